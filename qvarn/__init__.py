@@ -104,6 +104,24 @@ from .subitem_protos import (
     SubItemPrototypes,
 )
 
+from .item_cache import (
+    ItemCache,
+)
+
+from .document import (
+    DOCUMENT_COLUMN,
+    encode_document,
+    decode_document,
+)
+
+from .item_plan import (
+    ItemPlan,
+    TablePlan,
+    PlannedWalker,
+    get_item_plan,
+    compile_item_plan,
+)
+
 from .write_only import (
     WriteOnlyStorage,
     CannotAddWithId,
@@ -116,7 +134,11 @@ from .read_only import (
     ReadOnlyStorage,
     ItemDoesNotExist,
     FieldNotInResource,
+    BadSearchValue,
+    BadSearchCursor,
+    SearchSchema,
     create_search_param,
+    get_search_schema,
 )
 
 from .restype_storage import (
@@ -137,7 +159,11 @@ from .filler import (
 from .util import (
     get_resource_type_from_path,
     route_to_scope,
+    revision_etag,
+    etag_matches,
     table_name,
+    index_name,
+    get_case_sensitive_fields,
     ComplicatedTableNameError,
     create_tables_for_resource_type,
 )
@@ -146,6 +172,10 @@ from .simple_resource import (
     SimpleResource,
 )
 
+from .resource_stream import (
+    ResourceStream,
+)
+
 from .list_resource import (
     ListResource,
 )
@@ -174,6 +204,8 @@ from .listener_resource import (
     ListenerResource,
     listener_prototype,
     notification_prototype,
+    listener_search,
+    notification_search,
 )
 
 from .file_resource import (
@@ -82,6 +82,10 @@ class AuthorizationPlugin(object):
     def _get_current_scope(self):
         route_rule = bottle.request.route.rule
         request_method = bottle.request.method
+        # Bottle serves HEAD requests with the GET callback, so they
+        # need the same scope.
+        if request_method == 'HEAD':
+            request_method = 'GET'
         return qvarn.route_to_scope(route_rule, request_method)
 
 
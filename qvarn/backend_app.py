@@ -41,6 +41,11 @@ DEFAULT_CONFIG = {
         'log': 'syslog',
         'enable_access_log': 'false',
         'access_log_entry_chunk_size': '300',
+        'enable_item_cache': 'false',
+        'item_cache_max_items': '1000',
+        'enable_streaming': 'false',
+        'bulk_chunk_size': '1000',
+        'max_change_by_search': '1000',
     },
     'database': {
         'type': 'postgres',  # postgres, sqlite
@@ -52,6 +57,9 @@ DEFAULT_CONFIG = {
         'readonly': 'false',
         'minconn': '1',
         'maxconn': '5',
+        'fetch_batch_size': '1000',
+        'prepared_statements': 'false',
+        'json_items': 'false',
         'file': '',
     },
     'auth': {
@@ -98,10 +106,30 @@ class BackendApplication(object):
         self._dbconn = None
         self._vs_list = []
         self._conf = None
+        self._item_cache = None
+        self._streaming = False
+        self._bulk_chunk_size = 1000
+        self._max_change_by_search = 1000
 
     def add_versioned_storage(self, versioned_storage):
         self._vs_list.append(versioned_storage)
 
+    def get_item_cache(self):
+        '''Return the qvarn.ItemCache for resources, or None.'''
+        return self._item_cache
+
+    def is_streaming_enabled(self):
+        '''Should resource lists and search results be streamed?'''
+        return self._streaming
+
+    def get_bulk_chunk_size(self):
+        '''How many items should bulk creation add per transaction?'''
+        return self._bulk_chunk_size
+
+    def get_max_change_by_search(self):
+        '''How many resources may a search change or delete at most?'''
+        return self._max_change_by_search
+
     def add_routes(self, resources):
         '''Add routes to the application.
 
@@ -163,6 +191,13 @@ class BackendApplication(object):
             self._configure_logging(self._conf)
             qvarn.log.set_context('setup')
             self._install_logging_plugin(self._conf)
+            self._setup_item_cache(self._conf)
+            self._streaming = self._conf.getboolean(
+                'main', 'enable_streaming')
+            self._bulk_chunk_size = self._conf.getint(
+                'main', 'bulk_chunk_size')
+            self._max_change_by_search = self._conf.getint(
+                'main', 'max_change_by_search')
             # Error catching should also be as high as possible to catch all
             self._app.install(qvarn.ErrorTransformPlugin())
             self._setup_auth_token_endpoint(self._conf)
@@ -265,6 +300,11 @@ class BackendApplication(object):
         else:
             raise ConfigurationError("Unknown database type: %r" % dbtype)
 
+        sql.set_fetch_batch_size(conf.getint('database', 'fetch_batch_size'))
+        sql.set_prepared_statements(
+            conf.getboolean('database', 'prepared_statements'))
+        sql.set_json_items(conf.getboolean('database', 'json_items'))
+
         self._dbconn = qvarn.DatabaseConnection()
         self._dbconn.set_sql(sql)
 
@@ -336,6 +376,16 @@ class BackendApplication(object):
                     for vs in self._vs_list:
                         vs.prepare_storage(t, tables)
 
+            # Indexes are created after the tables have been
+            # committed, in autocommit mode, so that PostgreSQL can
+            # build them concurrently.
+            for vs in self._vs_list:
+                with self._dbconn.transaction(autocommit=True) as t:
+                    vs.prepare_indexes(t)
+
+            for vs in self._vs_list:
+                vs.prepare_documents(self._dbconn)
+
     def _configure_logging(self, conf):
         lognames = ['log', 'log2', 'log3', 'log4', 'log5']
         for logname in lognames:
@@ -410,6 +460,18 @@ class BackendApplication(object):
             access_log_entry_chunk_size=chunk_size)
         self._app.install(logging_plugin)
 
+    def _setup_item_cache(self, conf):
+        # The cache is created before uWSGI forks, but each worker
+        # gets its own copy of it, which is what we want.
+        enabled = conf.getboolean('main', 'enable_item_cache')
+        max_items = conf.getint('main', 'item_cache_max_items')
+        qvarn.log.log('info',
+                      msg='Item cache enabled?',
+                      enabled=enabled,
+                      max_items=max_items)
+        if enabled:
+            self._item_cache = qvarn.ItemCache(max_items)
+
     def _setup_auth(self, conf):
         validation_key = None
         issuer = None
@@ -41,8 +41,8 @@ class DatabaseConnection(object):
             self._sql.get_metadata(),
         )
 
-    def transaction(self):
-        trans = qvarn.Transaction()
+    def transaction(self, autocommit=False):
+        trans = qvarn.Transaction(autocommit=autocommit)
         trans.set_sql(self._sql)
         return trans
 
@@ -0,0 +1,62 @@
+# document.py - whole items stored as JSON documents
+#
+# Copyright 2019 Vaultit AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Store whole items as documents in the main table.
+
+A resource type can have its items stored as JSON documents, in
+addition to the tables for their fields. The document is in a column
+of the main table, so an item can be read with one query, instead of
+one per table. The tables for the fields are still used for
+searching.
+
+The column has the Python type dict, which SQL adapters map to a JSON
+type. It's NULL for items written before documents were enabled for
+the resource type, until VersionedStorage.prepare_documents fills it
+in.
+
+'''
+
+
+import json
+
+import six
+
+
+DOCUMENT_COLUMN = u'_document'
+
+
+def encode_document(item):
+    '''Return the value to store in the document column for an item.'''
+    return json.dumps(item, sort_keys=True)
+
+
+def decode_document(value):
+    '''Return the item from a document column value, or None.
+
+    Depending on the database and its driver, the value is the JSON
+    text or an already parsed dict.
+
+    '''
+
+    if value is None:
+        return None
+    if isinstance(value, six.binary_type):
+        value = value.decode('UTF-8')
+    if isinstance(value, six.string_types):
+        return json.loads(value)
+    return value
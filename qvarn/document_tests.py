@@ -0,0 +1,41 @@
+# document_tests.py - unit tests for document
+#
+# Copyright 2019 Vaultit AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+import qvarn
+
+
+class DocumentTests(unittest.TestCase):
+
+    item = {
+        u'type': u'yo',
+        u'id': u'yo-1',
+        u'names': [u'Ypäjä'],
+        u'dicts': [{u'age': 1, u'alive': True}],
+    }
+
+    def test_decodes_encoded_item(self):
+        encoded = qvarn.encode_document(self.item)
+        self.assertEqual(qvarn.decode_document(encoded), self.item)
+
+    def test_decodes_parsed_document_as_is(self):
+        self.assertEqual(qvarn.decode_document(self.item), self.item)
+
+    def test_decodes_null_as_none(self):
+        self.assertEqual(qvarn.decode_document(None), None)
@@ -54,6 +54,7 @@ class FileResource(object):
         self._item_prototype = None
         self._subitem_prototypes = qvarn.SubItemPrototypes()
         self._file_resource_name = None
+        self._document_storage = False
 
     def set_top_resource_path(self, path):
         '''Set path of the top level resource, e.g., /persons.'''
@@ -71,6 +72,15 @@ class FileResource(object):
         '''Set prototype for a subitem.'''
         self._subitem_prototypes.add(self._item_type, subitem_name, prototype)
 
+    def set_document_storage(self, enabled):
+        '''Set whether items are also stored as documents.
+
+        See qvarn.document.
+
+        '''
+
+        self._document_storage = enabled
+
     def set_listener(self, listener):
         '''Set the listener for this resource.
 
@@ -114,10 +124,15 @@ class FileResource(object):
         '''Serve GET /foos/123/<file_resource_name> to get a file.'''
         ro = self._create_ro_storage()
         with self._dbconn.transaction() as t:
+            revision = ro.get_item_revision(t, item_id)
+            bottle.response.set_header('Revision', revision)
+            bottle.response.set_header('ETag', qvarn.revision_etag(revision))
+            if_none_match = bottle.request.headers.get(u'If-None-Match')
+            if qvarn.etag_matches(revision, if_none_match):
+                bottle.response.status = 304
+                return u''
             subitem = ro.get_subitem(t, item_id, self._file_resource_name)
-            item = ro.get_item(t, item_id)
 
-        bottle.response.set_header('Revision', item[u'revision'])
         bottle.response.set_header('Content-Type', subitem[u'content_type'])
         return subitem[u'body']
 
@@ -159,6 +174,7 @@ class FileResource(object):
         wo.set_item_prototype(self._item_type, self._item_prototype)
         for subitem_name, prototype in self._subitem_prototypes.get_all():
             wo.set_subitem_prototype(self._item_type, subitem_name, prototype)
+        wo.set_document_storage(self._document_storage)
         return wo
 
 
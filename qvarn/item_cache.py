@@ -0,0 +1,117 @@
+# item_cache.py - in-process cache of recently read items
+#
+# Copyright 2019 Vaultit AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import copy
+import threading
+
+import qvarn
+
+
+class ItemCache(object):
+
+    '''A bounded cache of items, with least-recently-used eviction.
+
+    Each entry is identified by item type, item id, and revision. An
+    entry is only returned if the caller asks for the revision the
+    item currently has in the database, so an entry that another
+    process has made stale is never used. Writes in this process
+    should still call ``invalidate`` so that stale entries don't use
+    up space.
+
+    Items are copied when they are put in and taken out, so that
+    callers can modify them freely.
+
+    The statistics of the cache are logged every ``stats_interval``
+    lookups.
+
+    '''
+
+    def __init__(self, max_items, stats_interval=1000):
+        self._max_items = max_items
+        self._stats_interval = stats_interval
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self.hits = qvarn.Counter()
+        self.misses = qvarn.Counter()
+        self.evictions = qvarn.Counter()
+        self._lookups = qvarn.Counter()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, item_type, item_id, revision):
+        '''Return a cached item, or None if it's not in the cache.'''
+        key = (item_type, item_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != revision:
+                item = None
+            else:
+                # Move the entry to the end, so it's evicted last.
+                del self._entries[key]
+                self._entries[key] = entry
+                item = entry[1]
+
+        if item is None:
+            self.misses.increment()
+        else:
+            self.hits.increment()
+        if self._lookups.increment() % self._stats_interval == 0:
+            qvarn.log.log('item-cache-stats', **self.get_stats())
+        if item is None:
+            return None
+        return copy.deepcopy(item)
+
+    def put(self, item_type, item):
+        '''Add an item to the cache.
+
+        The item must have an id and a revision.
+
+        '''
+
+        if self._max_items <= 0:
+            return
+        key = (item_type, item[u'id'])
+        entry = (item[u'revision'], copy.deepcopy(item))
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self._max_items:
+                self._entries.popitem(last=False)
+                self.evictions.increment()
+
+    def invalidate(self, item_type, item_id):
+        '''Remove an item from the cache, if it is there.'''
+        with self._lock:
+            self._entries.pop((item_type, item_id), None)
+
+    def clear(self):
+        '''Remove all items from the cache.'''
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        '''Return a dict with the size and hit/miss counts of the cache.'''
+        return {
+            'items': len(self._entries),
+            'max_items': self._max_items,
+            'hits': self.hits.get(),
+            'misses': self.misses.get(),
+            'evictions': self.evictions.get(),
+        }
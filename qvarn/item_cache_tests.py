@@ -0,0 +1,136 @@
+# item_cache_tests.py - unit tests
+#
+# Copyright 2019 Vaultit AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+import six
+
+import qvarn
+
+
+class ItemCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = qvarn.ItemCache(2)
+
+    def item(self, item_id, revision):
+        return {u'id': item_id, u'revision': revision, u'names': [u'x']}
+
+    def test_is_empty_initially(self):
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.get(u'foo', u'1', u'r1'), None)
+
+    def test_returns_item_with_matching_revision(self):
+        self.cache.put(u'foo', self.item(u'1', u'r1'))
+        self.assertEqual(
+            self.cache.get(u'foo', u'1', u'r1'), self.item(u'1', u'r1'))
+
+    def test_does_not_return_item_with_other_revision(self):
+        self.cache.put(u'foo', self.item(u'1', u'r1'))
+        self.assertEqual(self.cache.get(u'foo', u'1', u'r2'), None)
+
+    def test_does_not_return_item_of_other_type(self):
+        self.cache.put(u'foo', self.item(u'1', u'r1'))
+        self.assertEqual(self.cache.get(u'bar', u'1', u'r1'), None)
+
+    def test_returns_copies(self):
+        item = self.item(u'1', u'r1')
+        self.cache.put(u'foo', item)
+        item[u'names'].append(u'y')
+        cached = self.cache.get(u'foo', u'1', u'r1')
+        cached[u'names'].append(u'z')
+        self.assertEqual(
+            self.cache.get(u'foo', u'1', u'r1'), self.item(u'1', u'r1'))
+
+    def test_evicts_least_recently_used_item(self):
+        self.cache.put(u'foo', self.item(u'1', u'r1'))
+        self.cache.put(u'foo', self.item(u'2', u'r2'))
+        self.cache.get(u'foo', u'1', u'r1')
+        self.cache.put(u'foo', self.item(u'3', u'r3'))
+        self.assertEqual(len(self.cache), 2)
+        self.assertNotEqual(self.cache.get(u'foo', u'1', u'r1'), None)
+        self.assertEqual(self.cache.get(u'foo', u'2', u'r2'), None)
+        self.assertNotEqual(self.cache.get(u'foo', u'3', u'r3'), None)
+
+    def test_replaces_older_revision(self):
+        self.cache.put(u'foo', self.item(u'1', u'r1'))
+        self.cache.put(u'foo', self.item(u'1', u'r2'))
+        self.assertEqual(len(self.cache), 1)
+        self.assertNotEqual(self.cache.get(u'foo', u'1', u'r2'), None)
+
+    def test_invalidates_item(self):
+        self.cache.put(u'foo', self.item(u'1', u'r1'))
+        self.cache.invalidate(u'foo', u'1')
+        self.assertEqual(self.cache.get(u'foo', u'1', u'r1'), None)
+
+    def test_clears(self):
+        self.cache.put(u'foo', self.item(u'1', u'r1'))
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_counts_hits_and_misses(self):
+        self.cache.put(u'foo', self.item(u'1', u'r1'))
+        self.cache.get(u'foo', u'1', u'r1')
+        self.cache.get(u'foo', u'1', u'r1')
+        self.cache.get(u'foo', u'2', u'r1')
+        self.assertEqual(
+            self.cache.get_stats(),
+            {'items': 1, 'max_items': 2, 'hits': 2, 'misses': 1,
+             'evictions': 0})
+
+    def test_counts_evictions(self):
+        for i in range(4):
+            self.cache.put(u'foo', self.item(six.text_type(i), u'r1'))
+        self.assertEqual(self.cache.get_stats()['evictions'], 2)
+
+    def test_logs_stats_every_interval(self):
+        writer = RecordingSlogWriter()
+        qvarn.log.add_log_writer(writer, qvarn.FilterAllow())
+        try:
+            cache = qvarn.ItemCache(2, stats_interval=2)
+            cache.put(u'foo', self.item(u'1', u'r1'))
+            for _ in range(5):
+                cache.get(u'foo', u'1', u'r1')
+            cache.get(u'foo', u'2', u'r1')
+        finally:
+            qvarn.log.remove_log_writer(writer)
+        stats = [
+            (x['hits'], x['misses']) for x in writer.log_objs
+            if x['msg_type'] == 'item-cache-stats'
+        ]
+        self.assertEqual(stats, [(2, 0), (4, 0), (5, 1)])
+
+    def test_zero_size_cache_stores_nothing(self):
+        cache = qvarn.ItemCache(0)
+        cache.put(u'foo', self.item(u'1', u'r1'))
+        self.assertEqual(len(cache), 0)
+
+
+class RecordingSlogWriter(qvarn.SlogWriter):
+
+    def __init__(self):
+        self.log_objs = []
+
+    def write(self, log_obj):
+        self.log_objs.append(log_obj)
+
+    def close(self):
+        pass
+
+    def reopen(self):
+        pass
@@ -0,0 +1,318 @@
+# item_plan.py - compiled form of item prototypes
+#
+# Copyright 2019 Vaultit AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''Compiled plans for reading and writing items.
+
+Walking a prototype means inspecting every field, sorting column
+names, and constructing table names. The result is the same every
+time, so we do it once per prototype and keep the result in an
+ItemPlan. The walkers that access the database execute from the plan.
+
+'''
+
+
+import collections
+
+import qvarn
+
+
+DictListPlan = collections.namedtuple('DictListPlan', (
+    'field',
+    'table',
+    # List of (field, TablePlan) pairs for string lists in the dicts.
+    'str_lists',
+    # List of InnerDictListPlan for dict lists in the dicts.
+    'inner_dict_lists',
+))
+
+
+InnerDictListPlan = collections.namedtuple('InnerDictListPlan', (
+    'field',
+    'table',
+    # List of (field, TablePlan) pairs for string lists in the dicts.
+    'str_lists',
+))
+
+
+class TablePlan(object):
+
+    '''Plan for one database table of an item.
+
+    ``columns`` are the value columns of the table, and
+    ``pos_columns`` are the columns that give the position of a row
+    within the item (such as ``list_pos``). The ``id`` column is not
+    included in either.
+
+    SQL statements formatted for the table are remembered, so that
+    they only need to be formatted once. See ``get_statement``.
+
+    '''
+
+    def __init__(self, name, columns, pos_columns=()):
+        self.name = name
+        self.columns = tuple(columns)
+        self.pos_columns = tuple(pos_columns)
+        self._statements = {}
+
+    def get_statement(self, sql, key, format_statement):
+        '''Return a formatted SQL statement.
+
+        ``key`` identifies the shape of the statement. If there's no
+        statement for the key yet, ``format_statement`` is called
+        to format it.
+
+        '''
+
+        key = (type(sql), key)
+        if key not in self._statements:
+            self._statements[key] = format_statement()
+        return self._statements[key]
+
+
+class ItemPlan(object):
+
+    '''Compiled plan for all tables of an item.
+
+    Use ``get_item_plan`` to get one.
+
+    '''
+
+    def __init__(self, main, str_lists, dict_lists):
+        self.main = main
+        self.str_lists = tuple(str_lists)
+        self.dict_lists = tuple(dict_lists)
+
+        self.tables = [main] + [table for _, table in str_lists]
+        self._tables_by_key = {(None, None, None): main}
+        for field, table in str_lists:
+            self._tables_by_key[(field, None, None)] = table
+        for dict_list in dict_lists:
+            self.tables.append(dict_list.table)
+            self._tables_by_key[(dict_list.field, None, None)] = (
+                dict_list.table)
+            for field, table in dict_list.str_lists:
+                self.tables.append(table)
+                self._tables_by_key[(dict_list.field, field, None)] = table
+            for inner in dict_list.inner_dict_lists:
+                self.tables.append(inner.table)
+                self._tables_by_key[(dict_list.field, inner.field, None)] = (
+                    inner.table)
+                for field, table in inner.str_lists:
+                    self.tables.append(table)
+                    key = (dict_list.field, inner.field, field)
+                    self._tables_by_key[key] = table
+
+    def get_table(self, list_field=None, subdict_list_field=None,
+                  inner_dict_list_field=None):
+        '''Return the TablePlan for a table of the item.
+
+        The arguments are the same as for ``qvarn.table_name``, except
+        for the resource type. Without arguments, the main table is
+        returned.
+
+        '''
+
+        key = (list_field, subdict_list_field, inner_dict_list_field)
+        return self._tables_by_key[key]
+
+
+_plans = {}
+
+
+def get_item_plan(prototype, **table_name_kwargs):
+    '''Return the ItemPlan for a prototype.
+
+    ``table_name_kwargs`` are given to ``qvarn.table_name`` to name
+    the tables, and must include ``resource_type``.
+
+    Plans are compiled once and remembered by the identity of the
+    prototype. Prototypes must not be modified after they have been
+    used to get a plan.
+
+    '''
+
+    key = (id(prototype), tuple(sorted(table_name_kwargs.items())))
+    cached = _plans.get(key)
+    if cached is None or cached[0] is not prototype:
+        cached = (prototype, compile_item_plan(prototype, **table_name_kwargs))
+        _plans[key] = cached
+    return cached[1]
+
+
+def compile_item_plan(prototype, **table_name_kwargs):
+    '''Compile a prototype into an ItemPlan, without caching.'''
+    walker = PlanCompiler(table_name_kwargs)
+    walker.walk_item(prototype, prototype)
+    return walker.get_plan()
+
+
+class PlanCompiler(qvarn.ItemWalker):
+
+    # This walks a prototype as if it were an item. Prototypes have
+    # one element in each list, but we make sure to only use the
+    # first one in case there are more.
+
+    def __init__(self, table_name_kwargs):
+        self._table_name_kwargs = table_name_kwargs
+        self._main = None
+        self._str_lists = []
+        self._dict_lists = collections.OrderedDict()
+
+    def _table_name(self, **kwargs):
+        kwargs.update(self._table_name_kwargs)
+        return qvarn.table_name(**kwargs)
+
+    def get_plan(self):
+        dict_lists = [
+            DictListPlan(
+                field,
+                parts['table'],
+                parts['str_lists'],
+                [
+                    InnerDictListPlan(inner_field, table, str_lists)
+                    for inner_field, (table, str_lists)
+                    in parts['inner_dict_lists'].items()
+                ])
+            for field, parts in self._dict_lists.items()
+        ]
+        return ItemPlan(self._main, self._str_lists, dict_lists)
+
+    def visit_main_dict(self, item, column_names):
+        self._main = TablePlan(self._table_name(), column_names)
+
+    def visit_main_str_list(self, item, field):
+        table = TablePlan(
+            self._table_name(list_field=field), [field], [u'list_pos'])
+        self._str_lists.append((field, table))
+
+    def visit_main_dict_list(self, item, field, column_names):
+        table = TablePlan(
+            self._table_name(list_field=field), column_names, [u'list_pos'])
+        self._dict_lists[field] = {
+            'table': table,
+            'str_lists': [],
+            'inner_dict_lists': collections.OrderedDict(),
+        }
+
+    def visit_dict_in_list_str_list(self, item, field, pos, str_list_field):
+        if pos == 0:
+            table_name = self._table_name(
+                list_field=field, subdict_list_field=str_list_field)
+            table = TablePlan(
+                table_name, [str_list_field], [u'dict_list_pos', u'list_pos'])
+            self._dict_lists[field]['str_lists'].append(
+                (str_list_field, table))
+
+    def visit_inner_dict_list(self, item, field, inner_field, column_names):
+        table_name = self._table_name(
+            list_field=field, subdict_list_field=inner_field)
+        table = TablePlan(
+            table_name, column_names, [u'dict_list_pos', u'list_pos'])
+        self._dict_lists[field]['inner_dict_lists'][inner_field] = (table, [])
+
+    def visit_dict_in_inner_list_str_list(self, item, outer_field, outer_pos,
+                                          inner_field, inner_pos,
+                                          str_list_field):
+        if outer_pos == 0 and inner_pos == 0:
+            table_name = self._table_name(
+                list_field=outer_field,
+                subdict_list_field=inner_field,
+                inner_dict_list_field=str_list_field)
+            table = TablePlan(
+                table_name,
+                [str_list_field],
+                [u'dict_list_pos', u'list_pos', u'str_list_pos'])
+            inner = self._dict_lists[outer_field]['inner_dict_lists']
+            inner[inner_field][1].append((str_list_field, table))
+
+
+class PlannedWalker(qvarn.ItemWalker):
+
+    '''Base class for walkers that access the tables of an item.
+
+    If the subclass sets ``_plan`` to an ItemPlan, ``walk_item``
+    makes its visits from the plan instead of inspecting the
+    prototype, and ``_get_table`` looks up tables from the plan.
+    Without a plan, both work from the prototype and
+    ``_item_type``, like a plain ItemWalker.
+
+    '''
+
+    _plan = None
+    _item_type = None
+
+    def _get_table(self, **kwargs):
+        if self._plan is not None:
+            return self._plan.get_table(**kwargs)
+        return TablePlan(
+            qvarn.table_name(resource_type=self._item_type, **kwargs), [])
+
+    def _main_field_ok(self, field):
+        return True
+
+    def _get_main_str_lists(self, proto):
+        return [
+            x for x in self._get_str_lists(proto)
+            if self._main_field_ok(x)
+        ]
+
+    def _get_main_dict_lists(self, proto):
+        return [
+            x for x in self._get_dict_lists(proto)
+            if self._main_field_ok(x)
+        ]
+
+    def walk_item(self, item, proto_item):
+        if self._plan is None:
+            super(PlannedWalker, self).walk_item(item, proto_item)
+        else:
+            self._walk_plan(item, self._plan)
+
+    def _walk_plan(self, item, plan):
+        self.visit_main_dict(item, list(plan.main.columns))
+        for field, _ in plan.str_lists:
+            if self._main_field_ok(field):
+                self.visit_main_str_list(item, field)
+        for dict_list in plan.dict_lists:
+            if self._main_field_ok(dict_list.field):
+                self._walk_dict_list_plan(item, dict_list)
+
+    def _walk_dict_list_plan(self, item, dict_list):
+        field = dict_list.field
+        names = list(dict_list.table.columns)
+        self.visit_main_dict_list(item, field, names)
+
+        for inner in dict_list.inner_dict_lists:
+            self.visit_inner_dict_list(
+                item, field, inner.field, list(inner.table.columns))
+
+        for i in range(len(item[field])):
+            self.visit_dict_in_list(item, field, i, names)
+            for str_list_field, _ in dict_list.str_lists:
+                self.visit_dict_in_list_str_list(
+                    item, field, i, str_list_field)
+
+            for inner in dict_list.inner_dict_lists:
+                inner_list = item[field][i].get(inner.field, [])
+                column_names = list(inner.table.columns)
+                for j in range(len(inner_list)):
+                    self.visit_dict_in_inner_list(
+                        item, field, i, inner.field, j, column_names)
+                    for str_list_field, _ in inner.str_lists:
+                        self.visit_dict_in_inner_list_str_list(
+                            item, field, i, inner.field, j, str_list_field)
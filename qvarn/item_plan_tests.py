@@ -0,0 +1,191 @@
+# item_plan_tests.py - unit tests
+#
+# Copyright 2019 Vaultit AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+import qvarn
+
+
+class ItemPlanTests(unittest.TestCase):
+
+    prototype = {
+        u'type': u'',
+        u'id': u'',
+        u'name': u'',
+        u'aliases': [u''],
+        u'outer': [
+            {
+                u'value': u'',
+                u'names': [u''],
+                u'inner': [
+                    {
+                        u'flag': False,
+                        u'tags': [u''],
+                    },
+                ],
+            },
+        ],
+    }
+
+    def setUp(self):
+        self.plan = qvarn.compile_item_plan(
+            self.prototype, resource_type=u'foo')
+
+    def test_has_main_table(self):
+        self.assertEqual(self.plan.main.name, u'foo')
+        self.assertEqual(self.plan.main.columns, (u'id', u'name', u'type'))
+        self.assertEqual(self.plan.main.pos_columns, ())
+
+    def test_has_str_list_table(self):
+        table = self.plan.get_table(list_field=u'aliases')
+        self.assertEqual(table.name, u'foo_aliases')
+        self.assertEqual(table.columns, (u'aliases',))
+        self.assertEqual(table.pos_columns, (u'list_pos',))
+
+    def test_has_dict_list_table(self):
+        table = self.plan.get_table(list_field=u'outer')
+        self.assertEqual(table.name, u'foo_outer')
+        self.assertEqual(table.columns, (u'value',))
+        self.assertEqual(table.pos_columns, (u'list_pos',))
+
+    def test_has_inner_tables(self):
+        names = self.plan.get_table(
+            list_field=u'outer', subdict_list_field=u'names')
+        inner = self.plan.get_table(
+            list_field=u'outer', subdict_list_field=u'inner')
+        tags = self.plan.get_table(
+            list_field=u'outer', subdict_list_field=u'inner',
+            inner_dict_list_field=u'tags')
+        self.assertEqual(names.name, u'foo_outer_names')
+        self.assertEqual(inner.name, u'foo_outer_inner')
+        self.assertEqual(inner.columns, (u'flag',))
+        self.assertEqual(tags.name, u'foo_outer_inner_tags')
+        self.assertEqual(
+            tags.pos_columns, (u'dict_list_pos', u'list_pos', u'str_list_pos'))
+
+    def test_lists_all_tables(self):
+        self.assertEqual(
+            sorted(t.name for t in self.plan.tables),
+            [
+                u'foo',
+                u'foo_aliases',
+                u'foo_outer',
+                u'foo_outer_inner',
+                u'foo_outer_inner_tags',
+                u'foo_outer_names',
+            ])
+
+    def test_caches_plans_by_prototype(self):
+        first = qvarn.get_item_plan(self.prototype, resource_type=u'foo')
+        second = qvarn.get_item_plan(self.prototype, resource_type=u'foo')
+        self.assertIs(first, second)
+
+    def test_compiles_separate_plans_for_separate_types(self):
+        foo = qvarn.get_item_plan(self.prototype, resource_type=u'foo')
+        bar = qvarn.get_item_plan(self.prototype, resource_type=u'bar')
+        self.assertEqual(bar.main.name, u'bar')
+        self.assertIsNot(foo, bar)
+
+
+class TablePlanTests(unittest.TestCase):
+
+    def test_formats_statement_once(self):
+        calls = []
+
+        def format_statement():
+            calls.append(None)
+            return u'SELECT'
+
+        table = qvarn.TablePlan(u'foo', [u'bar'])
+        sql = qvarn.SqliteAdapter()
+        self.assertEqual(table.get_statement(sql, 1, format_statement),
+                         u'SELECT')
+        self.assertEqual(table.get_statement(sql, 1, format_statement),
+                         u'SELECT')
+        self.assertEqual(len(calls), 1)
+
+
+class PlannedWalkerTests(unittest.TestCase):
+
+    def test_visits_the_same_as_without_plan(self):
+        proto = ItemPlanTests.prototype
+        item = {
+            u'type': u'foo',
+            u'id': u'1',
+            u'name': u'x',
+            u'aliases': [u'a', u'b'],
+            u'outer': [
+                {
+                    u'value': u'v',
+                    u'names': [u'n'],
+                    u'inner': [
+                        {u'flag': True, u'tags': [u't']},
+                        {u'flag': False, u'tags': []},
+                    ],
+                },
+            ],
+        }
+
+        without_plan = RecordingWalker()
+        without_plan.walk_item(item, proto)
+
+        with_plan = RecordingWalker()
+        # pylint: disable=protected-access
+        with_plan._plan = qvarn.compile_item_plan(proto, resource_type=u'foo')
+        with_plan.walk_item(item, proto)
+
+        self.assertEqual(with_plan.visits, without_plan.visits)
+
+
+class RecordingWalker(qvarn.PlannedWalker):
+
+    def __init__(self):
+        self.visits = []
+
+    def visit_main_dict(self, item, column_names):
+        self.visits.append(('main_dict', column_names))
+
+    def visit_main_str_list(self, item, field):
+        self.visits.append(('main_str_list', field))
+
+    def visit_main_dict_list(self, item, field, column_names):
+        self.visits.append(('main_dict_list', field, column_names))
+
+    def visit_dict_in_list(self, item, field, pos, column_names):
+        self.visits.append(('dict_in_list', field, pos, column_names))
+
+    def visit_dict_in_list_str_list(self, item, field, pos, str_list_field):
+        self.visits.append(
+            ('dict_in_list_str_list', field, pos, str_list_field))
+
+    def visit_inner_dict_list(self, item, field, inner_field, column_names):
+        self.visits.append(
+            ('inner_dict_list', field, inner_field, column_names))
+
+    def visit_dict_in_inner_list(self, item, outer_field, outer_pos,
+                                 inner_field, inner_pos, column_names):
+        self.visits.append(
+            ('dict_in_inner_list', outer_field, outer_pos, inner_field,
+             inner_pos, column_names))
+
+    def visit_dict_in_inner_list_str_list(self, item, outer_field, outer_pos,
+                                          inner_field, inner_pos,
+                                          str_list_field):
+        self.visits.append(
+            ('dict_in_inner_list_str_list', outer_field, outer_pos,
+             inner_field, inner_pos, str_list_field))
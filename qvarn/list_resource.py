@@ -34,6 +34,7 @@
 '''Multi-item resources in the HTTP API.'''
 
 
+import collections
 import json
 
 import bottle
@@ -42,9 +43,23 @@ from six.moves.urllib.parse import urljoin, urlparse, urlunparse, unquote
 
 import qvarn
 
+from qvarn.basic_validation_plugin import (
+    NewItemHasIdAlready, NewItemHasRevisionAlready)
 from qvarn.read_only import SortParam
 
 
+SearchCriteria = collections.namedtuple('SearchCriteria', (
+    'search_params',
+    'show_params',
+    'sort_params',
+    'limit',
+    'offset',
+    'after',
+    'count',
+    'approximate',
+))
+
+
 class ListResource(object):
 
     '''A multi-item resource in the HTTP API.
@@ -67,6 +82,12 @@ class ListResource(object):
         self._item_validator = self._no_validator
         self._subitem_prototypes = qvarn.SubItemPrototypes()
         self._listener = None
+        self._item_cache = None
+        self._streaming = False
+        self._search_spec = None
+        self._document_storage = False
+        self._bulk_chunk_size = 1000
+        self._max_change_by_search = 1000
         self._dbconn = None
 
     def _no_validator(self, item):
@@ -109,11 +130,69 @@ class ListResource(object):
         '''
         self._listener = listener
 
+    def set_item_cache(self, item_cache):
+        '''Set a qvarn.ItemCache for items of this resource.
+
+        Without a cache, every GET reads the whole item from the
+        database.
+
+        '''
+
+        self._item_cache = item_cache
+
+    def set_search_spec(self, search_spec):
+        '''Set the ``search`` part of the resource type spec.
+
+        See ReadOnlyStorage.set_search_spec.
+
+        '''
+
+        self._search_spec = search_spec
+
+    def set_document_storage(self, enabled):
+        '''Set whether items are also stored as documents.
+
+        See qvarn.document.
+
+        '''
+
+        self._document_storage = enabled
+
+    def set_streaming(self, streaming):
+        '''Set whether lists and search results are streamed.
+
+        When streaming, GET /foos and GET /foos/search produce the
+        JSON response body incrementally, reading resources from the
+        database as the body is sent, instead of building the whole
+        result in memory first.
+
+        '''
+
+        self._streaming = streaming
+
+    def set_bulk_chunk_size(self, chunk_size):
+        '''Set how many items POST /foos/_bulk adds per transaction.'''
+        self._bulk_chunk_size = chunk_size
+
+    def set_max_change_by_search(self, max_items):
+        '''Set how many items a search may change or delete at most.'''
+        self._max_change_by_search = max_items
+
     def prepare_resource(self, dbconn):
         '''Prepare the resource for action.'''
 
         self._dbconn = dbconn
 
+        # Compile the item plans now, rather than when serving the
+        # first request.
+        qvarn.get_item_plan(
+            self._item_prototype, resource_type=self._item_type)
+        for subitem_name, prototype in self._subitem_prototypes.get_all():
+            qvarn.get_item_plan(
+                prototype,
+                resource_type=qvarn.table_name(
+                    resource_type=self._item_type, subpath=subitem_name))
+
         item_paths = [
             {
                 'path': self._path,
@@ -126,6 +205,11 @@ class ListResource(object):
                 'callback': self.post_item,
                 'apply': qvarn.BasicValidationPlugin(),
             },
+            {
+                'path': self._path + '/_bulk',
+                'method': 'POST',
+                'callback': self.post_items_bulk,
+            },
             {
                 'path': self._path + '/<item_id>',
                 'method': 'GET',
@@ -147,6 +231,17 @@ class ListResource(object):
                 'method': 'GET',
                 'callback': self.get_matching_items,
             },
+            {
+                'path': self._path + '/search/<search_criteria:path>',
+                'method': 'PUT',
+                'callback': self.put_matching_items,
+                'apply': ChangeBySearchJSONPlugin(),
+            },
+            {
+                'path': self._path + '/search/<search_criteria:path>',
+                'method': 'DELETE',
+                'callback': self.delete_matching_items,
+            },
         ]
 
         subitem_paths = []
@@ -175,16 +270,57 @@ class ListResource(object):
     def get_items(self):
         '''Serve GET /foos to list all items.'''
         ro = self._create_ro_storage()
+        if self._streaming:
+            return self._stream(
+                lambda t: ({u'id': x} for x in ro.iter_item_ids(t)))
         with self._dbconn.transaction() as t:
             return {
                 'resources': [
-                    {'id': resource_id} for resource_id in ro.get_item_ids(t)
+                    {'id': resource_id}
+                    for resource_id in ro.iter_item_ids(t)
                 ],
             }
 
     def get_matching_items(self, search_criteria):
         '''Serve GET /foos/search to list items matching search criteria.'''
 
+        criteria = self._parse_search_criteria()
+        search_params = criteria.search_params
+        show_params = criteria.show_params
+        sort_params = criteria.sort_params
+        limit = criteria.limit
+        offset = criteria.offset
+        after = criteria.after
+        count = criteria.count
+        approximate = criteria.approximate
+
+        if count and (show_params or sort_params or limit is not None or
+                      offset is not None or after is not None):
+            raise BadCountSearch()
+
+        if approximate and search_params:
+            raise BadApproximateCount()
+
+        if (limit is not None or offset is not None) and not sort_params:
+            raise LimitWithoutSortError()
+
+        ro = self._create_ro_storage()
+        if count:
+            with self._dbconn.transaction() as t:
+                return {
+                    u'count': ro.count(
+                        t, search_params, approximate=approximate),
+                }
+        if self._streaming:
+            return self._stream(
+                lambda t: ro.search_iter(
+                    t, search_params, show_params, sort_params,
+                    limit=limit, offset=offset, after=after))
+        with self._dbconn.transaction() as t:
+            return ro.search(t, search_params, show_params, sort_params,
+                             limit=limit, offset=offset, after=after)
+
+    def _parse_search_criteria(self):
         # We need criteria to be encoded so that when we split by slash (/),
         # we split the criteria correctly and keep the slashes in the
         # condition values.
@@ -205,6 +341,9 @@ class ListResource(object):
         sort_params = []
         limit = None
         offset = None
+        after = None
+        count = False
+        approximate = False
         search_any = False
 
         any_opers = [
@@ -279,6 +418,19 @@ class ListResource(object):
                 if offset < 0:
                     raise BadOffsetValue(error="should be positive integer")
                 i += 2
+            elif part == u'after':
+                if i + 1 >= len(criteria):
+                    raise BadSearchCondition()
+                after = criteria[i + 1]
+                i += 2
+            elif part == u'count':
+                count = True
+                if (i + 1 < len(criteria) and
+                        criteria[i + 1] == u'approximate'):
+                    approximate = True
+                    i += 2
+                else:
+                    i += 1
             elif part == u'any':
                 if (i + 1) >= len(criteria):
                     raise MissingAnyOperator()
@@ -292,29 +444,103 @@ class ListResource(object):
             else:
                 raise BadSearchCondition()
 
-        if (limit is not None or offset is not None) and not sort_params:
-            raise LimitWithoutSortError()
+        return SearchCriteria(
+            search_params, show_params, sort_params, limit, offset, after,
+            count, approximate)
+
+    def delete_matching_items(self, search_criteria):
+        '''Serve DELETE /foos/search to delete items matching a search.
 
+        The search may only have conditions. If more than the maximum
+        number of items for changes by search match, nothing is
+        deleted. Otherwise all matching items are deleted in one
+        transaction, and the response lists their ids.
+
+        '''
+
+        search_params = self._get_change_search_params()
         ro = self._create_ro_storage()
+        wo = self._create_wo_storage()
         with self._dbconn.transaction() as t:
-            return ro.search(t, search_params, show_params, sort_params,
-                             limit=limit, offset=offset)
+            item_ids = self._get_ids_to_change(t, ro, search_params)
+            wo.delete_items(t, item_ids)
 
-    def post_item(self):
-        '''Serve POST /foos to create a new item.'''
+        self._listener.notify_delete_many(item_ids)
+        return {
+            u'resources': [{u'id': item_id} for item_id in item_ids],
+        }
 
-        item = bottle.request.qvarn_json
-        qvarn.add_missing_item_fields(
-            self._item_type, self._item_prototype, item)
+    def put_matching_items(self, search_criteria):
+        '''Serve PUT /foos/search to change items matching a search.
 
+        The body is a JSON object with new values for some of the
+        fields that aren't lists. Those fields are set to the same
+        values in all matching items, and each of them gets a new
+        revision. The search and the maximum number of items are as
+        for ``delete_matching_items``. Resource types that have
+        an item validator can't be changed this way, since the
+        validator needs the whole item.
+
+        '''
+
+        fields = bottle.request.qvarn_json
+        if self._item_validator != self._no_validator:
+            raise ChangeBySearchNotAllowed()
+        if not isinstance(fields, dict) or not fields:
+            raise BadChangeBySearchFields()
+        for field in fields:
+            if (field in (u'id', u'type', u'revision') or
+                    isinstance(self._item_prototype.get(field), list)):
+                raise FieldCannotBeChangedBySearch(field=field)
         iv = qvarn.ItemValidator()
-        iv.validate_item(self._item_type, self._item_prototype, item)
-        self._item_validator(item)
+        iv.validate_fields(self._item_prototype, fields)
 
-        # Filling in default values sets the fields to None, if
-        # missing. Thus we accept that and just remove it here.
-        del item[u'id']
-        del item[u'revision']
+        search_params = self._get_change_search_params()
+        ro = self._create_ro_storage()
+        wo = self._create_wo_storage()
+        with self._dbconn.transaction() as t:
+            item_ids = self._get_ids_to_change(t, ro, search_params)
+            updated = wo.update_items_fields(t, item_ids, fields)
+
+        self._listener.notify_update_many(updated)
+        return {
+            u'resources': [
+                {u'id': item_id, u'revision': revision}
+                for item_id, revision in updated
+            ],
+        }
+
+    def _get_change_search_params(self):
+        criteria = self._parse_search_criteria()
+        only_conditions = (
+            not criteria.show_params and
+            not criteria.sort_params and
+            criteria.limit is None and
+            criteria.offset is None and
+            criteria.after is None and
+            not criteria.count)
+        if not criteria.search_params or not only_conditions:
+            raise BadChangeBySearchCondition()
+        return criteria.search_params
+
+    def _get_ids_to_change(self, transaction, ro, search_params):
+        max_items = self._max_change_by_search
+        item_ids = ro.get_matching_ids(
+            transaction, search_params, limit=max_items + 1)
+        if len(item_ids) > max_items:
+            raise TooManyItemsToChange(max_items=max_items)
+        return item_ids
+
+    def _stream(self, get_resources):
+        stream = qvarn.ResourceStream(self._dbconn, get_resources)
+        bottle.response.content_type = 'application/json'
+        return stream
+
+    def post_item(self):
+        '''Serve POST /foos to create a new item.'''
+
+        item = bottle.request.qvarn_json
+        self._prepare_new_item(item)
 
         wo = self._create_wo_storage()
         with self._dbconn.transaction() as t:
@@ -331,22 +557,136 @@ class ListResource(object):
         bottle.response.status = 201
         return added
 
+    def _prepare_new_item(self, item):
+        qvarn.add_missing_item_fields(
+            self._item_type, self._item_prototype, item)
+
+        iv = qvarn.ItemValidator()
+        iv.validate_item(self._item_type, self._item_prototype, item)
+        self._item_validator(item)
+
+        # Filling in default values sets the fields to None, if
+        # missing. Thus we accept that and just remove it here.
+        del item[u'id']
+        del item[u'revision']
+
+    def post_items_bulk(self):
+        '''Serve POST /foos/_bulk to create many items at once.
+
+        The body is either a JSON list of items, or, with content type
+        application/x-ndjson, one JSON item per line. Each item is
+        validated like in POST /foos. Valid items are added in
+        transactions of at most the bulk chunk size items each, and
+        listeners are notified of each chunk at once.
+
+        The response has one result per item, in the same order: the
+        id and revision of the added item, or the error that prevented
+        adding it.
+
+        '''
+
+        items = self._parse_bulk_body()
+
+        results = []
+        valid = []
+        for i, item in enumerate(items):
+            try:
+                if isinstance(item, dict):
+                    if u'id' in item:
+                        raise NewItemHasIdAlready(item_id=item[u'id'])
+                    if u'revision' in item:
+                        raise NewItemHasRevisionAlready(
+                            revision=item[u'revision'])
+                self._prepare_new_item(item)
+            except qvarn.HTTPError as e:
+                results.append({u'error': e.error})
+            else:
+                results.append(None)
+                valid.append((i, item))
+
+        wo = self._create_wo_storage()
+        chunk_size = max(1, self._bulk_chunk_size)
+        for start in range(0, len(valid), chunk_size):
+            chunk = valid[start:start + chunk_size]
+            with self._dbconn.transaction() as t:
+                added_items = wo.add_items(t, [item for _, item in chunk])
+            self._listener.notify_create_many(
+                [(x[u'id'], x[u'revision']) for x in added_items])
+            for (i, _), added in zip(chunk, added_items):
+                results[i] = {
+                    u'id': added[u'id'],
+                    u'revision': added[u'revision'],
+                }
+
+        return {u'resources': results}
+
+    def _parse_bulk_body(self):
+        content_type = bottle.request.content_type
+        if content_type not in ('application/json', 'application/x-ndjson'):
+            raise BulkContentTypeNotSupported()
+
+        body = bottle.request.body.read()
+        try:
+            if not isinstance(body, six.text_type):
+                body = body.decode('UTF-8')
+            if content_type == 'application/json':
+                items = json.loads(body)
+            else:
+                items = [
+                    json.loads(line)
+                    for line in body.splitlines()
+                    if line.strip()
+                ]
+        except (ValueError, UnicodeDecodeError):
+            raise qvarn.ContentIsNotJSON()
+
+        if not isinstance(items, list):
+            raise BulkBodyIsNotList()
+        return items
+
     def get_item(self, item_id):
-        '''Serve GET /foos/123 to get an existing item.'''
+        '''Serve GET /foos/123 to get an existing item.
+
+        The revision of the item is returned as the ETag header. If
+        the request has an If-None-Match header that matches it, the
+        response is 304 Not Modified and the item is not read.
+
+        '''
+
         ro = self._create_ro_storage()
         with self._dbconn.transaction() as t:
-            return ro.get_item(t, item_id)
+            if u'If-None-Match' in bottle.request.headers:
+                revision = ro.get_item_revision(t, item_id)
+                if self._not_modified(revision):
+                    return u''
+            item = ro.get_item(t, item_id)
+
+        etag = qvarn.revision_etag(item[u'revision'])
+        bottle.response.set_header('ETag', etag)
+        return item
 
     def get_subitem(self, item_id, subitem_path):
         '''Serve GET /foos/123/subitem.'''
         ro = self._create_ro_storage()
         with self._dbconn.transaction() as t:
+            revision = ro.get_item_revision(t, item_id)
+            if self._not_modified(revision):
+                return u''
             subitem = ro.get_subitem(t, item_id, subitem_path)
-            item = ro.get_item(t, item_id)
 
-        subitem[u'revision'] = item[u'revision']
+        subitem[u'revision'] = revision
         return subitem
 
+    def _not_modified(self, revision):
+        # Set the ETag header, and if the request already has the
+        # current revision, set status to 304 Not Modified.
+        bottle.response.set_header('ETag', qvarn.revision_etag(revision))
+        if_none_match = bottle.request.headers.get(u'If-None-Match')
+        if qvarn.etag_matches(revision, if_none_match):
+            bottle.response.status = 304
+            return True
+        return False
+
     def put_item(self, item_id):
         '''Serve PUT /foos/123 to update an item.'''
 
@@ -402,6 +742,9 @@ class ListResource(object):
         ro.set_item_prototype(self._item_type, self._item_prototype)
         for subitem_name, prototype in self._subitem_prototypes.get_all():
             ro.set_subitem_prototype(self._item_type, subitem_name, prototype)
+        ro.set_item_cache(self._item_cache)
+        ro.set_search_spec(self._search_spec)
+        ro.set_document_storage(self._document_storage)
         return ro
 
     def _create_wo_storage(self):
@@ -409,6 +752,8 @@ class ListResource(object):
         wo.set_item_prototype(self._item_type, self._item_prototype)
         for subitem_name, prototype in self._subitem_prototypes.get_all():
             wo.set_subitem_prototype(self._item_type, subitem_name, prototype)
+        wo.set_item_cache(self._item_cache)
+        wo.set_document_storage(self._document_storage)
         return wo
 
     def _create_resource_ro_storage(
@@ -424,6 +769,63 @@ class ListResource(object):
         return wo
 
 
+class BulkContentTypeNotSupported(qvarn.UnsupportedMediaType):
+
+    msg = u'Content-Type must be application/json or application/x-ndjson'
+
+
+class BulkBodyIsNotList(qvarn.BadRequest):
+
+    msg = u'Bulk request body must be a JSON list of items'
+
+
+class ChangeBySearchJSONPlugin(qvarn.BasicValidationPlugin):
+
+    '''Parse the JSON body of PUT /foos/search.
+
+    The body is not a whole item, so the checks of
+    BasicValidationPlugin for PUT don't apply.
+
+    '''
+
+    def apply(self, callback, route):
+        def wrapper(*args, **kwargs):
+            self._parse_json()
+            return callback(*args, **kwargs)
+        return wrapper
+
+
+class BadChangeBySearchCondition(qvarn.BadRequest):
+
+    msg = (
+        u'Changing or deleting by search needs search conditions, '
+        u'and nothing else'
+    )
+
+
+class BadChangeBySearchFields(qvarn.BadRequest):
+
+    msg = u'Changing by search needs a JSON object of fields to change'
+
+
+class FieldCannotBeChangedBySearch(qvarn.BadRequest):
+
+    msg = u'Field {field} cannot be changed by search'
+
+
+class ChangeBySearchNotAllowed(qvarn.BadRequest):
+
+    msg = u'Resources of this type cannot be changed by search'
+
+
+class TooManyItemsToChange(qvarn.BadRequest):
+
+    msg = (
+        u'Search matches more than {max_items} resources, '
+        u'which is the most that can be changed or deleted at once'
+    )
+
+
 class BadSearchCondition(qvarn.BadRequest):
 
     msg = u'Could not parse search condition'
@@ -448,6 +850,19 @@ class BadOffsetValue(LimitError):
     msg = u'Invalid OFFSET value: {error}.'
 
 
+class BadCountSearch(qvarn.BadRequest):
+
+    msg = (
+        u"COUNT can't be used together with SHOW, SHOW_ALL, SORT, RSORT, "
+        u"LIMIT, OFFSET or AFTER."
+    )
+
+
+class BadApproximateCount(qvarn.BadRequest):
+
+    msg = u'Approximate COUNT can only be used without search conditions.'
+
+
 class BadAnySearchValue(qvarn.BadRequest):
 
     msg = u"Can't parse ANY search value: {error}."
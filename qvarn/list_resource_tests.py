@@ -21,6 +21,7 @@
 # (https://github.com/PyCQA/pylint/issues/2181)
 # pylint: disable=wrong-import-order
 
+import io
 import json
 import unittest
 
@@ -31,8 +32,12 @@ import qvarn
 
 from qvarn.list_resource import (
     LimitWithoutSortError, BadLimitValue, BadOffsetValue, BadAnySearchValue,
-    InvalidAnyOperator, MissingAnyOperator,
+    InvalidAnyOperator, MissingAnyOperator, BadCountSearch,
+    BadApproximateCount, BulkBodyIsNotList, BulkContentTypeNotSupported,
+    BadChangeBySearchCondition, FieldCannotBeChangedBySearch,
+    ChangeBySearchNotAllowed, TooManyItemsToChange,
 )
+from qvarn.validate import UnknownKeys, WrongTypeValue
 
 
 class ListResourceBase(unittest.TestCase):
@@ -278,13 +283,445 @@ class SearchAnyTests(ListResourceBase):
         ))
 
 
+class CountTests(ListResourceBase):
+
+    def setUp(self):
+        super(CountTests, self).setUp()
+        self._add_item(foo=u'a', lst=[u'x', u'y'])
+        self._add_item(foo=u'b', lst=[u'x'])
+        self._add_item(foo=u'b')
+
+    def _count(self, url):
+        bottle.request.environ['REQUEST_URI'] = url
+        return self.resource.get_matching_items(url)
+
+    def test_counts_all_items(self):
+        self.assertEqual(self._count(u'/search/count'), {u'count': 3})
+
+    def test_counts_matching_items(self):
+        self.assertEqual(
+            self._count(u'/search/exact/foo/b/count'), {u'count': 2})
+        self.assertEqual(
+            self._count(u'/search/count/exact/lst/x'), {u'count': 2})
+
+    def test_counts_approximately(self):
+        self.assertEqual(
+            self._count(u'/search/count/approximate'), {u'count': 3})
+
+    def test_count_is_not_streamed(self):
+        self.resource.set_streaming(True)
+        self.assertEqual(self._count(u'/search/count'), {u'count': 3})
+
+    def test_rejects_count_with_show(self):
+        with self.assertRaises(BadCountSearch):
+            self._count(u'/search/count/show_all')
+
+    def test_rejects_count_with_limit(self):
+        with self.assertRaises(BadCountSearch):
+            self._count(u'/search/count/sort/foo/limit/1')
+
+    def test_rejects_approximate_count_with_conditions(self):
+        with self.assertRaises(BadApproximateCount):
+            self._count(u'/search/count/approximate/exact/foo/b')
+
+
+class CursorTests(ListResourceBase):
+
+    def setUp(self):
+        super(CursorTests, self).setUp()
+        self._add_item(foo=u'b', bar=u'1', lst=[u'x'])
+        self._add_item(foo=u'a', bar=u'2')
+        self._add_item(foo=u'b', bar=u'3', lst=[u'z'])
+        self._add_item(foo=u'c', bar=u'4')
+        self._add_item(foo=u'a', bar=u'5', lst=[u'y'])
+
+    def _get(self, url):
+        bottle.request.environ['REQUEST_URI'] = url
+        result = self.resource.get_matching_items(url)
+        bottle.request = bottle.LocalRequest()
+        return result
+
+    def _get_all_pages(self, url):
+        pages = []
+        result = self._get(url)
+        pages.append([x[u'bar'] for x in result[u'resources']])
+        while u'next' in result:
+            result = self._get(url + u'/after/' + result[u'next'])
+            pages.append([x[u'bar'] for x in result[u'resources']])
+        return pages
+
+    def _get_unpaged(self, url):
+        return [x[u'bar'] for x in self._get(url)[u'resources']]
+
+    def assertPagesMatch(self, url, page_size):
+        pages = self._get_all_pages(
+            u'{}/limit/{}'.format(url, page_size))
+        self.assertTrue(all(len(page) <= page_size for page in pages))
+        # With a limit, rows with equal sort keys are ordered by id.
+        self.assertEqual(
+            sum(pages, []), self._get_unpaged(url + u'/limit/100'))
+
+    def test_returns_no_cursor_without_limit(self):
+        result = self._get(u'/search/sort/foo/show_all')
+        self.assertNotIn(u'next', result)
+
+    def test_returns_no_cursor_for_last_page(self):
+        result = self._get(u'/search/sort/foo/show_all/limit/10')
+        self.assertNotIn(u'next', result)
+
+    def test_pages_through_ascending_sort(self):
+        self.assertPagesMatch(u'/search/sort/foo/show_all', 2)
+
+    def test_pages_through_descending_sort(self):
+        self.assertPagesMatch(u'/search/rsort/foo/show_all', 2)
+
+    def test_pages_through_mixed_sort(self):
+        self.assertPagesMatch(u'/search/sort/foo/rsort/bar/show_all', 1)
+
+    def test_pages_through_sort_with_nulls(self):
+        self.assertPagesMatch(u'/search/sort/lst/show_all', 2)
+        self.assertPagesMatch(u'/search/rsort/lst/show_all', 2)
+
+    def test_pages_through_search_results(self):
+        self.assertPagesMatch(u'/search/exact/foo/b/sort/bar/show_all', 1)
+
+    def test_pages_through_streamed_results(self):
+        self.resource.set_streaming(True)
+        url = u'/search/sort/bar/show/bar/limit/2'
+        body = json.loads(u''.join(self._get(url)))
+        self.assertEqual([x[u'bar'] for x in body[u'resources']], [u'1', u'2'])
+        body = json.loads(u''.join(
+            self._get(url + u'/after/' + body[u'next'])))
+        self.assertEqual([x[u'bar'] for x in body[u'resources']], [u'3', u'4'])
+
+    def test_rejects_bad_cursor(self):
+        with self.assertRaises(qvarn.BadSearchCursor):
+            self._get(u'/search/sort/foo/show_all/after/garbage')
+
+    def test_rejects_cursor_for_other_sort(self):
+        result = self._get(u'/search/sort/foo/show_all/limit/1')
+        with self.assertRaises(qvarn.BadSearchCursor):
+            self._get(
+                u'/search/sort/foo/sort/bar/show_all/after/' + result[u'next'])
+
+
+class ConditionalGetTests(ListResourceBase):
+
+    subitem_prototype = {
+        u'secret': u'',
+    }
+
+    def setUp(self):
+        super(ConditionalGetTests, self).setUp()
+        with self._dbconn.transaction() as t:
+            qvarn.create_tables_for_resource_type(
+                t, self.resource_type,
+                [(self.subitem_prototype, {u'subpath': u'sub'})])
+        self.resource.set_subitem_prototype(u'sub', self.subitem_prototype)
+        self.wo.set_subitem_prototype(
+            self.resource_type, u'sub', self.subitem_prototype)
+        with self._dbconn.transaction() as t:
+            self.item = self.wo.add_item(t, {
+                u'type': u'yo',
+                u'foo': u'',
+                u'bar': u'',
+                u'lst': [],
+            })
+        bottle.response = bottle.LocalResponse()
+
+    def _get(self, method, *args, **kwargs):
+        if_none_match = kwargs.get('if_none_match')
+        if if_none_match is not None:
+            bottle.request.environ['HTTP_IF_NONE_MATCH'] = if_none_match
+        return method(*args)
+
+    def test_get_item_sets_etag(self):
+        item = self._get(self.resource.get_item, self.item[u'id'])
+        self.assertEqual(item, self.item)
+        self.assertEqual(bottle.response.status_code, 200)
+        self.assertEqual(
+            bottle.response.headers['ETag'],
+            u'"{}"'.format(self.item[u'revision']))
+
+    def test_get_item_returns_not_modified(self):
+        etag = u'"{}"'.format(self.item[u'revision'])
+        body = self._get(
+            self.resource.get_item, self.item[u'id'], if_none_match=etag)
+        self.assertEqual(body, u'')
+        self.assertEqual(bottle.response.status_code, 304)
+
+    def test_get_item_returns_item_if_revision_changed(self):
+        item = self._get(
+            self.resource.get_item, self.item[u'id'], if_none_match=u'"old"')
+        self.assertEqual(item, self.item)
+        self.assertEqual(bottle.response.status_code, 200)
+
+    def test_get_subitem_returns_revision(self):
+        subitem = self._get(
+            self.resource.get_subitem, self.item[u'id'], u'sub')
+        self.assertEqual(
+            subitem,
+            {u'secret': u'', u'revision': self.item[u'revision']})
+        self.assertEqual(
+            bottle.response.headers['ETag'],
+            u'"{}"'.format(self.item[u'revision']))
+
+    def test_get_subitem_returns_not_modified(self):
+        etag = u'"{}"'.format(self.item[u'revision'])
+        body = self._get(
+            self.resource.get_subitem, self.item[u'id'], u'sub',
+            if_none_match=etag)
+        self.assertEqual(body, u'')
+        self.assertEqual(bottle.response.status_code, 304)
+
+
+class StreamingTests(ListResourceBase):
+
+    def setUp(self):
+        super(StreamingTests, self).setUp()
+        self.resource.set_streaming(True)
+        self._add_item(foo=u'b')
+        self._add_item(foo=u'a')
+        self._add_item(foo=u'c')
+
+    def _body(self, stream):
+        return json.loads(u''.join(stream))
+
+    def test_streams_all_items(self):
+        body = self._body(self.resource.get_items())
+        with self._dbconn.transaction() as t:
+            ids = self.ro.get_item_ids(t)
+        self.assertEqual(
+            sorted(r[u'id'] for r in body[u'resources']), sorted(ids))
+
+    def test_streams_search_results(self):
+        bottle.request.environ['REQUEST_URI'] = u'/search/sort/foo/show_all'
+        body = self._body(self.resource.get_matching_items(u''))
+        self.assertEqual(
+            [r[u'foo'] for r in body[u'resources']], [u'a', u'b', u'c'])
+
+    def test_streams_same_search_result_as_without_streaming(self):
+        url = u'/search/sort/foo/show/foo'
+        bottle.request.environ['REQUEST_URI'] = url
+        streamed = self._body(self.resource.get_matching_items(u''))
+        self.resource.set_streaming(False)
+        self.assertEqual(streamed, self.resource.get_matching_items(u''))
+
+    def test_raises_search_errors_before_streaming(self):
+        bottle.request.environ['REQUEST_URI'] = u'/search/exact/nope/x'
+        with self.assertRaises(qvarn.FieldNotInResource):
+            self.resource.get_matching_items(u'')
+
+
+class BulkTests(ListResourceBase):
+
+    def setUp(self):
+        super(BulkTests, self).setUp()
+        self.listener = RecordingListenerResource()
+        self.resource.set_listener(self.listener)
+
+    def _post(self, body, content_type='application/json'):
+        body = body.encode('UTF-8')
+        bottle.request.environ['CONTENT_TYPE'] = content_type
+        bottle.request.environ['CONTENT_LENGTH'] = len(body)
+        bottle.request.environ['wsgi.input'] = io.BytesIO(body)
+        return self.resource.post_items_bulk()
+
+    def _get_foos(self):
+        with self._dbconn.transaction() as t:
+            return sorted(
+                self.ro.get_item(t, x)[u'foo']
+                for x in self.ro.get_item_ids(t))
+
+    def test_adds_items_from_json_list(self):
+        body = self._post(json.dumps([
+            {u'foo': u'a', u'lst': [u'x', u'y']},
+            {u'foo': u'b'},
+        ]))
+        results = body[u'resources']
+        self.assertEqual(len(results), 2)
+        with self._dbconn.transaction() as t:
+            for result in results:
+                item = self.ro.get_item(t, result[u'id'])
+                self.assertEqual(item[u'revision'], result[u'revision'])
+        self.assertEqual(self._get_foos(), [u'a', u'b'])
+        self.assertEqual(
+            self.listener.created,
+            [[(x[u'id'], x[u'revision']) for x in results]])
+
+    def test_adds_items_from_ndjson(self):
+        body = self._post(
+            u'{"foo": "a"}\n\n{"foo": "b"}\n', 'application/x-ndjson')
+        self.assertEqual(len(body[u'resources']), 2)
+        self.assertEqual(self._get_foos(), [u'a', u'b'])
+
+    def test_reports_errors_per_item(self):
+        body = self._post(json.dumps([
+            {u'foo': u'a'},
+            {u'foo': u'b', u'id': u'123'},
+            {u'foo': 42},
+            u'not an item',
+            {u'foo': u'c'},
+        ]))
+        results = body[u'resources']
+        self.assertIn(u'id', results[0])
+        self.assertEqual(
+            results[1][u'error'][u'error_code'], u'NewItemHasIdAlready')
+        self.assertEqual(
+            results[2][u'error'][u'error_code'], u'WrongTypeValue')
+        self.assertEqual(
+            results[3][u'error'][u'error_code'], u'ItemMustBeDict')
+        self.assertIn(u'id', results[4])
+        self.assertEqual(self._get_foos(), [u'a', u'c'])
+
+    def test_adds_items_in_chunks(self):
+        self.resource.set_bulk_chunk_size(2)
+        body = self._post(json.dumps([{u'foo': x} for x in u'abcde']))
+        ids = [x[u'id'] for x in body[u'resources']]
+        self.assertEqual(
+            [[x for x, _ in chunk] for chunk in self.listener.created],
+            [ids[0:2], ids[2:4], ids[4:5]])
+        self.assertEqual(self._get_foos(), list(u'abcde'))
+
+    def test_rejects_body_that_is_not_a_list(self):
+        with self.assertRaises(BulkBodyIsNotList):
+            self._post(json.dumps({u'foo': u'a'}))
+
+    def test_rejects_invalid_json(self):
+        with self.assertRaises(qvarn.ContentIsNotJSON):
+            self._post(u'[{"foo": ')
+
+    def test_rejects_other_content_types(self):
+        with self.assertRaises(BulkContentTypeNotSupported):
+            self._post(u'[]', 'text/plain')
+
+
+class ChangeBySearchTests(ListResourceBase):
+
+    def setUp(self):
+        super(ChangeBySearchTests, self).setUp()
+        self.listener = RecordingListenerResource()
+        self.resource.set_listener(self.listener)
+        self._add_item(foo=u'a', bar=u'old', lst=[u'x'])
+        self._add_item(foo=u'b', bar=u'old', lst=[u'x', u'y'])
+        self._add_item(foo=u'c', bar=u'new')
+
+    def _delete(self, url):
+        bottle.request.environ['REQUEST_URI'] = url
+        return self.resource.delete_matching_items(url)
+
+    def _put(self, url, fields):
+        bottle.request.environ['REQUEST_URI'] = url
+        bottle.request.qvarn_json = fields
+        return self.resource.put_matching_items(url)
+
+    def _get_items(self):
+        with self._dbconn.transaction() as t:
+            return sorted(
+                (self.ro.get_item(t, x) for x in self.ro.get_item_ids(t)),
+                key=lambda item: item[u'foo'])
+
+    def test_deletes_matching_items(self):
+        result = self._delete(u'/search/exact/bar/old/exact/lst/x')
+        self.assertEqual(
+            [item[u'foo'] for item in self._get_items()], [u'c'])
+        self.assertEqual(len(result[u'resources']), 2)
+        self.assertEqual(
+            self.listener.deleted,
+            [[x[u'id'] for x in result[u'resources']]])
+        with self._dbconn.transaction() as t:
+            rows = t.select(u'yo_lst', [u'id'], None)
+        self.assertEqual(rows, [])
+
+    def test_deletes_nothing_when_nothing_matches(self):
+        result = self._delete(u'/search/exact/bar/nope')
+        self.assertEqual(result, {u'resources': []})
+        self.assertEqual(len(self._get_items()), 3)
+
+    def test_updates_fields_of_matching_items(self):
+        before = self._get_items()
+        result = self._put(u'/search/exact/bar/old', {u'bar': u'newer'})
+        after = self._get_items()
+        self.assertEqual(
+            [item[u'bar'] for item in after], [u'newer', u'newer', u'new'])
+        self.assertEqual(
+            [item[u'lst'] for item in after], [[u'x'], [u'x', u'y'], []])
+        self.assertNotEqual(after[0][u'revision'], before[0][u'revision'])
+        self.assertEqual(after[2][u'revision'], before[2][u'revision'])
+        self.assertEqual(
+            sorted(self.listener.updated[0]),
+            sorted((x[u'id'], x[u'revision']) for x in after[:2]))
+        self.assertEqual(len(result[u'resources']), 2)
+
+    def test_refuses_too_many_matches(self):
+        self.resource.set_max_change_by_search(1)
+        with self.assertRaises(TooManyItemsToChange):
+            self._delete(u'/search/exact/bar/old')
+        with self.assertRaises(TooManyItemsToChange):
+            self._put(u'/search/exact/bar/old', {u'bar': u'newer'})
+        self.assertEqual(
+            [item[u'bar'] for item in self._get_items()],
+            [u'old', u'old', u'new'])
+        self.assertEqual(self.listener.deleted, [])
+
+    def test_refuses_search_with_other_than_conditions(self):
+        with self.assertRaises(BadChangeBySearchCondition):
+            self._delete(u'/search/exact/bar/old/show_all')
+        with self.assertRaises(BadChangeBySearchCondition):
+            self._put(u'/search/exact/bar/old/sort/foo', {u'bar': u'x'})
+        with self.assertRaises(BadChangeBySearchCondition):
+            self._delete(u'/search/show_all')
+
+    def test_refuses_to_change_lists_and_special_fields(self):
+        for field, value in [(u'lst', []), (u'id', u'x'), (u'type', u'x')]:
+            with self.assertRaises(FieldCannotBeChangedBySearch):
+                self._put(u'/search/exact/bar/old', {field: value})
+
+    def test_refuses_invalid_field_values(self):
+        with self.assertRaises(WrongTypeValue):
+            self._put(u'/search/exact/bar/old', {u'bar': 42})
+        with self.assertRaises(UnknownKeys):
+            self._put(u'/search/exact/bar/old', {u'nope': u'x'})
+
+    def test_refuses_to_change_items_with_validator(self):
+        self.resource.set_item_validator(lambda item: None)
+        with self.assertRaises(ChangeBySearchNotAllowed):
+            self._put(u'/search/exact/bar/old', {u'bar': u'x'})
+
+
 class FakeListenerResource(object):
 
     def notify_create(self, item_id, item_revision):
         pass
 
+    def notify_create_many(self, items):
+        pass
+
     def notify_update(self, item_id, item_revision):
         pass
 
+    def notify_update_many(self, items):
+        pass
+
     def notify_delete(self, item_id):
         pass
+
+    def notify_delete_many(self, item_ids):
+        pass
+
+
+class RecordingListenerResource(FakeListenerResource):
+
+    def __init__(self):
+        self.created = []
+        self.updated = []
+        self.deleted = []
+
+    def notify_create_many(self, items):
+        self.created.append(items)
+
+    def notify_update_many(self, items):
+        self.updated.append(items)
+
+    def notify_delete_many(self, item_ids):
+        self.deleted.append(item_ids)
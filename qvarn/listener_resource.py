@@ -64,6 +64,22 @@ notification_prototype = {
 }
 
 
+# Listeners and notifications are looked up by resource and listener
+# ids. Those are generated by Qvarn, in lower case, so they can be
+# compared as they are, using plain indexes.
+
+listener_search = {
+    u'indexed': [u'listen_on'],
+    u'case_sensitive': [u'listen_on'],
+}
+
+
+notification_search = {
+    u'indexed': [u'listener_id'],
+    u'case_sensitive': [u'listener_id', u'resource_id'],
+}
+
+
 class ListenerResource(object):
 
     '''A listener (+ notification) resource in the HTTP API.
@@ -84,6 +100,11 @@ class ListenerResource(object):
 
     ``notify_delete`` with argument item id only
 
+    ``notify_create_many``, ``notify_update_many``, and
+    ``notify_delete_many`` do the same for many items at once, with a
+    list of (item id, item revision) pairs, or of item ids for
+    deletions
+
     '''
 
     def __init__(self):
@@ -197,7 +218,8 @@ class ListenerResource(object):
         with self._dbconn.transaction() as t:
             return {
                 'resources': [
-                    {'id': resource_id} for resource_id in ro.get_item_ids(t)
+                    {'id': resource_id}
+                    for resource_id in ro.iter_item_ids(t)
                 ],
             }
 
@@ -320,6 +342,20 @@ class ListenerResource(object):
         enabled.
         '''
 
+        self.notify_create_many([(item_id, item_revision)])
+
+    def notify_create_many(self, items):
+        '''Adds created notifications for many items.
+
+        ``items`` is a list of (item id, item revision) pairs. The
+        notifications are all added in one transaction, and the
+        listeners are only looked up once.
+
+        '''
+
+        if not items:
+            return
+
         with self._dbconn.transaction() as t:
             ro = self._create_resource_ro_storage(
                 self._listener_table, listener_prototype)
@@ -329,16 +365,18 @@ class ListenerResource(object):
 
             wo = self._create_resource_wo_storage(
                 self._notification_table, notification_prototype)
+            notifications = []
             for listener in listener_resources[u'resources']:
-                notification = {
-                    u'type': u'notification',
-                    u'listener_id': listener[u'id'],
-                    u'resource_id': item_id,
-                    u'resource_revision': item_revision,
-                    u'resource_change': u'created',
-                    u'last_modified': int(time.time() * 1000000)
-                }
-                wo.add_item(t, notification)
+                for item_id, item_revision in items:
+                    notifications.append({
+                        u'type': u'notification',
+                        u'listener_id': listener[u'id'],
+                        u'resource_id': item_id,
+                        u'resource_revision': item_revision,
+                        u'resource_change': u'created',
+                        u'last_modified': int(time.time() * 1000000)
+                    })
+            wo.add_items(t, notifications)
 
     def notify_update(self, item_id, item_revision):
         '''Adds an updated notification.
@@ -347,30 +385,17 @@ class ListenerResource(object):
         the updated item id.
         '''
 
-        with self._dbconn.transaction() as t:
-            ro = self._create_resource_ro_storage(
-                self._listener_table, listener_prototype)
-            listener_resources = ro.search(t, [
-                qvarn.create_search_param(u'exact', u'listen_on', item_id),
-            ], [])
-            wildcard_listener_resources = ro.search(t, [
-                qvarn.create_search_param(u'exact', u'listen_on_all', True),
-            ], [])
-            listeners = listener_resources[u'resources']
-            listeners.extend(wildcard_listener_resources[u'resources'])
+        self.notify_update_many([(item_id, item_revision)])
 
-            wo = self._create_resource_wo_storage(
-                self._notification_table, notification_prototype)
-            for listener in listeners:
-                notification = {
-                    u'type': u'notification',
-                    u'listener_id': listener[u'id'],
-                    u'resource_id': item_id,
-                    u'resource_revision': item_revision,
-                    u'resource_change': u'updated',
-                    u'last_modified': int(time.time() * 1000000)
-                }
-                wo.add_item(t, notification)
+    def notify_update_many(self, items):
+        '''Adds updated notifications for many items.
+
+        ``items`` is a list of (item id, item revision) pairs. The
+        notifications are all added in one transaction.
+
+        '''
+
+        self._notify_changes(items, u'updated')
 
     def notify_delete(self, item_id):
         '''Adds an deleted notification.
@@ -379,34 +404,72 @@ class ListenerResource(object):
         the updated item id.
         '''
 
+        self.notify_delete_many([item_id])
+
+    def notify_delete_many(self, item_ids):
+        '''Adds deleted notifications for many items.
+
+        The notifications are all added in one transaction.
+
+        '''
+
+        self._notify_changes(
+            [(item_id, None) for item_id in item_ids], u'deleted')
+
+    def _notify_changes(self, items, change):
+        # Add notifications of changes to existing items, for the
+        # listeners that listen on each item, and all the listeners
+        # that listen on all items.
+        if not items:
+            return
+
         with self._dbconn.transaction() as t:
             ro = self._create_resource_ro_storage(
                 self._listener_table, listener_prototype)
             listener_resources = ro.search(t, [
-                qvarn.create_search_param(u'exact', u'listen_on', item_id),
-            ], [])
+                qvarn.create_search_param(
+                    u'exact', u'listen_on',
+                    [item_id for item_id, _ in items], any=True),
+            ], [(u'show', u'listen_on')])
             wildcard_listener_resources = ro.search(t, [
                 qvarn.create_search_param(u'exact', u'listen_on_all', True),
             ], [])
-            listeners = listener_resources[u'resources']
-            listeners.extend(wildcard_listener_resources[u'resources'])
+
+            listeners_by_item = {}
+            for listener in listener_resources[u'resources']:
+                for item_id in listener[u'listen_on']:
+                    listeners_by_item.setdefault(item_id, []).append(
+                        listener[u'id'])
+            wildcard_listeners = [
+                listener[u'id']
+                for listener in wildcard_listener_resources[u'resources']
+            ]
 
             wo = self._create_resource_wo_storage(
                 self._notification_table, notification_prototype)
-            for listener in listeners:
-                notification = {
-                    u'type': u'notification',
-                    u'listener_id': listener[u'id'],
-                    u'resource_id': item_id,
-                    u'resource_revision': None,
-                    u'resource_change': u'deleted',
-                    u'last_modified': int(time.time() * 1000000)
-                }
-                wo.add_item(t, notification)
+            notifications = []
+            for item_id, item_revision in items:
+                listener_ids = (
+                    listeners_by_item.get(item_id, []) + wildcard_listeners)
+                for listener_id in listener_ids:
+                    notifications.append({
+                        u'type': u'notification',
+                        u'listener_id': listener_id,
+                        u'resource_id': item_id,
+                        u'resource_revision': item_revision,
+                        u'resource_change': change,
+                        u'last_modified': int(time.time() * 1000000)
+                    })
+            wo.add_items(t, notifications)
 
     def _create_resource_ro_storage(self, resource_name, prototype):
+        search_specs = {
+            self._listener_table: listener_search,
+            self._notification_table: notification_search,
+        }
         ro = qvarn.ReadOnlyStorage()
         ro.set_item_prototype(resource_name, prototype)
+        ro.set_search_spec(search_specs.get(resource_name))
         return ro
 
     def _create_resource_wo_storage(self, resource_name, prototype):
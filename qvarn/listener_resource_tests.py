@@ -101,3 +101,69 @@ class ListenerResourceTests(ListenerResourceBase):
         notification = self.listener.get_notification(
             notifications[u'resources'][0][u'id'])
         self.assertEqual(notification[u'resource_id'], added[u'id'])
+
+    def test_notifies_of_many_created_items(self):
+        bottle.request.url = ''
+        bottle.request.qvarn_json = {
+            u'notify_of_new': True,
+        }
+        listener = self.listener.post_listener()
+
+        with self._dbconn.transaction() as t:
+            added = self.wo.add_items(t, [
+                {u'type': u'yo', u'value': u'1'},
+                {u'type': u'yo', u'value': u'2'},
+            ])
+        self.listener.notify_create_many(
+            [(x[u'id'], x[u'revision']) for x in added])
+
+        notifications = self.listener.get_notifications(listener[u'id'])
+        resource_ids = [
+            self.listener.get_notification(x[u'id'])[u'resource_id']
+            for x in notifications[u'resources']
+        ]
+        self.assertEqual(
+            sorted(resource_ids), sorted(x[u'id'] for x in added))
+
+    def test_notifies_of_many_changed_items(self):
+        with self._dbconn.transaction() as t:
+            added = self.wo.add_items(t, [
+                {u'type': u'yo', u'value': u'1'},
+                {u'type': u'yo', u'value': u'2'},
+                {u'type': u'yo', u'value': u'3'},
+            ])
+
+        bottle.request.url = ''
+        bottle.request.qvarn_json = {
+            u'listen_on': [added[0][u'id'], added[1][u'id']],
+        }
+        listener = self.listener.post_listener()
+        bottle.request.qvarn_json = {
+            u'listen_on_all': True,
+        }
+        wildcard_listener = self.listener.post_listener()
+
+        self.listener.notify_update_many(
+            [(x[u'id'], x[u'revision']) for x in added[1:]])
+        self.listener.notify_delete_many([x[u'id'] for x in added])
+
+        def get_changes(listener_id):
+            notifications = self.listener.get_notifications(listener_id)
+            return sorted(
+                (n[u'resource_id'], n[u'resource_change'])
+                for n in (
+                    self.listener.get_notification(x[u'id'])
+                    for x in notifications[u'resources']))
+
+        self.assertEqual(
+            get_changes(listener[u'id']),
+            sorted([
+                (added[0][u'id'], u'deleted'),
+                (added[1][u'id'], u'updated'),
+                (added[1][u'id'], u'deleted'),
+            ]))
+        self.assertEqual(
+            get_changes(wildcard_listener[u'id']),
+            sorted(
+                [(x[u'id'], u'updated') for x in added[1:]] +
+                [(x[u'id'], u'deleted') for x in added]))
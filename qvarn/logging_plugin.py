@@ -115,6 +115,26 @@ class LoggingPlugin(object):
     def _log_access(self, data):
         if self._access_log_enabled and bottle.response.status_code in (200,
                                                                         201):
-            self._access_logger.log_access(bottle.request,
-                                           bottle.response,
-                                           data)
+            if isinstance(data, qvarn.ResourceStream):
+                self._log_streamed_access(data)
+            else:
+                self._access_logger.log_access(bottle.request,
+                                               bottle.response,
+                                               data)
+
+    def _log_streamed_access(self, stream):
+        # The resources are only produced after the callback has
+        # returned, so log their ids as they are streamed. Copy the
+        # request and response, since by then bottle may be serving
+        # another request.
+        request = bottle.request.copy()
+        response = bottle.response.copy()
+
+        def log_ids(ids):
+            data = {
+                'resources': [{'id': resource_id} for resource_id in ids],
+            }
+            self._access_logger.log_access(request, response, data)
+
+        stream.add_ids_listener(
+            log_ids, self._access_logger.entry_chunk_size)
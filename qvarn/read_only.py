@@ -16,9 +16,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import time
-import uuid
+import base64
 import collections
+import itertools
+import json
+import time
 
 import six
 
@@ -57,47 +59,200 @@ class ReadOnlyStorage(object):
 
     '''
 
+    # How many items get_items fetches with one query per table. This
+    # keeps the number of bound values per statement within what
+    # SQLite accepts.
+    items_per_batch = 500
+
     def __init__(self):
         self._item_type = None
         self._prototype = None
+        self._plan = None
+        self._binary_fields = False
         self._subitem_prototypes = qvarn.SubItemPrototypes()
+        self._item_cache = None
+        self._documents = False
+        self._case_sensitive_fields = qvarn.get_case_sensitive_fields(None)
         self._m = None
 
     def set_item_prototype(self, item_type, prototype):
         '''Set type and prototype of items in this database.'''
         self._item_type = item_type
         self._prototype = prototype
+        self._plan = qvarn.get_item_plan(prototype, resource_type=item_type)
+        self._binary_fields = has_binary_fields(prototype)
 
     def set_subitem_prototype(self, item_type, subitem_name, prototype):
         '''Set prototype for a subitem.'''
         self._subitem_prototypes.add(item_type, subitem_name, prototype)
 
+    def set_item_cache(self, item_cache):
+        '''Set a qvarn.ItemCache for get_item to use.'''
+        self._item_cache = item_cache
+
+    def set_document_storage(self, enabled):
+        '''Read items from their documents, if they have one.
+
+        See qvarn.document. An item whose document is missing, or is
+        of an older revision than the item, is read from the tables
+        for its fields instead.
+
+        '''
+
+        self._documents = enabled
+
+    def set_search_spec(self, search_spec):
+        '''Set the ``search`` part of the resource type spec.
+
+        Text fields are compared in lower case in searches, unless
+        the spec lists them as case sensitive.
+
+        '''
+
+        self._case_sensitive_fields = qvarn.get_case_sensitive_fields(
+            search_spec)
+
     def get_item_ids(self, transaction):
         '''Get list of ids of all items.'''
-        return [
-            row['id']
-            for row in transaction.select(self._item_type, [u'id'], None)]
+        return list(self.iter_item_ids(transaction))
+
+    def iter_item_ids(self, transaction):
+        '''Iterate over the ids of all items.
+
+        Unlike ``get_item_ids``, this does not keep all the ids in
+        memory at once.
+
+        '''
+
+        rows = transaction.select_iter(self._item_type, [u'id'], None)
+        for row in rows:
+            yield row[u'id']
+
+    def get_item_revision(self, transaction, item_id):
+        '''Get the current revision of an item.
+
+        This only reads one column of the main table, so it is much
+        cheaper than getting the whole item.
+
+        '''
+
+        table_name = qvarn.table_name(resource_type=self._item_type)
+        match = ('=', table_name, u'id', item_id)
+        rows = transaction.select(
+            table_name, [u'revision'], match, table_plan=self._plan.main)
+        for row in rows:
+            return row[u'revision']
+        raise ItemDoesNotExist(item_id=item_id)
 
     def get_item(self, transaction, item_id, main_fields=None):
         '''Get a specific item.'''
+        if self._item_cache is not None and main_fields is None:
+            return self._get_cached_item(transaction, item_id)
+        return self._read_item(transaction, item_id, main_fields)
+
+    def _get_cached_item(self, transaction, item_id):
+        revision = self.get_item_revision(transaction, item_id)
+        item = self._item_cache.get(self._item_type, item_id, revision)
+        if item is None:
+            item = self._read_item(transaction, item_id)
+            self._item_cache.put(self._item_type, item)
+        return item
+
+    def _read_item(self, transaction, item_id, main_fields=None):
+        if self._documents and main_fields is None:
+            documents = self._read_documents(
+                transaction, ('=', self._plan.main.name, u'id', item_id))
+            if item_id in documents:
+                return documents[item_id]
+        if self._can_read_json_items(transaction, main_fields):
+            items = self._read_json_items(transaction, [item_id])
+            if item_id in items:
+                return items[item_id]
         item = {}
         rw = ReadWalker(
-            transaction, self._item_type, item_id, main_fields=main_fields)
+            transaction, self._item_type, item_id, main_fields=main_fields,
+            plan=self._plan)
         rw.walk_item(item, self._prototype)
         return item
 
+    def get_items(self, transaction, item_ids, main_fields=None):
+        '''Get many items at once.
+
+        Each table is queried once per batch of ids, rather than once
+        per item. Items are returned in the same order as
+        ``item_ids``. Ids that do not match an item are skipped.
+
+        '''
+
+        items = {}
+        for i in range(0, len(item_ids), self.items_per_batch):
+            batch = item_ids[i:i + self.items_per_batch]
+            if self._documents and main_fields is None:
+                items.update(self._read_documents(
+                    transaction, ('IN', self._plan.main.name, u'id', batch)))
+                batch = [x for x in batch if x not in items]
+                if not batch:
+                    continue
+            if self._can_read_json_items(transaction, main_fields):
+                items.update(self._read_json_items(transaction, batch))
+                continue
+            rw = BatchReadWalker(
+                transaction, self._item_type, batch, main_fields=main_fields,
+                plan=self._plan)
+            rw.walk_item(self._prototype, self._prototype)
+            items.update(rw.items)
+        return [items[x] for x in item_ids if x in items]
+
+    def _can_read_json_items(self, transaction, main_fields):
+        # JSON has no binary values, so items with binary fields are
+        # read by walking the tables.
+        sql = getattr(transaction, '_sql')
+        return (
+            sql.json_items and
+            main_fields is None and
+            not self._binary_fields
+        )
+
+    def _read_json_items(self, transaction, item_ids):
+        # Have the database put together the whole items, with one
+        # query, and return them in a dict keyed by item id.
+        sql = getattr(transaction, '_sql')
+        query = self._plan.main.get_statement(
+            sql, ('ITEM JSON',),
+            lambda: sql.format_item_json_select(self._plan))
+        cursor = transaction.execute(
+            'SELECT', query, {u'ids': list(item_ids)}, prepared=True)
+        return dict(
+            (item_id, qvarn.decode_document(item))
+            for item_id, item in cursor.fetchall())
+
+    def _read_documents(self, transaction, match):
+        # Return the up to date documents of matching items, in a dict
+        # keyed by item id.
+        column_names = [u'id', u'revision', qvarn.DOCUMENT_COLUMN]
+        rows = transaction.select(
+            self._plan.main.name, column_names, match,
+            table_plan=self._plan.main)
+        documents = {}
+        for row in rows:
+            item = qvarn.decode_document(row[qvarn.DOCUMENT_COLUMN])
+            if item is not None and item.get(u'revision') == row[u'revision']:
+                documents[row[u'id']] = item
+        return documents
+
     def get_subitem(self, transaction, item_id, subitem_name):
         '''Get a specific subitem.'''
         subitem = {}
         table_name = qvarn.table_name(
             resource_type=self._item_type, subpath=subitem_name)
         prototype = self._subitem_prototypes.get(self._item_type, subitem_name)
-        rw = ReadWalker(transaction, table_name, item_id)
+        plan = qvarn.get_item_plan(prototype, resource_type=table_name)
+        rw = ReadWalker(transaction, table_name, item_id, plan=plan)
         rw.walk_item(subitem, prototype)
         return subitem
 
     def search(self, transaction, search_params, show_params, sort_params=None,
-               limit=None, offset=None):
+               limit=None, offset=None, after=None):
         '''Do a search.
 
         ``search_params`` is a list of qvarn.list_resource.SearchParam
@@ -113,88 +268,199 @@ class ReadOnlyStorage(object):
         ``limit`` is applied after applying ``offset``.
         ``offset`` positive integer, if given, skips given number
         of rows before returning result.
+        ``after`` is a cursor string from the ``next`` field of an
+        earlier search result. If given, only rows that come after
+        the row the cursor was made from, in sort order, are
+        returned. Unlike ``offset``, this does not make the database
+        go through all the skipped rows.
+
+        If ``limit`` is given, and the search returns that many rows,
+        the result has a ``next`` field with a cursor for getting the
+        next page of results.
 
         '''
 
         self._m = Measurement()
         with self._m.new('build_schema'):
             schema = self._build_schema()
-        ids = self._kludge(transaction, schema, search_params, sort_params,
-                           limit=limit, offset=offset)
+        sql, query, values = self._kludge(
+            transaction, schema, search_params, sort_params,
+            limit=limit, offset=offset, after=after)
+        rows = self._kludge_execute(sql, query, values)
         with self._m.new('build_search_result'):
-            result = self._build_search_result(transaction, ids, show_params)
+            result = {
+                u'resources': list(self._iter_search_result(
+                    transaction, (row[0] for row in rows), show_params)),
+            }
+            if limit is not None and rows and len(rows) == limit:
+                result[u'next'] = encode_search_cursor(rows[-1])
         self._m.finish()
         self._m.log(None)
         self._m = None
         return result
 
+    def search_iter(self, transaction, search_params, show_params,
+                    sort_params=None, limit=None, offset=None, after=None):
+        '''Do a search, and iterate over the matching resources.
+
+        The arguments are the same as for ``search``. The search
+        query is executed before this method returns, so that errors
+        in the search parameters are raised right away. The matching
+        ids are then fetched from the database cursor, and resources
+        read, in batches of ``items_per_batch``, as the caller
+        iterates.
+
+        The returned iterable has a ``next_cursor`` attribute, which
+        is set like the ``next`` field of ``search`` once iteration
+        is finished.
+
+        '''
+
+        self._m = Measurement()
+        with self._m.new('build_schema'):
+            schema = self._build_schema()
+        sql, query, values = self._kludge(
+            transaction, schema, search_params, sort_params,
+            limit=limit, offset=offset, after=after)
+        rows = self._kludge_execute_iter(sql, query, values)
+        # Start the generator, to execute the query.
+        first_row = next(rows, None)
+        self._m.finish()
+        self._m.log(None)
+        self._m = None
+        if first_row is not None:
+            rows = itertools.chain([first_row], rows)
+        return SearchResults(self, transaction, rows, show_params, limit)
+
+    def count(self, transaction, search_params, approximate=False):
+        '''Count the items matching a search.
+
+        ``search_params`` is as for ``search``. Only the number of
+        matching items is computed; no ids or items are fetched.
+
+        If ``approximate`` is true and there are no search
+        parameters, the count is the database's own estimate of the
+        number of items, which doesn't require going through them.
+        If the database has no estimate, the items are counted.
+
+        '''
+
+        if approximate and not search_params:
+            main_table = qvarn.table_name(resource_type=self._item_type)
+            estimate = transaction.get_approximate_row_count(main_table)
+            if estimate is not None:
+                return estimate
+
+        self._m = Measurement()
+        with self._m.new('build_schema'):
+            schema = self._build_schema()
+        sql, query, values = self._kludge(
+            transaction, schema, search_params, count=True)
+        rows = self._kludge_execute(sql, query, values)
+        self._m.finish()
+        self._m.log(None)
+        self._m = None
+        return rows[0][0]
+
+    def get_matching_ids(self, transaction, search_params, limit=None):
+        '''Return the ids of the items matching a search.
+
+        ``search_params`` is as for ``search``. Unlike the other
+        search methods, the query is executed in ``transaction``, so
+        that the items can be changed in the same transaction. If
+        ``limit`` is given, at most that many ids are returned.
+
+        '''
+
+        self._m = Measurement()
+        with self._m.new('build_schema'):
+            schema = self._build_schema()
+        _, query, values = self._kludge(
+            transaction, schema, search_params, limit=limit)
+        cursor = transaction.execute('SELECT', query, values)
+        ids = [row[0] for row in cursor]
+        self._m.finish()
+        self._m.log(None)
+        self._m = None
+        return ids
+
     def _build_schema(self):
-        schema = qvarn.schema_from_prototype(
-            self._prototype, resource_type=self._item_type)
-        for subpath, subproto in self._subitem_prototypes.get_all():
-            schema += qvarn.schema_from_prototype(
-                subproto, resource_type=self._item_type, subpath=subpath)
-        return schema
+        return get_search_schema(
+            self._item_type, self._prototype,
+            self._subitem_prototypes.get_all())
 
     def _kludge(self, transaction, schema, search_params, sort_params=None,
-                limit=None, offset=None):
+                limit=None, offset=None, after=None, count=False):
         sql = getattr(transaction, '_sql')
-        main_table = qvarn.table_name(resource_type=self._item_type)
-        tables_used = [main_table]
+        joins = SearchJoins(schema)
 
         with self._m.new('build param conditions'):
             values = {}
             conds = [
-                self._kludge_conds(
-                    sql, schema, param, values, main_table, tables_used)
+                self._kludge_conds(sql, schema, param, values, joins)
                 for param in search_params]
 
         with self._m.new('build order by fields'):
-            join_conditions = {}
             sort_params = sort_params or []
             order_by_fields = [
-                self._kludge_order_by_fields(sql, schema, param, main_table,
-                                             tables_used, join_conditions)
+                self._kludge_order_by_fields(sql, schema, param, joins)
                 for param in sort_params]
+            # Paging with a cursor needs a total order, so we order
+            # by id last. We don't need to select it again.
+            order_by_keys = list(order_by_fields)
+            if limit is not None or after is not None:
+                order_by_keys.append(SortParam(u't0.id', ascending=True))
+
+        if after is not None:
+            with self._m.new('build cursor condition'):
+                conds.append(self._kludge_after_cond(
+                    sql, order_by_keys, decode_search_cursor(after), values))
 
         with self._m.new('build full sql query'):
             main_table_alias = u't0'
-            # With `SELECT DISTINCT` PostgreSQL requires all ORDER BY fields to
-            # be included in select list too.
-            select_list = (
-                [main_table_alias + u'.id'] +
-                [f.key for f in order_by_fields]
-            )
+            # Conditions on lists are subqueries, and only the first
+            # item of a list is joined for sorting, so usually each
+            # item is on one row, and DISTINCT isn't needed.
+            distinct = joins.multiplies_rows()
+            if count:
+                select_list = u'COUNT({}{}.id)'.format(
+                    u'DISTINCT ' if distinct else u'', main_table_alias)
+            else:
+                # With `SELECT DISTINCT` PostgreSQL requires all ORDER
+                # BY fields to be included in select list too. We need
+                # them for search cursors anyway.
+                select_list = (u'DISTINCT ' if distinct else u'') + u', '.join(
+                    [main_table_alias + u'.id'] +
+                    [f.key for f in order_by_fields])
             query = (
-                u'SELECT DISTINCT {select_list} '
+                u'SELECT {select_list} '
                 u'FROM {main_table} AS {main_table_alias}'
             ).format(
-                select_list=u', '.join(select_list),
-                main_table=sql.quote(main_table),
+                select_list=select_list,
+                main_table=sql.quote(schema.main_table),
                 main_table_alias=main_table_alias,
             )
-            for idx, table_name in enumerate(tables_used):
-                if table_name != main_table:
-                    table_alias = u't' + str(idx)
-                    query += (u' LEFT JOIN {1} AS {2} ON {0}.id = {2}.id'
-                              .format(u't0', sql.quote(table_name),
-                                      sql.quote(table_alias)))
-                    if idx in join_conditions:
-                        query += ' AND ' + join_conditions[idx]
+            for join in joins.get_ordered():
+                query += (u' {0} {2} AS {3} ON {1}.id = {3}.id'
+                          .format(u'JOIN' if join.inner else u'LEFT JOIN',
+                                  main_table_alias, sql.quote(join.table),
+                                  sql.quote(join.alias)))
+                if join.condition:
+                    query += u' AND ' + join.condition
             if conds:
                 query += u' WHERE ' + u' AND '.join(
                     u'({})'.format(c) for c in conds)
-            if order_by_fields:
+            if order_by_keys:
                 query += u' ORDER BY ' + u', '.join([
                     # pylint: disable=no-member
                     sort.key + (u'' if sort.ascending else u' DESC')
-                    for sort in order_by_fields
+                    for sort in order_by_keys
                 ])
             if limit is not None or offset is not None:
                 query += u' ' + sql.format_limit(limit, offset)
             self._m.note(query=query, values=values)
 
-        return self._kludge_execute(sql, query, values)
+        return sql, query, values
 
     def _kludge_execute(self, sql, query, values):
         with self._m.new('get conn'):
@@ -203,10 +469,10 @@ class ReadOnlyStorage(object):
             with self._m.new('get cursor'):
                 c = conn.cursor()
             with self._m.new('execute'):
-                c.execute(query, values)
+                sql.execute_prepared(c, query, values)
             with self._m.new('fetch rows'):
-                ids = [row[0] for row in c]
-                self._m.note(row_count=len(ids))
+                rows = c.fetchall()
+                self._m.note(row_count=len(rows))
         except BaseException:
             with self._m.new('put conn (except)'):
                 sql.put_conn(conn)
@@ -214,10 +480,82 @@ class ReadOnlyStorage(object):
         else:
             with self._m.new('put conn'):
                 sql.put_conn(conn)
-            return ids
+            return rows
 
-    def _kludge_conds(self, sql, schema, param, values,
-                      main_table, tables_used):
+    def _kludge_execute_iter(self, sql, query, values):
+        conn = sql.get_conn()
+        try:
+            c = sql.get_streaming_cursor(conn)
+            try:
+                with self._m.new('execute'):
+                    c.execute(query, values)
+                while True:
+                    rows = c.fetchmany(sql.fetch_batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+            finally:
+                c.close()
+        finally:
+            sql.put_conn(conn)
+
+    def _kludge_after_cond(self, sql, order_by_keys, cursor_values, values):
+        # Rows after the cursor row, in the order given by
+        # order_by_keys. For keys k1, k2, k3 this is
+        #
+        #   k1 after v1
+        #   OR (k1 = v1 AND k2 after v2)
+        #   OR (k1 = v1 AND k2 = v2 AND k3 after v3)
+        #
+        # where "after" is > or < depending on sort direction. Row
+        # value comparison would be neater, but doesn't allow mixed
+        # directions, and NULLs need special care anyway.
+        if len(cursor_values) != len(order_by_keys):
+            raise BadSearchCursor()
+
+        placeholders = []
+        for i, value in enumerate(cursor_values):
+            name = u'after{}'.format(i)
+            placeholders.append(
+                sql.format_qualified_placeholder(u'cursor', name))
+            values[sql.format_qualified_placeholder_name(
+                u'cursor', name)] = value
+
+        alternatives = []
+        for i, sort in enumerate(order_by_keys):
+            parts = [
+                self._kludge_equal_cond(
+                    order_by_keys[j].key, cursor_values[j], placeholders[j])
+                for j in range(i)
+            ]
+            after = self._kludge_after_key_cond(
+                sql, sort, cursor_values[i], placeholders[i])
+            if after is not None:
+                alternatives.append(u' AND '.join(parts + [after]))
+        if not alternatives:
+            return u'1 = 0'
+        return u' OR '.join(u'({})'.format(x) for x in alternatives)
+
+    def _kludge_equal_cond(self, key, value, placeholder):
+        if value is None:
+            return u'{} IS NULL'.format(key)
+        return u'{} = {}'.format(key, placeholder)
+
+    def _kludge_after_key_cond(self, sql, sort, value, placeholder):
+        # Where do NULLs go in this sort direction?
+        nulls_first = sql.nulls_sort_first == sort.ascending
+        if value is None:
+            if nulls_first:
+                return u'{} IS NOT NULL'.format(sort.key)
+            return None
+        op = u'>' if sort.ascending else u'<'
+        cond = u'{} {} {}'.format(sort.key, op, placeholder)
+        if not nulls_first:
+            cond = u'({} OR {} IS NULL)'.format(cond, sort.key)
+        return cond
+
+    def _kludge_conds(self, sql, schema, param, values, joins):
         rule_queries = {
             u'exact': u'{} = {}',
             u'gt': u'{} > {}',
@@ -230,120 +568,435 @@ class ReadOnlyStorage(object):
         }
         assert param.rule in rule_queries.keys()
 
-        conds = []
-        for table_name, column_name, column_type in schema:
-            if column_name == param.key:
-                if table_name == main_table:
-                    table_alias = u't0'
-                else:
-                    table_alias = u't' + str(len(tables_used))
-                    tables_used.append(table_name)
-
-                qualified_name = sql.qualified_column(table_alias, column_name)
-                if column_type == six.text_type:
-                    qualified_name = u'LOWER(' + qualified_name + u')'
-
-                if param.any:
-                    values_list = param.value
-                else:
-                    values_list = [param.value]
+        matches = schema.get_tables(param.key)
+        if not matches:
+            # key did not match column name in any table
+            raise FieldNotInResource(field=param.key)
+        if param.any:
+            values_list = param.value
+        else:
+            values_list = [param.value]
+        if not values_list:
+            # an empty list of values for an any search
+            raise FieldNotInResource(field=param.key)
 
-                for value in values_list:
-                    rand_name = six.text_type(uuid.uuid4())
-                    conds.append(rule_queries[param.rule].format(
+        conds = []
+        aliases = set()
+        for table_name, column_name, column_type in matches:
+            case_sensitive = column_name in self._case_sensitive_fields
+            try:
+                cast_values = [
+                    self._cast_value(
+                        value, column_type, lower=not case_sensitive)
+                    for value in values_list]
+            except ValueError:
+                # The values can't be in this column, so there's no
+                # need to look.
+                continue
+
+            single_row = schema.is_single_row(table_name)
+            if single_row:
+                table_alias = joins.get_alias(table_name)
+            else:
+                # The condition is true if it's true for any item in
+                # the list. A subquery checks that without making the
+                # search result have a row for each matching item.
+                table_alias = joins.new_alias()
+            aliases.add(table_alias)
+
+            qualified_name = sql.qualified_column(table_alias, column_name)
+            if column_type == six.text_type and not case_sensitive:
+                qualified_name = u'LOWER(' + qualified_name + u')'
+
+            table_conds = []
+            if param.any and param.rule == u'exact':
+                # Bind the list as a whole, instead of making a
+                # condition for each value.
+                cond, cond_values = sql.format_search_in(
+                    qualified_name, table_name,
+                    u'search{}'.format(len(values)), cast_values)
+                table_conds.append(cond)
+                values.update(cond_values)
+            else:
+                for value in cast_values:
+                    # Name placeholders by their position, so that the
+                    # same kind of search always gives the same query.
+                    param_name = u'search{}'.format(len(values))
+                    table_conds.append(rule_queries[param.rule].format(
                         qualified_name,
                         sql.format_qualified_placeholder(
-                            table_name, rand_name)))
+                            table_name, param_name)))
                     name = sql.format_qualified_placeholder_name(
-                        table_name, rand_name)
-                    values[name] = self._cast_value(value)
+                        table_name, param_name)
+                    values[name] = value
+
+            if single_row:
+                conds.extend(table_conds)
+            else:
+                conds.append(self._kludge_exists_cond(
+                    sql, table_name, table_alias, table_conds))
         if not conds:
-            # key did not match column name in any table
-            raise FieldNotInResource(field=param.key)
+            raise BadSearchValue(field=param.key)
+
+        # None of the conditions are true for a NULL column, so if
+        # they're all on the same joined table, an item without a row
+        # in that table can't match, and an inner join will do.
+        if len(aliases) == 1:
+            joins.require(aliases.pop())
         return u' OR '.join(conds)
 
-    def _kludge_order_by_fields(self, sql, schema, sort, main_table,
-                                tables_used, join_conditions):
-        columns_by_table_name = collections.defaultdict(list)
-        for table_name, column_name, _ in schema:
-            columns_by_table_name[table_name].append(column_name)
-
-        for table_name, column_name, _ in schema:
-            if column_name == sort.key:
-                if table_name == main_table:
-                    table_alias = u't0'
-                else:
-                    idx = len(tables_used)
-                    table_alias = u't' + str(idx)
-                    tables_used.append(table_name)
-                    join_conds = self._kludge_first_item_join_cond(
-                        sql, table_alias, columns_by_table_name[table_name])
-                    join_conditions[idx] = join_conds
-                qualified_name = sql.qualified_column(table_alias, column_name)
-                return SortParam(qualified_name, ascending=sort.ascending)
-        # key did not match column name in any table
-        raise FieldNotInResource(field=sort.key)
+    def _kludge_exists_cond(self, sql, table_name, table_alias, conds):
+        return (
+            u'EXISTS (SELECT 1 FROM {table} AS {alias} '
+            u'WHERE {alias}.id = t0.id AND ({conds}))'
+        ).format(
+            table=sql.quote(table_name),
+            alias=table_alias,
+            conds=u' OR '.join(conds),
+        )
+
+    def _kludge_order_by_fields(self, sql, schema, sort, joins):
+        matches = schema.get_tables(sort.key)
+        if not matches:
+            # key did not match column name in any table
+            raise FieldNotInResource(field=sort.key)
+
+        table_name, column_name, _ = matches[0]
+        if schema.is_single_row(table_name):
+            table_alias = joins.get_alias(table_name)
+        else:
+            table_alias = joins.get_alias(
+                table_name, first_item=True,
+                condition=lambda alias: self._kludge_first_item_join_cond(
+                    sql, alias, schema.get_columns(table_name)))
+        qualified_name = sql.qualified_column(table_alias, column_name)
+        return SortParam(qualified_name, ascending=sort.ascending)
 
     def _kludge_first_item_join_cond(self, sql, table_alias, columns):
         # Build extra condition JOIN conditions in order to join just first
         # itemns in lists, whre query should consider only first item in list.
-        list_pos_names = set([
-            u'list_pos',
-            u'str_list_pos',
-            u'dict_list_pos',
-        ])
         conds = []
         for column_name in columns:
-            if column_name in list_pos_names:
+            if column_name in LIST_POS_COLUMNS:
                 qualified_name = sql.qualified_column(table_alias, column_name)
                 conds.append('{} = 0'.format(qualified_name))
         return ' AND '.join(conds)
 
-    def _cast_value(self, value):
-        magic = {
-            u'true': True,
-            u'false': False,
-        }
-        lower = six.text_type(value).lower()
-        return magic.get(lower, lower)
-
-    def _build_search_result(self, transaction, ids, show_params):
+    def _cast_value(self, value, column_type, lower=True):
+        # Convert a search value to the type of the column it's
+        # compared with, so that the database compares values of the
+        # same type, and can use indexes. Raise ValueError if that's
+        # not possible.
+        if column_type == bool:
+            if isinstance(value, bool):
+                return value
+            text = six.text_type(value).lower()
+            if text not in (u'true', u'false'):
+                raise ValueError(value)
+            return text == u'true'
+        if column_type in six.integer_types or column_type == float:
+            if isinstance(value, bool):
+                raise ValueError(value)
+            return column_type(six.text_type(value))
+        text = six.text_type(value)
+        if lower:
+            text = text.lower()
+        return text
+
+    def _iter_search_result(self, transaction, ids, show_params):
+        show_all, fields = self._get_show_fields(show_params)
+        ids = iter(ids)
+        while True:
+            batch = list(itertools.islice(ids, self.items_per_batch))
+            if not batch:
+                break
+            if show_all:
+                resources = self.get_items(transaction, batch)
+            elif fields:
+                resources = self.get_items(
+                    transaction, batch, main_fields=fields)
+            else:
+                resources = [{u'id': resource_id} for resource_id in batch]
+            for resource in resources:
+                yield resource
+
+    def _get_show_fields(self, show_params):
         fields = []
         for param in show_params:
             if param == u'show_all':
-                return self._build_search_result_show_all(transaction, ids)
+                return True, None
             elif isinstance(param, tuple) and param[0] == u'show':
                 fields.append(param[1])
+        if fields and u'id' not in fields:
+            fields.append(u'id')
+        return False, fields
 
-        if fields:
-            return self._build_search_result_with_fields(
-                transaction, ids, fields)
-        else:
-            return self._build_search_result_ids_only(ids)
 
-    def _build_search_result_show_all(self, transaction, ids):
-        return {
-            u'resources': [
-                self.get_item(transaction, resource_id) for resource_id in ids
-            ],
-        }
+# Columns that give the position of a row in a list.
+LIST_POS_COLUMNS = frozenset([
+    u'list_pos',
+    u'str_list_pos',
+    u'dict_list_pos',
+])
 
-    def _build_search_result_with_fields(self, transaction, ids, fields):
-        if u'id' not in fields:
-            fields = fields + [u'id']
-        return {
-            u'resources': [
-                self.get_item(transaction, resource_id, main_fields=fields)
-                for resource_id in ids
-            ],
-        }
 
-    def _build_search_result_ids_only(self, ids):
-        return {
-            u'resources': [
-                {u'id': resource_id} for resource_id in ids
-            ],
-        }
+class SearchSchema(object):
+
+    '''The tables and columns of a resource type, arranged for searching.
+
+    A search needs to find the tables each field is stored in, and
+    know which tables have at most one row per item, so these are
+    worked out once from the schema, instead of going through the
+    whole schema for every search parameter.
+
+    ``paths`` maps dotted field paths to (table name, column name)
+    pairs, as filled in by ``qvarn.schema_from_prototype``.
+
+    '''
+
+    def __init__(self, main_table, schema, paths=None):
+        self.main_table = main_table
+        self._tables_by_field = collections.defaultdict(list)
+        self._columns_by_table = collections.OrderedDict()
+        types = {}
+        for table_name, column_name, column_type in schema:
+            self._tables_by_field[column_name].append(
+                (table_name, column_name, column_type))
+            types[(table_name, column_name)] = column_type
+            self._columns_by_table.setdefault(
+                table_name, []).append(column_name)
+        self._single_row_tables = set(
+            table_name
+            for table_name, columns in self._columns_by_table.items()
+            if not LIST_POS_COLUMNS.intersection(columns))
+        self._columns_by_path = dict(
+            (path, (table_name, column_name, types[(table_name, column_name)]))
+            for path, (table_name, column_name) in (paths or {}).items())
+
+    def get_tables(self, field):
+        '''Return (table name, column name, column type) for a field.
+
+        A plain field name, such as ``country``, matches every column
+        with that name, in schema order. A dotted path, such as
+        ``contacts.country``, matches at most one column. The list
+        is empty if there is no such field.
+
+        '''
+
+        if u'.' in field:
+            match = self._columns_by_path.get(field)
+            return [match] if match else []
+        return self._tables_by_field.get(field, [])
+
+    def get_columns(self, table_name):
+        return self._columns_by_table[table_name]
+
+    def is_single_row(self, table_name):
+        '''Does the table have at most one row per item?'''
+        return table_name in self._single_row_tables
+
+
+_search_schemas = {}
+
+
+def get_search_schema(item_type, prototype, subitem_prototypes):
+    '''Return the SearchSchema for a resource type.
+
+    ``subitem_prototypes`` is a list of (subpath, prototype) pairs.
+    Like item plans, search schemas are remembered by the identity
+    of the prototypes, which must not be modified after they've been
+    used to get a schema.
+
+    '''
+
+    subitem_prototypes = sorted(subitem_prototypes, key=lambda x: x[0])
+    key = (
+        item_type,
+        id(prototype),
+        tuple((subpath, id(proto)) for subpath, proto in subitem_prototypes),
+    )
+    cached = _search_schemas.get(key)
+    if cached is None or cached[0] is not prototype:
+        paths = {}
+        schema = qvarn.schema_from_prototype(
+            prototype, resource_type=item_type, paths=paths)
+        for subpath, subproto in subitem_prototypes:
+            schema += qvarn.schema_from_prototype(
+                subproto, resource_type=item_type, subpath=subpath,
+                paths=paths)
+        main_table = qvarn.table_name(resource_type=item_type)
+        # Keep the subitem prototypes alive, so that their ids in the
+        # key can't be reused for other prototypes.
+        cached = (
+            prototype,
+            subitem_prototypes,
+            SearchSchema(main_table, schema, paths),
+        )
+        _search_schemas[key] = cached
+    return cached[2]
+
+
+SearchJoin = collections.namedtuple(
+    'SearchJoin', ('alias', 'table', 'condition', 'inner'))
+
+
+class SearchJoins(object):
+
+    '''The tables joined to the main table in a search query.
+
+    The main table is always aliased as t0. Other tables are joined
+    once for each value of ``first_item``, and the alias reused.
+    Tables with many rows per item are only joined with
+    ``first_item`` true, for sorting; conditions on them are checked
+    with subqueries instead, which get their aliases from
+    ``new_alias``.
+
+    '''
+
+    def __init__(self, schema):
+        self._main_table = schema.main_table
+        self._schema = schema
+        self._alias_count = 0
+        self._joins = []
+        self._shared = {}
+        self._inner = set()
+
+    def new_alias(self):
+        '''Return a new alias, for a table that isn't joined.'''
+        self._alias_count += 1
+        return u't' + str(self._alias_count)
+
+    def get_alias(self, table_name, first_item=False, condition=None):
+        '''Return the alias for a table, joining it if needed.
+
+        ``condition``, if given, is called with the alias, and
+        returns extra SQL conditions for joining the table, such as
+        the ones that limit the join to the first item of a list.
+
+        '''
+
+        if table_name == self._main_table:
+            return u't0'
+        key = (table_name, first_item)
+        if key not in self._shared:
+            alias = self.new_alias()
+            join_condition = condition(alias) if condition else None
+            self._joins.append((alias, table_name, join_condition))
+            self._shared[key] = alias
+        return self._shared[key]
+
+    def require(self, alias):
+        '''Only match items which have a row in the aliased table.
+
+        This allows the table to be joined with an inner join.
+
+        '''
+
+        if alias != u't0':
+            self._inner.add(alias)
+
+    def multiplies_rows(self):
+        '''Can an item have more than one row in the joined tables?'''
+        return any(
+            not self._schema.is_single_row(table_name) and
+            not first_item
+            for table_name, first_item in self._shared)
+
+    def get_ordered(self):
+        '''Return the joins, as SearchJoins, in the order to make them.
+
+        All joins are on the id of the main table, so they can be made
+        in any order. Inner joins, which can only reduce the number of
+        rows, are made first, and joins with at most one row per item
+        before those that can have many. Not all databases reorder
+        outer joins themselves.
+
+        '''
+
+        joins = [
+            SearchJoin(alias, table_name, condition, alias in self._inner)
+            for alias, table_name, condition in self._joins
+        ]
+
+        def cost(join):
+            return (
+                not join.inner,
+                not self._schema.is_single_row(join.table),
+            )
+
+        return sorted(joins, key=cost)
+
+
+def has_binary_fields(prototype):
+    '''Does a prototype have binary fields, at any level?'''
+    if isinstance(prototype, dict):
+        return any(has_binary_fields(x) for x in prototype.values())
+    if isinstance(prototype, list):
+        return any(has_binary_fields(x) for x in prototype)
+    return isinstance(prototype, memoryview)
+
+
+class SearchResults(object):
+
+    '''Resources matching a search, read as they are iterated over.
+
+    See ReadOnlyStorage.search_iter.
+
+    '''
+
+    def __init__(self, storage, transaction, rows, show_params, limit):
+        self._storage = storage
+        self._transaction = transaction
+        self._rows = rows
+        self._show_params = show_params
+        self._limit = limit
+        self._row_count = 0
+        self._last_row = None
+
+    def __iter__(self):
+        # pylint: disable=protected-access
+        return self._storage._iter_search_result(
+            self._transaction, self._ids(), self._show_params)
+
+    def _ids(self):
+        for row in self._rows:
+            self._row_count += 1
+            self._last_row = row
+            yield row[0]
+
+    @property
+    def next_cursor(self):
+        if self._limit is not None and self._row_count == self._limit:
+            return encode_search_cursor(self._last_row)
+        return None
+
+
+def encode_search_cursor(row):
+    '''Encode a search query result row as an opaque cursor string.
+
+    The row has the id first, followed by the values of the sort
+    keys. The cursor has the sort key values first and id last, in
+    the same order as the search orders rows.
+
+    '''
+
+    values = list(row[1:]) + [row[0]]
+    text = json.dumps(values, separators=(',', ':'))
+    encoded = base64.urlsafe_b64encode(text.encode('UTF-8'))
+    return encoded.decode('ASCII').rstrip(u'=')
+
+
+def decode_search_cursor(cursor):
+    '''Decode a cursor string into the list of values in it.'''
+    padding = u'=' * (-len(cursor) % 4)
+    try:
+        text = base64.urlsafe_b64decode((cursor + padding).encode('ASCII'))
+        values = json.loads(text.decode('UTF-8'))
+    except (TypeError, ValueError):
+        raise BadSearchCursor()
+    if not isinstance(values, list) or not values:
+        raise BadSearchCursor()
+    return values
 
 
 class FieldNotInResource(qvarn.BadRequest):
@@ -351,32 +1004,36 @@ class FieldNotInResource(qvarn.BadRequest):
     msg = u'Resource does not contain given field'
 
 
+class BadSearchValue(qvarn.BadRequest):
+
+    msg = u'Search value does not match the type of the field'
+
+
+class BadSearchCursor(qvarn.BadRequest):
+
+    msg = u'Search cursor is not valid for this search'
+
+
 class ItemDoesNotExist(qvarn.NotFound):
 
     msg = u'Item does not exist'
 
 
-class ReadWalker(qvarn.ItemWalker):
+class ReadWalker(qvarn.PlannedWalker):
 
     '''Visit every part of an item to retrieve it from the database.'''
 
-    def __init__(self, transaction, item_type, item_id, main_fields=None):
+    def __init__(self, transaction, item_type, item_id, main_fields=None,
+                 plan=None):
         self._transaction = transaction
         self._item_type = item_type
         self._item_id = item_id
         self._main_fields = main_fields
-
-    def _get_main_str_lists(self, proto):
-        return [
-            x for x in self._get_str_lists(proto)
-            if self._main_field_ok(x)
-        ]
-
-    def _get_main_dict_lists(self, proto):
-        return [
-            x for x in self._get_dict_lists(proto)
-            if self._main_field_ok(x)
-        ]
+        self._plan = plan
+        # Rows of string lists in dict lists, keyed by table name, and
+        # then by position of the dict the list belongs to. These get
+        # filled in by the first visit to each table.
+        self._str_lists = {}
 
     def _main_field_ok(self, field):
         return not self._main_fields or field in self._main_fields
@@ -384,19 +1041,20 @@ class ReadWalker(qvarn.ItemWalker):
     def visit_main_dict(self, item, column_names):
         if self._main_fields:
             column_names = [c for c in column_names if c in self._main_fields]
-        row = self._get_row(self._item_type, self._item_id, column_names)
+        row = self._get_row(self._get_table(), self._item_id, column_names)
         for name in column_names:
             item[name] = row[name]
 
-    def _get_row(self, table_name, item_id, column_names):
+    def _get_row(self, table, item_id, column_names):
         # If a dict has no non-list fields, column_names is empty.
         # This breaks the self._transaction.select call below. There's
         # no sensible way to fix the select method, so we look for the
         # id column instead.
         lookup_names = column_names or [u'id']
 
-        match = ('=', table_name, u'id', item_id)
-        rows = self._transaction.select(table_name, lookup_names, match)
+        match = ('=', table.name, u'id', item_id)
+        rows = self._transaction.select(
+            table.name, lookup_names, match, table_plan=table)
         for row in rows:
             # If we don't have any columns, return an empty dict.
             return row if column_names else {}
@@ -404,18 +1062,17 @@ class ReadWalker(qvarn.ItemWalker):
 
     def visit_main_str_list(self, item, field):
         if self._main_field_ok(field):
-            table_name = qvarn.table_name(
-                resource_type=self._item_type, list_field=field)
-            item[field] = self._get_str_list(table_name, field, self._item_id)
+            table = self._get_table(list_field=field)
+            item[field] = self._get_str_list(table, field, self._item_id)
 
-    def _get_str_list(self, table_name, column_name, item_id):
-        rows = self._get_list(table_name, item_id, [column_name])
+    def _get_str_list(self, table, column_name, item_id):
+        rows = self._get_list(table, item_id, [column_name])
         return [row[column_name] for row in rows]
 
-    def _get_list(self, table_name, item_id, column_names):
-        match = ('=', table_name, u'id', item_id)
+    def _get_list(self, table, item_id, column_names):
+        match = ('=', table.name, u'id', item_id)
         rows = self._transaction.select(
-            table_name, [u'list_pos'] + column_names, match)
+            table.name, [u'list_pos'] + column_names, match, table_plan=table)
         in_order = self._sort_rows(rows)
         return self._make_dicts_from_rows(in_order, column_names)
 
@@ -433,46 +1090,55 @@ class ReadWalker(qvarn.ItemWalker):
 
     def visit_main_dict_list(self, item, field, column_names):
         if self._main_field_ok(field):
-            table_name = qvarn.table_name(
-                resource_type=self._item_type, list_field=field)
-            item[field] = self._get_list(
-                table_name, self._item_id, column_names)
+            table = self._get_table(list_field=field)
+            item[field] = self._get_list(table, self._item_id, column_names)
 
     def visit_dict_in_list_str_list(self, item, field, pos, str_list_field):
         if not self._main_field_ok(field):
             return
 
-        table_name = qvarn.table_name(
-            resource_type=self._item_type,
-            list_field=field,
-            subdict_list_field=str_list_field)
-
-        match = (
-            'AND',
-            ('=', table_name, u'id', self._item_id),
-            ('=', table_name, u'dict_list_pos', six.text_type(pos))
-        )
-        rows = self._transaction.select(
-            table_name, [u'list_pos', str_list_field], match)
-
-        in_order = self._sort_rows(rows)
-        result = [row[str_list_field] for row in in_order]
-        item[field][pos][str_list_field] = result
+        table = self._get_table(
+            list_field=field, subdict_list_field=str_list_field)
+        str_lists = self._get_str_lists_by_pos(
+            table, str_list_field, [u'dict_list_pos'], u'list_pos')
+        item[field][pos][str_list_field] = str_lists.get((pos,), [])
+
+    def _get_str_lists_by_pos(self, table, column_name, pos_columns,
+                              list_pos_column):
+        # Fetch all rows of a table for the item with one query, and
+        # group them into lists by the positions of the dicts the
+        # lists are in.
+        if table.name not in self._str_lists:
+            match = ('=', table.name, u'id', self._item_id)
+            rows = self._transaction.select(
+                table.name,
+                pos_columns + [list_pos_column, column_name],
+                match,
+                table_plan=table)
+
+            def get_pos(row):
+                return tuple(row[x] for x in pos_columns + [list_pos_column])
+
+            str_lists = {}
+            for row in sorted(rows, key=get_pos):
+                key = tuple(row[x] for x in pos_columns)
+                str_lists.setdefault(key, []).append(row[column_name])
+            self._str_lists[table.name] = str_lists
+        return self._str_lists[table.name]
 
     def visit_inner_dict_list(self, item, outer_field, inner_field,
                               column_names):
         if not self._main_field_ok(outer_field):
             return
 
-        table_name = qvarn.table_name(
-            resource_type=self._item_type,
-            list_field=outer_field,
-            subdict_list_field=inner_field)
+        table = self._get_table(
+            list_field=outer_field, subdict_list_field=inner_field)
 
         column_names = [u'list_pos', u'dict_list_pos'] + column_names
 
-        match = ('=', table_name, u'id', self._item_id)
-        rows = self._transaction.select(table_name, column_names, match)
+        match = ('=', table.name, u'id', self._item_id)
+        rows = self._transaction.select(
+            table.name, column_names, match, table_plan=table)
 
         def get_pos(row):
             return row[u'dict_list_pos'], row[u'list_pos']
@@ -490,6 +1156,145 @@ class ReadWalker(qvarn.ItemWalker):
             assert j == len(inner_list), '{} != {}'.format(j, len(inner_list))
             inner_list.append(row)
 
+    def visit_dict_in_inner_list_str_list(self, item, outer_field, outer_pos,
+                                          inner_field, inner_pos,
+                                          str_list_field):
+        if not self._main_field_ok(outer_field):
+            return
+
+        table = self._get_table(
+            list_field=outer_field,
+            subdict_list_field=inner_field,
+            inner_dict_list_field=str_list_field)
+        str_lists = self._get_str_lists_by_pos(
+            table, str_list_field, [u'dict_list_pos', u'list_pos'],
+            u'str_list_pos')
+        inner_dict = item[outer_field][outer_pos][inner_field][inner_pos]
+        inner_dict[str_list_field] = str_lists.get((outer_pos, inner_pos), [])
+
+
+class BatchReadWalker(qvarn.PlannedWalker):
+
+    '''Retrieve several items from the database at once.
+
+    Unlike ReadWalker, this walks the prototype rather than an item,
+    so that every visit happens once per table. Each visit fetches
+    the rows of all the wanted items from one table and distributes
+    them to the right items. The resulting items are in the ``items``
+    dict, keyed by item id.
+
+    '''
+
+    def __init__(self, transaction, item_type, item_ids, main_fields=None,
+                 plan=None):
+        self._transaction = transaction
+        self._item_type = item_type
+        self._item_ids = item_ids
+        self._main_fields = main_fields
+        self._plan = plan
+        self.items = {}
+
+    def _main_field_ok(self, field):
+        return not self._main_fields or field in self._main_fields
+
+    def _get_rows(self, table, column_names, sort_columns):
+        match = ('IN', table.name, u'id', self._item_ids)
+        wanted = [u'id'] + [
+            x for x in sort_columns + column_names if x != u'id']
+        rows = self._transaction.select(
+            table.name, wanted, match, table_plan=table)
+
+        def get_pos(row):
+            return tuple(row[x] for x in sort_columns)
+
+        return sorted(rows, key=get_pos)
+
+    def _group_rows(self, rows):
+        grouped = collections.defaultdict(list)
+        for row in rows:
+            grouped[row[u'id']].append(row)
+        return grouped
+
+    def visit_main_dict(self, item, column_names):
+        if self._main_fields:
+            column_names = [c for c in column_names if c in self._main_fields]
+        for row in self._get_rows(self._get_table(), column_names, []):
+            self.items[row[u'id']] = dict(
+                (name, row[name]) for name in column_names)
+
+    def visit_main_str_list(self, item, field):
+        table = self._get_table(list_field=field)
+        rows = self._group_rows(self._get_rows(table, [field], [u'list_pos']))
+        for item_id, an_item in self.items.items():
+            an_item[field] = [row[field] for row in rows.get(item_id, [])]
+
+    def visit_main_dict_list(self, item, field, column_names):
+        table = self._get_table(list_field=field)
+        rows = self._group_rows(
+            self._get_rows(table, column_names, [u'list_pos']))
+        for item_id, an_item in self.items.items():
+            an_item[field] = [
+                dict((name, row[name]) for name in column_names)
+                for row in rows.get(item_id, [])
+            ]
+
+    def visit_dict_in_list_str_list(self, item, field, pos, str_list_field):
+        if not self._main_field_ok(field):
+            return
+
+        table = self._get_table(
+            list_field=field, subdict_list_field=str_list_field)
+        rows = self._group_rows(self._get_rows(
+            table, [str_list_field], [u'dict_list_pos', u'list_pos']))
+
+        for item_id, an_item in self.items.items():
+            for a_dict in an_item[field]:
+                a_dict[str_list_field] = []
+            for row in rows.get(item_id, []):
+                a_dict = an_item[field][row[u'dict_list_pos']]
+                a_dict[str_list_field].append(row[str_list_field])
+
+    def visit_inner_dict_list(self, item, outer_field, inner_field,
+                              column_names):
+        if not self._main_field_ok(outer_field):
+            return
+
+        table = self._get_table(
+            list_field=outer_field, subdict_list_field=inner_field)
+        rows = self._group_rows(self._get_rows(
+            table, column_names, [u'dict_list_pos', u'list_pos']))
+
+        for item_id, an_item in self.items.items():
+            for outer_dict in an_item[outer_field]:
+                outer_dict[inner_field] = []
+            for row in rows.get(item_id, []):
+                outer_dict = an_item[outer_field][row[u'dict_list_pos']]
+                outer_dict[inner_field].append(
+                    dict((name, row[name]) for name in column_names))
+
+    def visit_dict_in_inner_list_str_list(self, item, outer_field, outer_pos,
+                                          inner_field, inner_pos,
+                                          str_list_field):
+        if not self._main_field_ok(outer_field):
+            return
+
+        table = self._get_table(
+            list_field=outer_field,
+            subdict_list_field=inner_field,
+            inner_dict_list_field=str_list_field)
+        rows = self._group_rows(self._get_rows(
+            table, [str_list_field],
+            [u'dict_list_pos', u'list_pos', u'str_list_pos']))
+
+        for item_id, an_item in self.items.items():
+            for outer_dict in an_item[outer_field]:
+                for inner_dict in outer_dict[inner_field]:
+                    inner_dict[str_list_field] = []
+            for row in rows.get(item_id, []):
+                outer_dict = an_item[outer_field][row[u'dict_list_pos']]
+                inner_dict = outer_dict[inner_field][row[u'list_pos']]
+                inner_dict[str_list_field].append(row[str_list_field])
+
 
 class Measurement(object):
 
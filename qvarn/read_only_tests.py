@@ -18,6 +18,8 @@
 
 import unittest
 
+import six
+
 import qvarn
 
 from qvarn.read_only import SortParam
@@ -137,6 +139,74 @@ class ReadOnlyStorageTests(ReadOnlyStorageBase):
             item = self.ro.get_item(t, added[u'id'])
             self.assertEqual(added, item)
 
+    def test_gets_item_revision(self):
+        with self._dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.item)
+            revision = self.ro.get_item_revision(t, added[u'id'])
+        self.assertEqual(revision, added[u'revision'])
+
+    def test_raises_error_for_revision_of_missing_item(self):
+        with self.assertRaises(qvarn.ItemDoesNotExist):
+            with self._dbconn.transaction() as t:
+                self.ro.get_item_revision(t, u'does-not-exist')
+
+    def test_gets_item_from_cache(self):
+        cache = qvarn.ItemCache(10)
+        self.ro.set_item_cache(cache)
+        with self._dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.item)
+            first = self.ro.get_item(t, added[u'id'])
+            second = self.ro.get_item(t, added[u'id'])
+        self.assertEqual(first, added)
+        self.assertEqual(second, added)
+        self.assertEqual(cache.hits.get(), 1)
+        self.assertEqual(cache.misses.get(), 1)
+
+    def test_does_not_use_stale_cached_item(self):
+        # The cache is not given to the write-only storage, as if the
+        # item was updated by another process.
+        cache = qvarn.ItemCache(10)
+        self.ro.set_item_cache(cache)
+        with self._dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.item)
+            self.ro.get_item(t, added[u'id'])
+            added[u'foo'] = u'changed'
+            updated = self.wo.update_item(t, added)
+            item = self.ro.get_item(t, added[u'id'])
+        self.assertEqual(item, updated)
+        self.assertEqual(cache.hits.get(), 0)
+
+    def test_gets_many_items_at_once(self):
+        self.maxDiff = None
+        with self._dbconn.transaction() as t:
+            first = self.wo.add_item(t, self.item)
+            second = self.wo.add_item(t, _build_item(
+                baz=(u'x', u'y'), bars=(), foo=u'second'))
+            items = self.ro.get_items(
+                t, [second[u'id'], u'does-not-exist', first[u'id']])
+        self.assertEqual(items, [second, first])
+
+    def test_gets_many_items_with_only_some_fields(self):
+        with self._dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.item)
+            items = self.ro.get_items(
+                t, [added[u'id']], main_fields=[u'id', u'foo', u'bars'])
+        self.assertEqual(items, [{
+            u'id': added[u'id'],
+            u'foo': added[u'foo'],
+            u'bars': added[u'bars'],
+        }])
+
+    def test_gets_many_items_in_batches(self):
+        self.ro.items_per_batch = 2
+        with self._dbconn.transaction() as t:
+            added = [
+                self.wo.add_item(t, _build_item(foo=foo))
+                for foo in [u'a', u'b', u'c', u'd', u'e']
+            ]
+            items = self.ro.get_items(t, [x[u'id'] for x in added])
+        self.assertEqual(items, added)
+
     def test_gets_empty_subitem_of_added_item(self):
         with self._dbconn.transaction() as t:
             added = self.wo.add_item(t, self.item)
@@ -364,6 +434,115 @@ class ReadOnlyStorageTests(ReadOnlyStorageBase):
         ])
 
 
+class NestedListTests(unittest.TestCase):
+
+    resource_type = u'nest'
+
+    prototype = {
+        u'type': u'',
+        u'id': u'',
+        u'revision': u'',
+        u'outer': [
+            {
+                u'names': [u''],
+                u'inner': [
+                    {
+                        u'tags': [u''],
+                    },
+                ],
+            },
+        ],
+    }
+
+    item = {
+        u'type': u'nest',
+        u'outer': [
+            {
+                u'names': [u'a', u'b', u'c'],
+                u'inner': [
+                    {u'tags': [u'x', u'y']},
+                    {u'tags': []},
+                ],
+            },
+            {
+                u'names': [],
+                u'inner': [
+                    {u'tags': [u'z']},
+                ],
+            },
+            {
+                u'names': [u'd'],
+                u'inner': [],
+            },
+        ],
+    }
+
+    def setUp(self):
+        self._dbconn = qvarn.DatabaseConnection()
+        self._dbconn.set_sql(qvarn.SqliteAdapter())
+
+        vs = qvarn.VersionedStorage()
+        vs.set_resource_type(self.resource_type)
+        vs.start_version(u'first-version')
+        vs.add_prototype(self.prototype)
+        with self._dbconn.transaction() as t:
+            vs.prepare_storage(t)
+
+        self.ro = qvarn.ReadOnlyStorage()
+        self.ro.set_item_prototype(self.resource_type, self.prototype)
+
+        self.wo = qvarn.WriteOnlyStorage()
+        self.wo.set_item_prototype(self.resource_type, self.prototype)
+
+    def test_gets_nested_lists(self):
+        with self._dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.item)
+            self.assertEqual(self.ro.get_item(t, added[u'id']), added)
+
+    def test_gets_many_items_with_nested_lists(self):
+        with self._dbconn.transaction() as t:
+            first = self.wo.add_item(t, self.item)
+            second = self.wo.add_item(t, self.item)
+            items = self.ro.get_items(t, [first[u'id'], second[u'id']])
+        self.assertEqual(items, [first, second])
+
+    def test_queries_each_table_once_per_item(self):
+        with self._dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.item)
+            selected_tables = record_selects(t)
+            self.ro.get_item(t, added[u'id'])
+        self.assertEqual(
+            sorted(selected_tables),
+            [
+                u'nest',
+                u'nest_outer',
+                u'nest_outer_inner',
+                u'nest_outer_inner_tags',
+                u'nest_outer_names',
+            ])
+
+    def test_deletes_nested_lists(self):
+        with self._dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.item)
+            self.wo.delete_item(t, added[u'id'])
+            rows = t.select(u'nest_outer_inner_tags', [u'id'], None)
+        self.assertEqual(rows, [])
+
+
+def record_selects(transaction):
+    # Statements are formatted only once per table, so count the
+    # select calls rather than calls to the SQL adapter.
+    selected_tables = []
+    select = transaction.select
+
+    def recording_select(table_name, *args, **kwargs):
+        selected_tables.append(table_name)
+        return select(table_name, *args, **kwargs)
+
+    transaction.select = recording_select
+    return selected_tables
+
+
 class LimitTests(ReadOnlyStorageBase):
 
     def setUp(self):
@@ -386,3 +565,528 @@ class LimitTests(ReadOnlyStorageBase):
 
     def test_search_limit_and_offset(self):
         self.assertEqual(self._search(limit=2, offset=1), [u'b', u'c'])
+
+
+class CountTests(ReadOnlyStorageBase):
+
+    def setUp(self):
+        super(CountTests, self).setUp()
+        with self._dbconn.transaction() as t:
+            for foo in [u'a', u'b', u'b']:
+                self.wo.add_item(t, _build_item(foo=foo))
+
+    def _count(self, search_params, **kwargs):
+        with self._dbconn.transaction() as t:
+            return self.ro.count(t, search_params, **kwargs)
+
+    def test_counts_all_items(self):
+        self.assertEqual(self._count([]), 3)
+
+    def test_counts_matching_items(self):
+        search_params = [qvarn.create_search_param(u'exact', u'foo', u'b')]
+        self.assertEqual(self._count(search_params), 2)
+
+    def test_counts_items_once_when_several_rows_match(self):
+        # Every item has two dicts, both of which match.
+        search_params = [qvarn.create_search_param(u'ne', u'baz', u'x')]
+        self.assertEqual(self._count(search_params), 3)
+
+    def test_counts_exactly_without_estimate(self):
+        # SQLite doesn't give an estimate, so the items get counted.
+        self.assertEqual(self._count([], approximate=True), 3)
+
+
+class CaseSensitiveSearchTests(ReadOnlyStorageBase):
+
+    def setUp(self):
+        super(CaseSensitiveSearchTests, self).setUp()
+        with self._dbconn.transaction() as t:
+            self.added = self.wo.add_item(t, _build_item(foo=u'FooBar'))
+
+    def _search(self, key, value):
+        with self._dbconn.transaction() as t:
+            result = self.ro.search(
+                t, [qvarn.create_search_param(u'exact', key, value)], [])
+        return [item[u'id'] for item in result[u'resources']]
+
+    def test_ignores_case_by_default(self):
+        self.assertEqual(self._search(u'foo', u'foobar'), [self.added[u'id']])
+
+    def test_compares_case_sensitive_fields_as_is(self):
+        self.ro.set_search_spec({u'case_sensitive': [u'foo']})
+        self.assertEqual(self._search(u'foo', u'foobar'), [])
+        self.assertEqual(self._search(u'foo', u'FooBar'), [self.added[u'id']])
+
+    def test_compares_ids_as_is(self):
+        item_id = self.added[u'id']
+        self.assertEqual(self._search(u'id', item_id), [item_id])
+        self.assertEqual(self._search(u'id', item_id.upper()), [])
+
+
+class TypedSearchTests(unittest.TestCase):
+
+    prototype = {
+        u'type': u'',
+        u'id': u'',
+        u'revision': u'',
+        u'name': u'',
+        u'age': 0,
+        u'alive': False,
+    }
+
+    def setUp(self):
+        self._dbconn = qvarn.DatabaseConnection()
+        self._dbconn.set_sql(qvarn.SqliteAdapter())
+
+        vs = qvarn.VersionedStorage()
+        vs.set_resource_type(u'yo')
+        vs.start_version(u'v1')
+        vs.add_prototype(self.prototype)
+        with self._dbconn.transaction() as t:
+            vs.prepare_storage(t)
+
+        self.ro = qvarn.ReadOnlyStorage()
+        self.ro.set_item_prototype(u'yo', self.prototype)
+
+        wo = qvarn.WriteOnlyStorage()
+        wo.set_item_prototype(u'yo', self.prototype)
+        self.ids = []
+        with self._dbconn.transaction() as t:
+            for name, age, alive in [(u'true', 9, True), (u'x', 10, False)]:
+                item = wo.add_item(t, {
+                    u'type': u'yo',
+                    u'name': name,
+                    u'age': age,
+                    u'alive': alive,
+                })
+                self.ids.append(item[u'id'])
+
+    def _search(self, rule, key, value):
+        with self._dbconn.transaction() as t:
+            result = self.ro.search(
+                t, [qvarn.create_search_param(rule, key, value)], [])
+        return [r[u'id'] for r in result[u'resources']]
+
+    def test_compares_integers_as_numbers(self):
+        self.assertEqual(self._search(u'gt', u'age', u'9'), [self.ids[1]])
+
+    def test_compares_booleans(self):
+        self.assertEqual(
+            self._search(u'exact', u'alive', u'TRUE'), [self.ids[0]])
+
+    def test_compares_strings_that_look_like_booleans_as_strings(self):
+        self.assertEqual(
+            self._search(u'exact', u'name', u'true'), [self.ids[0]])
+
+    def test_raises_error_for_value_that_is_not_an_integer(self):
+        with self.assertRaises(qvarn.BadSearchValue):
+            self._search(u'exact', u'age', u'nine')
+
+    def test_raises_error_for_value_that_is_not_a_boolean(self):
+        with self.assertRaises(qvarn.BadSearchValue):
+            self._search(u'exact', u'alive', u'yes')
+
+
+class DocumentStorageTests(unittest.TestCase):
+
+    prototype = {
+        u'type': u'',
+        u'id': u'',
+        u'revision': u'',
+        u'foo': u'',
+        u'bars': [u''],
+        u'dicts': [{u'baz': u'', u'foobars': [u'']}],
+    }
+
+    subitem_prototype = {
+        u'secret': u'',
+    }
+
+    item = {
+        u'type': u'yo',
+        u'foo': u'foo',
+        u'bars': [u'bar1', u'bar2'],
+        u'dicts': [{u'baz': u'baz', u'foobars': [u'foobar']}],
+    }
+
+    def setUp(self):
+        self.sql = RecordingSqliteAdapter()
+        self._dbconn = qvarn.DatabaseConnection()
+        self._dbconn.set_sql(self.sql)
+
+        vs = qvarn.VersionedStorage()
+        vs.set_resource_type(u'yo')
+        vs.start_version(u'v1')
+        vs.add_prototype(self.prototype, document=True)
+        vs.add_prototype(self.subitem_prototype, subpath=u'sub')
+        with self._dbconn.transaction() as t:
+            vs.prepare_storage(t)
+
+        self.ro = self._create_storage(qvarn.ReadOnlyStorage)
+        self.wo = self._create_storage(qvarn.WriteOnlyStorage)
+
+    def _create_storage(self, storage_class, document_storage=True):
+        storage = storage_class()
+        storage.set_item_prototype(u'yo', self.prototype)
+        storage.set_subitem_prototype(u'yo', u'sub', self.subitem_prototype)
+        storage.set_document_storage(document_storage)
+        return storage
+
+    def _read_queries(self, read):
+        del self.sql.executed[:]
+        with self._dbconn.transaction() as t:
+            result = read(t)
+        return result, len(self.sql.executed)
+
+    def test_reads_item_with_one_query(self):
+        with self._dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.item)
+        item, queries = self._read_queries(
+            lambda t: self.ro.get_item(t, added[u'id']))
+        self.assertEqual(item, added)
+        self.assertEqual(queries, 1)
+
+    def test_reads_many_items_with_one_query(self):
+        with self._dbconn.transaction() as t:
+            added = [self.wo.add_item(t, self.item) for _ in range(3)]
+        ids = [x[u'id'] for x in added]
+        items, queries = self._read_queries(
+            lambda t: self.ro.get_items(t, ids))
+        self.assertEqual(items, added)
+        self.assertEqual(queries, 1)
+
+    def test_reads_item_without_document_from_tables(self):
+        wo = self._create_storage(
+            qvarn.WriteOnlyStorage, document_storage=False)
+        with self._dbconn.transaction() as t:
+            added = wo.add_item(t, self.item)
+        item, queries = self._read_queries(
+            lambda t: self.ro.get_item(t, added[u'id']))
+        self.assertEqual(item, added)
+        self.assertGreater(queries, 1)
+
+    def test_keeps_document_revision_up_to_date(self):
+        with self._dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.item)
+            revision = self.wo.update_subitem(
+                t, added[u'id'], added[u'revision'], u'sub',
+                {u'secret': u'x'})
+        item, queries = self._read_queries(
+            lambda t: self.ro.get_item(t, added[u'id']))
+        self.assertEqual(item[u'revision'], revision)
+        self.assertEqual(queries, 1)
+
+    def _make_document_stale(self, added):
+        # Change the item without updating its document, like a
+        # process that doesn't store documents would.
+        wo = self._create_storage(
+            qvarn.WriteOnlyStorage, document_storage=False)
+        with self._dbconn.transaction() as t:
+            return wo.update_item(
+                t, dict(added, foo=u'changed', bars=[u'changed']))
+
+    def test_does_not_refresh_stale_document_when_subitem_changes(self):
+        with self._dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.item)
+        updated = self._make_document_stale(added)
+        with self._dbconn.transaction() as t:
+            revision = self.wo.update_subitem(
+                t, added[u'id'], updated[u'revision'], u'sub',
+                {u'secret': u'x'})
+        with self._dbconn.transaction() as t:
+            self.assertEqual(
+                self.ro.get_item(t, added[u'id']),
+                dict(updated, revision=revision))
+            rows = t.select(u'yo', [qvarn.DOCUMENT_COLUMN], None)
+            self.assertEqual(rows, [{qvarn.DOCUMENT_COLUMN: None}])
+
+    def test_keeps_document_up_to_date_when_changed_by_search(self):
+        with self._dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.item)
+            updated = self.wo.update_items_fields(
+                t, [added[u'id']], {u'foo': u'changed'})
+        item, queries = self._read_queries(
+            lambda t: self.ro.get_item(t, added[u'id']))
+        self.assertEqual(
+            item, dict(added, foo=u'changed', revision=updated[0][1]))
+        self.assertEqual(queries, 1)
+
+    def test_does_not_refresh_stale_document_when_changed_by_search(self):
+        with self._dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.item)
+        updated = self._make_document_stale(added)
+        with self._dbconn.transaction() as t:
+            changed = self.wo.update_items_fields(
+                t, [added[u'id']], {u'foo': u'again'})
+        with self._dbconn.transaction() as t:
+            self.assertEqual(
+                self.ro.get_item(t, added[u'id']),
+                dict(updated, foo=u'again', revision=changed[0][1]))
+            rows = t.select(u'yo', [qvarn.DOCUMENT_COLUMN], None)
+            self.assertEqual(rows, [{qvarn.DOCUMENT_COLUMN: None}])
+
+    def test_does_not_read_outdated_document(self):
+        with self._dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.item)
+        wo = self._create_storage(
+            qvarn.WriteOnlyStorage, document_storage=False)
+        changed = dict(added, foo=u'changed')
+        with self._dbconn.transaction() as t:
+            updated = wo.update_item(t, changed)
+        with self._dbconn.transaction() as t:
+            self.assertEqual(self.ro.get_item(t, added[u'id']), updated)
+
+
+class QueryTextTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sql = RecordingSqliteAdapter()
+        self._dbconn = qvarn.DatabaseConnection()
+        self._dbconn.set_sql(self.sql)
+
+        prototype = {u'type': u'', u'id': u'', u'foo': u'', u'bars': [u'']}
+        vs = qvarn.VersionedStorage()
+        vs.set_resource_type(u'yo')
+        vs.start_version(u'v1')
+        vs.add_prototype(prototype)
+        with self._dbconn.transaction() as t:
+            vs.prepare_storage(t)
+
+        self.ro = qvarn.ReadOnlyStorage()
+        self.ro.set_item_prototype(u'yo', prototype)
+
+    def _search(self, foo, bar):
+        with self._dbconn.transaction() as t:
+            self.ro.search(t, [
+                qvarn.create_search_param(u'exact', u'foo', foo),
+                qvarn.create_search_param(u'exact', u'bars', bar),
+            ], [])
+        return self.sql.executed.pop()
+
+    def test_same_kind_of_search_gives_same_query(self):
+        query1, values1 = self._search(u'a', u'b')
+        query2, values2 = self._search(u'c', u'd')
+        self.assertEqual(query1, query2)
+        self.assertEqual(sorted(values1.values()), [u'a', u'b'])
+        self.assertEqual(sorted(values2.values()), [u'c', u'd'])
+
+
+class SearchPlanTests(unittest.TestCase):
+
+    prototype = {
+        u'type': u'',
+        u'id': u'',
+        u'revision': u'',
+        u'foo': u'',
+        u'bars': [u''],
+        u'dicts': [
+            {
+                u'baz': u'',
+                u'qux': u'',
+            },
+        ],
+    }
+
+    subitem_prototype = {
+        u'secret': u'',
+        u'other_secret': u'',
+    }
+
+    def setUp(self):
+        self.sql = RecordingSqliteAdapter()
+        self._dbconn = qvarn.DatabaseConnection()
+        self._dbconn.set_sql(self.sql)
+
+        vs = qvarn.VersionedStorage()
+        vs.set_resource_type(u'yo')
+        vs.start_version(u'v1')
+        vs.add_prototype(self.prototype)
+        vs.add_prototype(self.subitem_prototype, subpath=u'sub')
+        with self._dbconn.transaction() as t:
+            vs.prepare_storage(t)
+
+        self.ro = qvarn.ReadOnlyStorage()
+        self.ro.set_item_prototype(u'yo', self.prototype)
+        self.ro.set_subitem_prototype(u'yo', u'sub', self.subitem_prototype)
+
+        wo = qvarn.WriteOnlyStorage()
+        wo.set_item_prototype(u'yo', self.prototype)
+        wo.set_subitem_prototype(u'yo', u'sub', self.subitem_prototype)
+        self.ids = []
+        with self._dbconn.transaction() as t:
+            for bars, secret in [([u'a', u'b'], u'x'), ([u'a'], u'y')]:
+                item = wo.add_item(t, {
+                    u'type': u'yo',
+                    u'foo': u'foo',
+                    u'bars': bars,
+                    u'dicts': [],
+                })
+                wo.update_subitem(
+                    t, item[u'id'], item[u'revision'], u'sub',
+                    {u'secret': secret, u'other_secret': secret})
+                self.ids.append(item[u'id'])
+
+    def _search(self, search_params, sort_params=None):
+        with self._dbconn.transaction() as t:
+            result = self.ro.search(
+                t,
+                [qvarn.create_search_param(*p) for p in search_params],
+                [],
+                sort_params=[SortParam(key, True)
+                             for key in sort_params or []])
+        query, _ = self.sql.executed.pop()
+        return [r[u'id'] for r in result[u'resources']], query
+
+    def test_checks_list_table_in_subquery_for_each_condition(self):
+        ids, query = self._search([
+            (u'exact', u'bars', u'a'),
+            (u'exact', u'bars', u'b'),
+        ])
+        self.assertEqual(ids, [self.ids[0]])
+        self.assertEqual(query.count(u'JOIN'), 0)
+        self.assertEqual(query.count(u'EXISTS'), 2)
+
+    def test_does_not_select_distinct_rows(self):
+        ids, query = self._search(
+            [(u'exact', u'bars', u'a')], sort_params=[u'baz', u'secret'])
+        self.assertEqual(sorted(ids), sorted(self.ids))
+        self.assertNotIn(u'DISTINCT', query)
+
+    def test_shares_join_of_single_row_table(self):
+        ids, query = self._search([
+            (u'exact', u'secret', u'x'),
+            (u'exact', u'other_secret', u'x'),
+        ], sort_params=[u'secret'])
+        self.assertEqual(ids, [self.ids[0]])
+        self.assertEqual(query.count(u'JOIN'), 1)
+
+    def test_shares_join_for_sorting_by_same_list(self):
+        _, query = self._search([], sort_params=[u'baz', u'qux'])
+        self.assertEqual(query.count(u'JOIN'), 1)
+
+    def test_uses_inner_join_for_condition_on_one_table(self):
+        ids, query = self._search([(u'exact', u'secret', u'x')])
+        self.assertEqual(ids, [self.ids[0]])
+        self.assertIn(u'JOIN', query)
+        self.assertNotIn(u'LEFT JOIN', query)
+
+    def test_searches_one_table_for_dotted_path(self):
+        ids, query = self._search([(u'exact', u'sub.secret', u'y')])
+        self.assertEqual(ids, [self.ids[1]])
+        self.assertEqual(query.count(u'JOIN'), 1)
+
+    def test_searches_list_for_dotted_path(self):
+        ids, query = self._search([(u'exact', u'dicts.baz', u'nope')])
+        self.assertEqual(ids, [])
+        self.assertEqual(query.count(u'EXISTS'), 1)
+
+    def test_sorts_by_dotted_path(self):
+        ids, _ = self._search([], sort_params=[u'sub.secret'])
+        self.assertEqual(ids, self.ids)
+
+    def test_raises_error_for_unknown_dotted_path(self):
+        with self.assertRaises(qvarn.FieldNotInResource):
+            self._search([(u'exact', u'sub.baz', u'x')])
+
+    def test_searches_any_of_a_list_of_values_with_in(self):
+        with self._dbconn.transaction() as t:
+            result = self.ro.search(t, [
+                qvarn.create_search_param(
+                    u'exact', u'bars', [u'b', u'c', u'd'], any=True),
+            ], [])
+        query, values = self.sql.executed.pop()
+        self.assertEqual(
+            [r[u'id'] for r in result[u'resources']], [self.ids[0]])
+        self.assertIn(u' IN (', query)
+        self.assertNotIn(u' OR ', query)
+        self.assertEqual(sorted(values.values()), [u'b', u'c', u'd'])
+
+    def test_uses_outer_join_for_sorting(self):
+        _, query = self._search([], sort_params=[u'baz'])
+        self.assertIn(u'LEFT JOIN', query)
+
+    def test_joins_single_row_tables_first(self):
+        _, query = self._search([], sort_params=[u'baz', u'secret'])
+        sub_table = qvarn.table_name(resource_type=u'yo', subpath=u'sub')
+        dicts_table = qvarn.table_name(
+            resource_type=u'yo', list_field=u'dicts')
+        self.assertLess(query.index(sub_table), query.index(dicts_table))
+
+
+class SearchSchemaTests(unittest.TestCase):
+
+    prototype = {
+        u'type': u'',
+        u'id': u'',
+        u'foo': u'',
+        u'bars': [u''],
+    }
+
+    def test_finds_tables_of_field(self):
+        schema = qvarn.get_search_schema(u'yo', self.prototype, [])
+        bars_table = qvarn.table_name(resource_type=u'yo', list_field=u'bars')
+        self.assertEqual(
+            schema.get_tables(u'foo'), [(u'yo', u'foo', six.text_type)])
+        self.assertEqual(
+            schema.get_tables(u'bars'),
+            [(bars_table, u'bars', six.text_type)])
+        self.assertEqual(schema.get_tables(u'nope'), [])
+
+    def test_knows_single_row_tables(self):
+        schema = qvarn.get_search_schema(u'yo', self.prototype, [])
+        self.assertTrue(schema.is_single_row(u'yo'))
+        self.assertFalse(schema.is_single_row(
+            qvarn.table_name(resource_type=u'yo', list_field=u'bars')))
+
+    def test_remembers_schema(self):
+        schema1 = qvarn.get_search_schema(u'yo', self.prototype, [])
+        schema2 = qvarn.get_search_schema(u'yo', self.prototype, [])
+        self.assertIs(schema1, schema2)
+
+
+class RecordingSqliteAdapter(qvarn.SqliteAdapter):
+
+    def __init__(self):
+        super(RecordingSqliteAdapter, self).__init__()
+        self.executed = []
+
+    def execute_prepared(self, cursor, query, values):
+        self.executed.append((query, values))
+        super(RecordingSqliteAdapter, self).execute_prepared(
+            cursor, query, values)
+
+
+def test_reads_items_as_json(dbconn):
+    prototype = ReadOnlyStorageBase.prototype
+    dbconn.drop_tables([
+        u'yo', u'yo_bars', u'yo_dicts', u'yo_dicts_foobars', u'yo_dicts_foo',
+        u'yo_dicts_inner', u'yo__aux_versions'])
+    vs = qvarn.VersionedStorage()
+    vs.set_resource_type(u'yo')
+    vs.start_version(u'v1')
+    vs.add_prototype(prototype)
+    with dbconn.transaction() as t:
+        vs.prepare_storage(t)
+
+    wo = qvarn.WriteOnlyStorage()
+    wo.set_item_prototype(u'yo', prototype)
+    ro = qvarn.ReadOnlyStorage()
+    ro.set_item_prototype(u'yo', prototype)
+    with dbconn.transaction() as t:
+        added = [
+            wo.add_item(t, _build_item()),
+            wo.add_item(t, _build_item(bars=(), bool_=False)),
+        ]
+    ids = [x[u'id'] for x in added]
+
+    sql = getattr(dbconn, '_sql')
+    sql.set_json_items(True)
+    assert sql.json_items
+    try:
+        with dbconn.transaction() as t:
+            assert ro.get_item(t, ids[0]) == added[0]
+            assert ro.get_items(t, ids) == added
+    finally:
+        sql.set_json_items(False)
+    with dbconn.transaction() as t:
+        assert ro.get_items(t, ids) == added
@@ -47,20 +47,26 @@ class ResourceServer(object):
         self._latest_version = versions[-1]
 
     def _add_resource_type_version(self, version):
+        search = version.get(u'search')
         self._vs.start_version(version[u'version'])
-        self._vs.add_prototype(version[u'prototype'])
+        self._vs.add_prototype(
+            version[u'prototype'], search=search,
+            document=version.get(u'document', False))
 
-        self._add_subresources(version)
+        self._add_subresources(version, search)
 
-        self._vs.add_prototype(qvarn.listener_prototype, auxtable=u'listener')
         self._vs.add_prototype(
-            qvarn.notification_prototype, auxtable=u'notification')
+            qvarn.listener_prototype, search=qvarn.listener_search,
+            auxtable=u'listener')
+        self._vs.add_prototype(
+            qvarn.notification_prototype, search=qvarn.notification_search,
+            auxtable=u'notification')
 
-    def _add_subresources(self, version):
+    def _add_subresources(self, version, search):
         subpaths = version.get(u'subpaths', [])
         for subpath in subpaths:
             proto = subpaths[subpath][u'prototype']
-            self._vs.add_prototype(proto, subpath=subpath)
+            self._vs.add_prototype(proto, search=search, subpath=subpath)
 
     def create_resource(self):
         listener = self._create_listener()
@@ -80,6 +86,14 @@ class ResourceServer(object):
         resource.set_item_type(self._type)
         resource.set_item_prototype(self._latest_version[u'prototype'])
         resource.set_listener(listener)
+        resource.set_item_cache(self._app.get_item_cache())
+        resource.set_streaming(self._app.is_streaming_enabled())
+        resource.set_bulk_chunk_size(self._app.get_bulk_chunk_size())
+        resource.set_max_change_by_search(
+            self._app.get_max_change_by_search())
+        resource.set_search_spec(self._latest_version.get(u'search'))
+        resource.set_document_storage(
+            self._latest_version.get(u'document', False))
 
         resource.set_item_validator(self._latest_version.get(u'validator'))
 
@@ -105,6 +119,8 @@ class ResourceServer(object):
         file_resource.set_item_type(self._type)
         file_resource.set_file_resource_name(subpath)
         file_resource.set_listener(listener)
+        file_resource.set_document_storage(
+            self._latest_version.get(u'document', False))
         return file_resource
 
     def prepare_for_uwsgi(self):
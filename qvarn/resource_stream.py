@@ -0,0 +1,112 @@
+# resource_stream.py - stream a list of resources as a JSON response
+#
+# Copyright 2019 Vaultit AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+
+
+class ResourceStream(object):
+
+    '''A response body with a JSON list of resources, produced lazily.
+
+    The body is the same as for a non-streamed response, i.e., a
+    JSON object with a ``resources`` list, but it is produced piece
+    by piece as the WSGI server iterates over this object, so the
+    whole result never needs to be in memory at once.
+
+    ``get_resources`` is called with an open transaction and must
+    return an iterable of resources. The transaction stays open
+    until the body has been produced, or the stream is closed.
+
+    If the iterable has a ``next_cursor`` attribute that is not None
+    after iteration, it's added to the body as the ``next`` field,
+    like in non-streamed search results.
+
+    The transaction is opened and ``get_resources`` called when the
+    stream is created, so that any errors from them are raised while
+    the request is still being handled, and become proper error
+    responses.
+
+    '''
+
+    # Produce the body in chunks of about this many bytes.
+    chunk_bytes = 64 * 1024
+
+    def __init__(self, dbconn, get_resources):
+        self._dbconn = dbconn
+        self._get_resources = get_resources
+        self._ids_listeners = []
+        self._chunks = self._generate()
+        self._first = next(self._chunks)
+
+    def add_ids_listener(self, callback, chunk_size):
+        '''Call ``callback`` with the ids of the streamed resources.
+
+        The callback gets a list of at most ``chunk_size`` ids at a
+        time, as resources are produced.
+
+        '''
+
+        self._ids_listeners.append((callback, chunk_size, []))
+
+    def __iter__(self):
+        yield self._first
+        for chunk in self._chunks:
+            yield chunk
+
+    def close(self):
+        self._chunks.close()
+
+    def _generate(self):
+        with self._dbconn.transaction() as t:
+            resources = self._get_resources(t)
+            yield u'{"resources": ['
+
+            buf = []
+            size = 0
+            for i, resource in enumerate(resources):
+                text = json.dumps(resource)
+                if i > 0:
+                    text = u', ' + text
+                buf.append(text)
+                size += len(text)
+                self._notify(resource[u'id'])
+                if size >= self.chunk_bytes:
+                    yield u''.join(buf)
+                    buf = []
+                    size = 0
+            self._flush_ids()
+
+            buf.append(u']')
+            next_cursor = getattr(resources, 'next_cursor', None)
+            if next_cursor is not None:
+                buf.append(u', "next": ' + json.dumps(next_cursor))
+            buf.append(u'}')
+            yield u''.join(buf)
+
+    def _notify(self, resource_id):
+        for callback, chunk_size, ids in self._ids_listeners:
+            ids.append(resource_id)
+            if len(ids) >= chunk_size:
+                callback(list(ids))
+                del ids[:]
+
+    def _flush_ids(self):
+        for callback, _, ids in self._ids_listeners:
+            if ids:
+                callback(list(ids))
+                del ids[:]
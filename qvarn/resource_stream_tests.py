@@ -0,0 +1,80 @@
+# resource_stream_tests.py - unit tests
+#
+# Copyright 2019 Vaultit AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import unittest
+
+import qvarn
+
+
+class ResourceStreamTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dbconn = qvarn.DatabaseConnection()
+        self.dbconn.set_sql(qvarn.SqliteAdapter())
+
+    def resources(self, n):
+        return [{u'id': str(i), u'foo': u'bar'} for i in range(n)]
+
+    def body(self, stream):
+        return json.loads(u''.join(stream))
+
+    def test_streams_empty_list(self):
+        stream = qvarn.ResourceStream(self.dbconn, lambda t: [])
+        self.assertEqual(self.body(stream), {u'resources': []})
+
+    def test_streams_resources(self):
+        resources = self.resources(3)
+        stream = qvarn.ResourceStream(self.dbconn, lambda t: resources)
+        self.assertEqual(self.body(stream), {u'resources': resources})
+
+    def test_streams_in_several_chunks(self):
+        resources = self.resources(100)
+        stream = qvarn.ResourceStream(self.dbconn, lambda t: resources)
+        stream.chunk_bytes = 100
+        chunks = list(stream)
+        self.assertTrue(len(chunks) > 2)
+        self.assertEqual(
+            json.loads(u''.join(chunks)), {u'resources': resources})
+
+    def test_calls_get_resources_when_created(self):
+        def get_resources(transaction):
+            raise qvarn.BadRequest()
+
+        with self.assertRaises(qvarn.BadRequest):
+            qvarn.ResourceStream(self.dbconn, get_resources)
+
+    def test_tells_listener_ids_in_chunks(self):
+        resources = self.resources(5)
+        stream = qvarn.ResourceStream(self.dbconn, lambda t: resources)
+        chunks = []
+        stream.add_ids_listener(chunks.append, 2)
+        self.body(stream)
+        self.assertEqual(chunks, [['0', '1'], ['2', '3'], ['4']])
+
+    def test_closes_without_producing_body(self):
+        produced = []
+
+        def get_resources(transaction):
+            for resource in self.resources(3):
+                produced.append(resource)
+                yield resource
+
+        stream = qvarn.ResourceStream(self.dbconn, get_resources)
+        stream.close()
+        self.assertEqual(produced, [])
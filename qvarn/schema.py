@@ -21,12 +21,20 @@ import six
 import qvarn
 
 
-def schema_from_prototype(prototype, resource_type=None, **kwargs):
+def schema_from_prototype(prototype, resource_type=None, paths=None,
+                          **kwargs):
     '''Produce a schema (list of triplets) from a resource prototype.
 
     The list has triplets of the form (table name, column name, column
     type). The resource_type keyword argument MUST be given.
 
+    If ``paths`` is given, it must be a dict, and it gets the dotted
+    path of each field, such as ``contacts.country``, as the key for
+    the (table name, column name) pair the field is stored in. Paths
+    of fields in a sub-resource start with its subpath. Columns that
+    aren't fields of the resource, such as list positions, have no
+    path.
+
     If the prototype does not have an "id" field, an "id" column is
     added to the schema anyway. Sub-resources shouldn't have a
     resource identifier, but their database schema needs one anyway,
@@ -43,31 +51,37 @@ def schema_from_prototype(prototype, resource_type=None, **kwargs):
         prototype[u'id'] = u''
 
     schema = []
-    walker = SchemaWalker(schema, kwargs)
+    walker = SchemaWalker(schema, kwargs, paths)
     walker.walk_item(prototype, prototype)
     return schema
 
 
 class SchemaWalker(qvarn.ItemWalker):
 
-    def __init__(self, schema, table_name_kwargs):
+    def __init__(self, schema, table_name_kwargs, paths=None):
         self._schema = schema
         self._table_name_kwargs = table_name_kwargs
+        self._paths = paths
+        subpath = table_name_kwargs.get('subpath')
+        self._prefix = [subpath] if subpath else []
 
     def visit_main_dict(self, item, column_names):
         table_name = qvarn.table_name(**self._table_name_kwargs)
         for name in column_names:
-            self._add_column(table_name, name, type(item[name]))
+            self._add_column(table_name, name, type(item[name]), [name])
 
-    def _add_column(self, table_name, column_name, column_type):
+    def _add_column(self, table_name, column_name, column_type, path=None):
         self._schema.append((table_name, column_name, column_type))
+        if self._paths is not None and path is not None:
+            dotted = u'.'.join(self._prefix + path)
+            self._paths[dotted] = (table_name, column_name)
 
     def visit_main_str_list(self, item, field):
         table_name = qvarn.table_name(
             list_field=field, **self._table_name_kwargs)
         self._add_column(table_name, u'id', six.text_type)
         self._add_column(table_name, u'list_pos', int)
-        self._add_column(table_name, field, six.text_type)
+        self._add_column(table_name, field, six.text_type, [field])
 
     def visit_main_dict_list(self, item, field, column_names):
         table_name = qvarn.table_name(
@@ -76,7 +90,8 @@ class SchemaWalker(qvarn.ItemWalker):
         self._add_column(table_name, u'list_pos', int)
         for column_name in column_names:
             column_type = type(item[field][0][column_name])
-            self._add_column(table_name, column_name, column_type)
+            self._add_column(
+                table_name, column_name, column_type, [field, column_name])
 
     def visit_dict_in_list_str_list(self, item, field, pos, str_list_field):
         table_name = qvarn.table_name(
@@ -86,7 +101,9 @@ class SchemaWalker(qvarn.ItemWalker):
         self._add_column(table_name, u'id', six.text_type)
         self._add_column(table_name, u'dict_list_pos', int)
         self._add_column(table_name, u'list_pos', int)
-        self._add_column(table_name, str_list_field, six.text_type)
+        self._add_column(
+            table_name, str_list_field, six.text_type,
+            [field, str_list_field])
 
     def visit_inner_dict_list(self, item, field, inner_field, simple_columns):
         table_name = qvarn.table_name(
@@ -98,7 +115,9 @@ class SchemaWalker(qvarn.ItemWalker):
         self._add_column(table_name, u'list_pos', int)
         for column_name in simple_columns:
             column_type = type(item[field][0][inner_field][0][column_name])
-            self._add_column(table_name, column_name, column_type)
+            self._add_column(
+                table_name, column_name, column_type,
+                [field, inner_field, column_name])
 
     def visit_dict_in_inner_list_str_list(self, item, outer_field,
                                           outer_pos, inner_field,
@@ -113,4 +132,6 @@ class SchemaWalker(qvarn.ItemWalker):
         self._add_column(table_name, u'dict_list_pos', int)
         self._add_column(table_name, u'list_pos', int)
         self._add_column(table_name, u'str_list_pos', int)
-        self._add_column(table_name, str_list_field, six.text_type)
+        self._add_column(
+            table_name, str_list_field, six.text_type,
+            [outer_field, inner_field, str_list_field])
@@ -147,3 +147,48 @@ class SchemaFromPrototypeTests(unittest.TestCase):
                 (table_name, u'id', six.text_type),
                 (table_name, u'foo', six.text_type),
             ]))
+
+    def test_gives_paths_of_fields(self):
+        prototype = {
+            u'type': u'',
+            u'id': u'',
+            u'tags': [u''],
+            u'vehicle': [
+                {
+                    u'vehicle_type': u'',
+                    u'owners': [
+                        {
+                            u'owner_names': [u''],
+                            u'owned_from_year': 0,
+                        },
+                    ],
+                },
+            ],
+        }
+        paths = {}
+        qvarn.schema_from_prototype(
+            prototype, resource_type=u'foo', paths=paths)
+        self.assertEqual(
+            paths,
+            {
+                u'type': (u'foo', u'type'),
+                u'id': (u'foo', u'id'),
+                u'tags': (u'foo_tags', u'tags'),
+                u'vehicle.vehicle_type': (u'foo_vehicle', u'vehicle_type'),
+                u'vehicle.owners.owned_from_year':
+                    (u'foo_vehicle_owners', u'owned_from_year'),
+                u'vehicle.owners.owner_names':
+                    (u'foo_vehicle_owners_owner_names', u'owner_names'),
+            })
+
+    def test_gives_paths_of_subresource_fields_with_subpath(self):
+        paths = {}
+        qvarn.schema_from_prototype(
+            {u'sync_id': u''}, resource_type=u'foo', subpath=u'sync',
+            paths=paths)
+        self.assertEqual(
+            paths,
+            {
+                u'sync.id': (u'foo__path_sync', u'id'),
+                u'sync.sync_id': (u'foo__path_sync', u'sync_id'),
+            })
@@ -66,6 +66,9 @@ class StructuredLog(object):
     def add_log_writer(self, writer, filter_rule):
         self._writers.append((writer, filter_rule))
 
+    def remove_log_writer(self, writer):
+        self._writers = [x for x in self._writers if x[0] is not writer]
+
     def set_context(self, new_context):
         thread_id = self._get_thread_id()
         self._context[thread_id] = new_context
@@ -27,8 +27,14 @@ Qvarn are supported.
 
 
 import codecs
+import collections
+import itertools
+import re
 import sqlite3
 import string
+import threading
+import uuid
+import weakref
 
 import psycopg2
 import psycopg2.pool
@@ -55,20 +61,23 @@ class SqlAdapter(object):
     A "column_name_types" argument is similar, but instead of a value,
     it indicates type type of a column, when it is created. Types are
     basic Python types, and must be one of types in the
-    "qvarn.column_types" constant.
+    "qvarn.column_types" constant, or dict for a column holding a JSON
+    document (see qvarn.document).
 
     A "select_condition" argument is a tree structure describing an
     arbitrarily complex boolean expression. The tree nodes may be of
     the following shapes:
 
         ('=', table_name, column_name, value)
+        ('IN', table_name, column_name, values)
         ('AND', cond...)
         ('OR', cond...)
 
     where "cond..." zero or more conditions of the same structure as
     the tree. A '=' node specifies a condition of where table row
-    matches if its column has an exact value. The 'AND' and 'OR' nodes
-    combine other conditions to a more complicated one.
+    matches if its column has an exact value. An 'IN' node matches if
+    the column has any of the values in a list. The 'AND' and 'OR'
+    nodes combine other conditions to a more complicated one.
 
     A select_condition may be None to indicate that all rows match.
 
@@ -94,6 +103,39 @@ class SqlAdapter(object):
     # override it.
     type_name = {}
 
+    # Do NULL values come before all other values in ascending order?
+    # Subclasses MUST set this to match the database engine.
+    nulls_sort_first = None
+
+    # How many rows to fetch at a time from a streaming cursor.
+    fetch_batch_size = 1000
+
+    # How many rows execute_many puts in one statement, if the
+    # adapter inserts many rows with one statement.
+    insert_batch_size = 1000
+
+    # Kinds of indexes, other than plain ones, that the database
+    # supports: 'pattern' for prefix matching with LIKE, and 'trigram'
+    # for substring matching with LIKE.
+    index_kinds = ()
+
+    # Can indexes be created without locking out writes?
+    concurrent_indexes = False
+
+    # The exception the database module raises when a constraint,
+    # such as a unique index, would be violated.
+    integrity_error = sqlite3.IntegrityError
+
+    # Does execute_prepared use prepared statements?
+    prepared_statements = False
+
+    # Can the database put together whole items as JSON? See
+    # format_item_json_select.
+    json_items_supported = False
+
+    # Are items read with format_item_json_select?
+    json_items = False
+
     def quote(self, name):
         '''Quote a name for SQL.
 
@@ -140,6 +182,76 @@ class SqlAdapter(object):
     def format_drop_table(self, table_name):
         return u'DROP TABLE IF EXISTS %s ' % self.quote(table_name)
 
+    def format_create_index(self, table_name, index_name, column_names,
+                            unique=False, lower=False, kind=None,
+                            concurrently=False):
+        '''Format an SQL CREATE INDEX statement.
+
+        If ``lower`` is true, the index is on the lower case values of
+        the columns, for case insensitive comparisons. ``kind`` is
+        None for a plain index, or one of ``index_kinds``. If
+        ``concurrently`` is true, and the database supports it, the
+        index is built without locking out writes to the table. This
+        needs the statement to be executed outside a transaction.
+
+        '''
+
+        assert kind is None or kind in self.index_kinds
+        template = (
+            u'CREATE {unique}INDEX {concurrently}IF NOT EXISTS {name} '
+            u'ON {table}{using} ({columns})'
+        )
+        return template.format(
+            unique=u'UNIQUE ' if unique else u'',
+            concurrently=(
+                u'CONCURRENTLY '
+                if concurrently and self.concurrent_indexes else u''),
+            name=self.quote(index_name),
+            table=self.quote(table_name),
+            using=self._format_index_using(kind),
+            columns=self._format_index_columns(column_names, lower, kind))
+
+    def _format_index_using(self, kind):
+        return u''
+
+    def _format_index_columns(self, column_names, lower, kind):
+        template = u'LOWER({})' if lower else u'{}'
+        opclass = self._format_index_opclass(kind)
+        return u', '.join(
+            template.format(self.quote(x)) + opclass for x in column_names)
+
+    def _format_index_opclass(self, kind):
+        return u''
+
+    def format_index_prerequisites(self, kind):
+        '''Return statements to run before creating a kind of index.'''
+        return []
+
+    def format_invalid_index_select(self, index_name):
+        '''Format a query for whether an index exists but is invalid.
+
+        An index that failed to be built concurrently is left in
+        place, but invalid. Return the query and its values, or None
+        if the database doesn't leave such indexes. The query returns
+        a row only if the index is invalid.
+
+        '''
+
+        return None
+
+    def format_drop_index(self, index_name, concurrently=False):
+        '''Format an SQL DROP INDEX statement.
+
+        ``concurrently`` is as for format_create_index.
+
+        '''
+
+        return u'DROP INDEX {concurrently}IF EXISTS {name}'.format(
+            concurrently=(
+                u'CONCURRENTLY '
+                if concurrently and self.concurrent_indexes else u''),
+            name=self.quote(index_name))
+
     def format_select(self, table_name, column_names, select_condition):
         '''Format an SQL SELECT statement.
 
@@ -167,9 +279,9 @@ class SqlAdapter(object):
     def _get_table_names(self, condition):
         if condition is None:
             return []
-        assert condition[0] in ('=', 'AND', 'OR')
+        assert condition[0] in ('=', 'IN', 'AND', 'OR')
 
-        if condition[0] == '=':
+        if condition[0] in ('=', 'IN'):
             return [condition[1]]
         else:
             result = []
@@ -177,17 +289,31 @@ class SqlAdapter(object):
                 result += self._get_table_names(cond)
             return result
 
+    def format_condition_values(self, select_condition):
+        '''Return the placeholder values for a select condition.
+
+        This gives the values that format_select and format_delete
+        return for the condition, without formatting the statement.
+
+        '''
+
+        return self._construct_values({}, select_condition)
+
     def _construct_values(self, values, condition):
         if condition is None:
             return values
 
         op = condition[0]
-        assert op in ('=', 'AND', 'OR')
+        assert op in ('=', 'IN', 'AND', 'OR')
 
         if op == '=':
             _, table_name, column_name, value = condition
             x = self.format_qualified_placeholder_name(table_name, column_name)
             values[x] = value
+        elif op == 'IN':
+            _, table_name, column_name, in_values = condition
+            values.update(
+                self._construct_in_values(table_name, column_name, in_values))
         else:
             for cond in condition[1:]:
                 self._construct_values(values, cond)
@@ -197,6 +323,7 @@ class SqlAdapter(object):
     def _format_condition(self, condition):
         funcs = {
             '=': self._format_equal,
+            'IN': self._format_in,
             'AND': self._format_and,
             'OR': self._format_or,
         }
@@ -209,6 +336,51 @@ class SqlAdapter(object):
             self.quote(column_name),
             self.format_qualified_placeholder(table_name, column_name))
 
+    def _format_in(self, table_name, column_name, values):
+        # The generic version uses one placeholder per value. Adapters
+        # that can bind a whole list to one placeholder override this,
+        # together with _construct_in_values.
+        placeholders = [
+            self.format_qualified_placeholder(
+                table_name, self._in_placeholder_column(column_name, i))
+            for i in range(len(values))
+        ]
+        return u'{}.{} IN ({})'.format(
+            self.quote(table_name),
+            self.quote(column_name),
+            u', '.join(placeholders))
+
+    def _construct_in_values(self, table_name, column_name, values):
+        return dict(
+            (self.format_qualified_placeholder_name(
+                table_name, self._in_placeholder_column(column_name, i)),
+             value)
+            for i, value in enumerate(values)
+        )
+
+    def _in_placeholder_column(self, column_name, i):
+        return u'{}_in_{}'.format(column_name, i)
+
+    def format_search_in(self, expression, table_name, name, values):
+        '''Format a search condition for an expression being in a list.
+
+        Return the condition and a dict of values for its
+        placeholders. ``name`` is used to name the placeholders.
+
+        '''
+
+        placeholder_names = [
+            self._in_placeholder_column(name, i) for i in range(len(values))]
+        condition = u'{} IN ({})'.format(
+            expression,
+            u', '.join(
+                self.format_qualified_placeholder(table_name, x)
+                for x in placeholder_names))
+        condition_values = dict(
+            (self.format_qualified_placeholder_name(table_name, x), value)
+            for x, value in zip(placeholder_names, values))
+        return condition, condition_values
+
     def _format_and(self, *conds):
         return self._format_andor(u'AND', *conds)
 
@@ -232,6 +404,26 @@ class SqlAdapter(object):
             u', '.join(quoted_column_names),
             u', '.join(placeholders))
 
+    def format_insert_many(self, table_name, column_names):
+        '''Format an SQL INSERT statement for many rows.
+
+        The statement is meant for ``execute_many``. By default it's
+        the same statement as for inserting one row, and it gets
+        executed once for each row.
+
+        '''
+
+        return self.format_insert(table_name, column_names)
+
+    def execute_many(self, cursor, query, column_names, rows):
+        '''Execute a statement from format_insert_many.
+
+        ``rows`` is a list of dicts with values for ``column_names``.
+
+        '''
+
+        cursor.executemany(query, rows)
+
     def format_update(self, table_name, select_condition, column_name_values):
         assignments = [
             u'{} = {}'.format(self.quote(x), self.format_placeholder(x))
@@ -279,6 +471,109 @@ class SqlAdapter(object):
     def put_conn(self, conn):
         raise NotImplementedError()
 
+    def set_autocommit(self, conn, autocommit):
+        '''Make each statement on a connection commit by itself.
+
+        By default this does nothing, and statements are executed in
+        a transaction.
+
+        '''
+
+    def set_prepared_statements(self, enabled):
+        '''Set whether execute_prepared uses prepared statements.'''
+        self.prepared_statements = enabled
+
+    def execute_prepared(self, cursor, query, values):
+        '''Execute a query that is likely to be executed again.
+
+        If the adapter supports it, and prepared statements are
+        enabled, the query is prepared on the cursor's connection the
+        first time, and the prepared statement is used after that, so
+        the database doesn't need to parse and plan it every time. By
+        default the query is just executed.
+
+        '''
+
+        cursor.execute(query, values)
+
+    def set_fetch_batch_size(self, batch_size):
+        '''Set how many rows streaming cursors fetch at a time.'''
+        self.fetch_batch_size = batch_size
+
+    def set_json_items(self, enabled):
+        '''Set whether items are put together as JSON by the database.
+
+        This has no effect unless the adapter supports it.
+
+        '''
+
+        self.json_items = enabled and self.json_items_supported
+
+    def format_item_json_select(self, plan):
+        '''Format a query that returns whole items as JSON.
+
+        ``plan`` is the qvarn.ItemPlan of the items. The query has an
+        ``ids`` placeholder, for a list of item ids, and returns a row
+        with the id and the item, as a JSON object, for each item in
+        the list. Only adapters with ``json_items_supported`` set
+        implement this.
+
+        '''
+
+        raise NotImplementedError()
+
+    def get_streaming_cursor(self, conn):
+        '''Return a cursor for reading a large result in batches.
+
+        The caller should fetch rows with ``fetchmany`` and close the
+        cursor when done. By default this is a plain cursor.
+
+        '''
+
+        return conn.cursor()
+
+    def format_approximate_row_count(self, table_name):
+        '''Format a query for the estimated number of rows in a table.
+
+        Return the query and its values, or None if the database
+        doesn't keep such an estimate. The query returns one row,
+        with the estimate, or a negative number if there is none.
+
+        '''
+
+        return None
+
+    def format_outdated_documents_select(self, table_name, document_column,
+                                         after_id, limit):
+        '''Format a query for ids of items without an up to date document.
+
+        A document is up to date if it exists and has the revision of
+        the item. At most ``limit`` ids are selected, in order, and
+        only ids after ``after_id``, unless it's None. Return the query
+        and its values.
+
+        '''
+
+        document = self.quote(document_column)
+        document_revision = self._format_document_field(
+            document, u'revision')
+        conds = [
+            u'({0} IS NULL OR {1} IS NULL OR {1} <> revision)'.format(
+                document, document_revision),
+        ]
+        values = {}
+        if after_id is not None:
+            conds.append(u'id > ' + self.format_placeholder(u'after_id'))
+            values[self.quote(u'after_id')] = after_id
+        query = u'SELECT id FROM {} WHERE {} ORDER BY id {}'.format(
+            self.quote(table_name), u' AND '.join(conds),
+            self.format_limit(limit))
+        return query, values
+
+    def _format_document_field(self, document, field):
+        # Format an expression for a text field of a stored document.
+        raise NotImplementedError()
+
     def _create_engine(self, dsn):
         # pylint: disable=attribute-defined-outside-init
         self._engine = sa.create_engine(dsn, creator=self.get_conn)
@@ -297,17 +592,23 @@ class SqliteAdapter(SqlAdapter):
 
     '''An SQL dialect adapter for SQLite.'''
 
+    nulls_sort_first = True
+
     type_name = {
         bool: u'BOOLEAN',
         memoryview: u'BLOB',
         int: u'INTEGER',
         six.text_type: u'TEXT',
+        dict: u'JSON',
     }
 
     def __init__(self, dbfile=u':memory:'):
         self._conn = sqlite3.connect(dbfile)
         self._create_engine('sqlite://')
 
+    def _format_document_field(self, document, field):
+        return u"json_extract({}, '$.{}')".format(document, field)
+
     def format_limit(self, limit=None, offset=None):
         query = []
         if limit is None and offset is not None:
@@ -343,17 +644,47 @@ class PostgresAdapter(SqlAdapter):
 
     '''An SQL adapter for Postgres.'''
 
+    nulls_sort_first = False
+
+    index_kinds = (u'pattern', u'trigram')
+
+    concurrent_indexes = True
+
     type_name = {
         bool: u'BOOLEAN',
         memoryview: u'BYTEA',
         int: u'BIGINT',
         six.text_type: u'TEXT',
+        dict: u'JSONB',
     }
 
+    json_items_supported = True
+
+    integrity_error = psycopg2.IntegrityError
+
+    insert_batch_size = 500
+
+    # How many prepared statements to keep per connection. The least
+    # recently used ones are deallocated first.
+    max_prepared_statements = 200
+
+    # Matches the placeholders in queries, and escaped percent signs.
+    _placeholder_re = re.compile(r'%\(([^)]+)\)s|%%')
+
+    # PostgreSQL types of values given to prepared statements.
+    _parameter_types = [
+        (bool, u'boolean'),
+        (six.integer_types, u'bigint'),
+        (six.text_type, u'text'),
+        (memoryview, u'bytea'),
+    ]
+
     def __init__(self, **kwargs):
         self._check_init_args(kwargs)
         self._pool = self._create_connection_pool(kwargs)
         self._create_engine('postgresql+psycopg2://')
+        self._prepared = weakref.WeakKeyDictionary()
+        self._prepared_lock = threading.Lock()
 
     def _check_init_args(self, kwargs):
         # Check arguments to __init__. We do it this way, to force
@@ -393,6 +724,28 @@ class PostgresAdapter(SqlAdapter):
         psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
         return pool
 
+    def format_approximate_row_count(self, table_name):
+        # This is the planner's estimate, which VACUUM and ANALYZE
+        # update. It is -1 if the table has never been analyzed.
+        sql = u'SELECT reltuples FROM pg_class WHERE oid = to_regclass({})'
+        return (
+            sql.format(self.format_placeholder(u'table_name')),
+            {self.quote(u'table_name'): self.quote(table_name)},
+        )
+
+    def format_invalid_index_select(self, index_name):
+        sql = (
+            u'SELECT indexrelid FROM pg_index '
+            u'WHERE indexrelid = to_regclass({}) AND NOT indisvalid'
+        )
+        return (
+            sql.format(self.format_placeholder(u'index_name')),
+            {self.quote(u'index_name'): self.quote(index_name)},
+        )
+
+    def _format_document_field(self, document, field):
+        return u"{}->>'{}'".format(document, field)
+
     def format_limit(self, limit=None, offset=None):
         query = []
         if limit is None and offset is not None:
@@ -413,6 +766,117 @@ class PostgresAdapter(SqlAdapter):
     def format_qualified_placeholder_name(self, table_name, column_name):
         return self.qualified_column(table_name, column_name)
 
+    def _format_in(self, table_name, column_name, values):
+        # psycopg2 adapts a Python list to an ARRAY, so the whole list
+        # is bound to a single placeholder.
+        return u'{}.{} = ANY({})'.format(
+            self.quote(table_name),
+            self.quote(column_name),
+            self.format_qualified_placeholder(table_name, column_name))
+
+    def _construct_in_values(self, table_name, column_name, values):
+        name = self.format_qualified_placeholder_name(table_name, column_name)
+        return {name: list(values)}
+
+    def format_search_in(self, expression, table_name, name, values):
+        # Like _format_in, bind the whole list to one placeholder, so
+        # that the query is the same however long the list is.
+        condition = u'{} = ANY({})'.format(
+            expression, self.format_qualified_placeholder(table_name, name))
+        name = self.format_qualified_placeholder_name(table_name, name)
+        return condition, {name: list(values)}
+
+    def format_item_json_select(self, plan):
+        # The item is built with jsonb_build_object from the main
+        # table, and each list with a correlated jsonb_agg subquery
+        # over the list's table, in list order. Lists in dicts in
+        # lists are subqueries within those subqueries.
+        aliases = itertools.count(1)
+        main_alias = u't0'
+        fields = [
+            (column, self.qualified_column(main_alias, column))
+            for column in plan.main.columns
+        ]
+        for field, table in plan.str_lists:
+            fields.append((field, self._format_json_list(
+                aliases, table, main_alias, [],
+                lambda alias, field=field: self.qualified_column(
+                    alias, field))))
+        for dict_list in plan.dict_lists:
+            fields.append((dict_list.field, self._format_json_list(
+                aliases, dict_list.table, main_alias, [],
+                lambda alias, dict_list=dict_list: self._format_json_dict(
+                    aliases, main_alias, alias, dict_list.table,
+                    dict_list.str_lists, dict_list.inner_dict_lists))))
+        return (
+            u'SELECT {main}.id, {item} FROM {table} AS {main} '
+            u'WHERE {main}.id = ANY(%(ids)s)'
+        ).format(
+            main=main_alias,
+            item=self._format_json_object(fields),
+            table=self.quote(plan.main.name))
+
+    def _format_json_dict(self, aliases, main_alias, alias, table, str_lists,
+                          inner_dict_lists):
+        positions = [
+            self.qualified_column(alias, x) for x in table.pos_columns]
+        fields = [
+            (column, self.qualified_column(alias, column))
+            for column in table.columns
+        ]
+        for field, str_list_table in str_lists:
+            fields.append((field, self._format_json_list(
+                aliases, str_list_table, main_alias, positions,
+                lambda inner_alias, field=field: self.qualified_column(
+                    inner_alias, field))))
+        for inner in inner_dict_lists:
+            fields.append((inner.field, self._format_json_list(
+                aliases, inner.table, main_alias, positions,
+                lambda inner_alias, inner=inner: self._format_json_dict(
+                    aliases, main_alias, inner_alias, inner.table,
+                    inner.str_lists, []))))
+        return self._format_json_object(fields)
+
+    def _format_json_list(self, aliases, table, main_alias, parent_positions,
+                          format_element):
+        # The list's rows are those of the item whose positions, except
+        # the last one, are the positions of the parent dict. The last
+        # position is the position in the list.
+        alias = u't{}'.format(next(aliases))
+        conds = [u'{}.id = {}.id'.format(alias, main_alias)]
+        for column, parent in zip(table.pos_columns[:-1], parent_positions):
+            conds.append(u'{} = {}'.format(
+                self.qualified_column(alias, column), parent))
+        return (
+            u"COALESCE((SELECT jsonb_agg({element} ORDER BY {pos}) "
+            u"FROM {table} AS {alias} WHERE {conds}), '[]'::jsonb)"
+        ).format(
+            element=format_element(alias),
+            pos=self.qualified_column(alias, table.pos_columns[-1]),
+            table=self.quote(table.name),
+            alias=alias,
+            conds=u' AND '.join(conds))
+
+    def _format_json_object(self, fields):
+        # Functions take at most 100 arguments, so big objects are
+        # built in parts and concatenated.
+        pairs_per_part = 50
+        parts = []
+        for i in range(0, len(fields), pairs_per_part):
+            args = []
+            for name, expression in fields[i:i + pairs_per_part]:
+                args.append(u'{}, {}'.format(
+                    self._format_string_literal(name), expression))
+            parts.append(u'jsonb_build_object({})'.format(u', '.join(args)))
+        if not parts:
+            return u"'{}'::jsonb"
+        return u' || '.join(parts)
+
+    def _format_string_literal(self, text):
+        # Field names come from resource type definitions, so they
+        # can't be trusted to be free of quotes.
+        return u"'{}'".format(text.replace(u"'", u"''"))
+
     def format_alter_column(self, table_name, column_name, old, new):
 
         def using():
@@ -444,5 +908,119 @@ class PostgresAdapter(SqlAdapter):
     def get_conn(self):
         return self._pool.getconn()
 
+    def set_autocommit(self, conn, autocommit):
+        conn.autocommit = autocommit
+
+    def _format_index_using(self, kind):
+        return u' USING GIN' if kind == u'trigram' else u''
+
+    def _format_index_opclass(self, kind):
+        # text_pattern_ops makes a btree index usable for LIKE with a
+        # fixed prefix, whatever the database collation. A trigram
+        # index can be used for any LIKE pattern.
+        opclasses = {
+            u'pattern': u' text_pattern_ops',
+            u'trigram': u' gin_trgm_ops',
+        }
+        return opclasses.get(kind, u'')
+
+    def format_index_prerequisites(self, kind):
+        if kind == u'trigram':
+            return [u'CREATE EXTENSION IF NOT EXISTS pg_trgm']
+        return []
+
+    def format_insert_many(self, table_name, column_names):
+        # This is for psycopg2.extras.execute_values, which puts the
+        # rows in place of the single placeholder, so that many rows
+        # get inserted with one statement.
+        return u'INSERT INTO {} ({}) VALUES %s'.format(
+            self.quote(table_name),
+            u', '.join(self.quote(x) for x in column_names))
+
+    def execute_many(self, cursor, query, column_names, rows):
+        psycopg2.extras.execute_values(
+            cursor, query,
+            [tuple(row[x] for x in column_names) for row in rows],
+            page_size=self.insert_batch_size)
+
+    def execute_prepared(self, cursor, query, values):
+        if not self.prepared_statements:
+            cursor.execute(query, values)
+            return
+
+        statement, names = self._to_positional(query)
+        args = [values[name] for name in names]
+        types = [self._get_parameter_type(x) for x in args]
+        if None in types:
+            # We don't know what type to declare, so we can't
+            # prepare this.
+            cursor.execute(query, values)
+            return
+
+        statements = self._get_prepared_statements(cursor.connection)
+        key = (statement, tuple(types))
+        name = statements.pop(key, None)
+        if name is None:
+            name = u'qvarn_{}'.format(uuid.uuid4().hex)
+            if types:
+                declaration = u'{} ({})'.format(name, u', '.join(types))
+            else:
+                declaration = name
+            cursor.execute(
+                u'PREPARE {} AS {}'.format(declaration, statement))
+            while len(statements) >= self.max_prepared_statements:
+                _, old_name = statements.popitem(last=False)
+                cursor.execute(u'DEALLOCATE {}'.format(old_name))
+        # Keep the most recently used statement last.
+        statements[key] = name
+
+        if args:
+            placeholders = u', '.join([u'%s'] * len(args))
+            cursor.execute(
+                u'EXECUTE {} ({})'.format(name, placeholders), args)
+        else:
+            cursor.execute(u'EXECUTE {}'.format(name))
+
+    def _get_prepared_statements(self, conn):
+        with self._prepared_lock:
+            if conn not in self._prepared:
+                self._prepared[conn] = collections.OrderedDict()
+            return self._prepared[conn]
+
+    def _to_positional(self, query):
+        # PREPARE takes $1, $2, etc, as placeholders, instead of the
+        # named ones psycopg2 fills in.
+        names = []
+
+        def replace(m):
+            if m.group(0) == u'%%':
+                return u'%'
+            name = m.group(1)
+            if name not in names:
+                names.append(name)
+            return u'${}'.format(names.index(name) + 1)
+
+        return self._placeholder_re.sub(replace, query), names
+
+    def _get_parameter_type(self, value):
+        if isinstance(value, list):
+            item_types = set(self._get_parameter_type(x) for x in value)
+            if len(item_types) == 1 and None not in item_types:
+                return item_types.pop() + u'[]'
+            return None
+        for python_type, sql_type in self._parameter_types:
+            if isinstance(value, python_type):
+                return sql_type
+        return None
+
+    def get_streaming_cursor(self, conn):
+        # A named cursor is a server-side cursor: rows are only sent
+        # to us when we fetch them. A plain psycopg2 cursor gets the
+        # whole result at once when the query is executed.
+        name = u'qvarn_{}'.format(uuid.uuid4().hex)
+        cursor = conn.cursor(name=name)
+        cursor.itersize = self.fetch_batch_size
+        return cursor
+
     def put_conn(self, conn):
         self._pool.putconn(conn)
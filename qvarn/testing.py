@@ -95,12 +95,12 @@ class DeleteWalker(qvarn.DeleteWalker):
         self._item_type = item_type
         self._item_id = None
 
-    def _delete_rows(self, table_name, item_id):
+    def _delete_rows(self, table):
         # Some tables (like resource_files) are created on demand, so it's not
         # an error if they do not exist.
-        if table_name in self._db.meta.tables:
+        if table.name in self._db.meta.tables:
             self._db.engine.execute(
-                self._db.meta.tables[table_name].delete()
+                self._db.meta.tables[table.name].delete()
             )
 
 
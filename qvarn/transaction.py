@@ -38,12 +38,24 @@ class Transaction(object):
     actual SQL text is allowed anywhere outside SQLAdapter and its
     subclasses.
 
+    The select, insert, update, and delete methods optionally take a
+    ``table_plan`` (a qvarn.TablePlan), in which case the formatted
+    statement is remembered in the plan and reused the next time a
+    statement of the same shape is needed.
+
+    If ``autocommit`` is true, each statement is committed as soon
+    as it has been executed, if the database supports that, instead
+    of all at the end. This is needed for statements that can't be
+    run inside a transaction, such as creating indexes concurrently
+    on PostgreSQL.
+
     '''
 
-    def __init__(self):
+    def __init__(self, autocommit=False):
         self._sql = None
         self._conn = None
         self._measurement = None
+        self._autocommit = autocommit
 
     def set_sql(self, sql):
         self._sql = sql
@@ -61,6 +73,8 @@ class Transaction(object):
         self._measurement = qvarn.Measurement()
         self._conn = self._sql.get_conn()
         qvarn.log.log('get_conn', conn=repr(self._conn))
+        if self._autocommit:
+            self._sql.set_autocommit(self._conn, True)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -71,6 +85,8 @@ class Transaction(object):
                 self._conn.commit()
             else:
                 self._conn.rollback()
+            if self._autocommit:
+                self._sql.set_autocommit(self._conn, False)
         except BaseException:
             qvarn.log.log('put_conn', conn=repr(self._conn))
             self._sql.put_conn(self._conn)
@@ -82,15 +98,18 @@ class Transaction(object):
         self._conn = None
         self._measurement = None
 
-    def _execute(self, what, query, values):
+    def _execute(self, what, query, values, prepared=False):
         with self._measurement.new(what) as m:
             c = self._conn.cursor()
-            c.execute(query, values)
+            if prepared:
+                self._sql.execute_prepared(c, query, values)
+            else:
+                c.execute(query, values)
             m.note(query=query, values=values)
         return c
 
-    def execute(self, what, query, values=None):
-        return self._execute(what, query, values)
+    def execute(self, what, query, values=None, prepared=False):
+        return self._execute(what, query, values, prepared=prepared)
 
     def create_table(self, table_name, column_name_type_pairs):
         query = self._sql.format_create_table(
@@ -115,15 +134,148 @@ class Transaction(object):
         query = self._sql.format_drop_table(table_name)
         self._execute('DROP TABLE', query, {})
 
-    def select(self, table_name, column_names, select_condition):
-        query, values = self._sql.format_select(
-            table_name, column_names, select_condition)
+    def create_index(self, table_name, index_name, column_names,
+                     unique=False, lower=False, kind=None):
+        '''Create an index, unless it exists already.
+
+        An invalid index, left behind by a failed concurrent build, is
+        dropped and built again. Return True if the index exists, and
+        is valid, afterwards.
+
+        Return False, without doing anything, if the database doesn't
+        support the kind of index. Also return False, and log the
+        error, if a unique index can't be built because of duplicate
+        values, and the transaction is in autocommit mode. In a
+        transaction, the error is raised, since the transaction can't
+        be continued.
+
+        '''
+
+        if kind is not None and kind not in self._sql.index_kinds:
+            return False
+        for query in self._sql.format_index_prerequisites(kind):
+            self._execute('CREATE INDEX (prerequisite)', query, {})
+        if self._is_invalid_index(index_name):
+            self._drop_index(index_name)
+        query = self._sql.format_create_index(
+            table_name, index_name, column_names, unique=unique,
+            lower=lower, kind=kind, concurrently=self._autocommit)
+        try:
+            self._execute('CREATE INDEX', query, {})
+        except self._sql.integrity_error as e:
+            if not unique or not self._autocommit:
+                raise
+            qvarn.log.log(
+                'create-index-failed', table_name=table_name,
+                index_name=index_name, exception=str(e))
+            # A failed concurrent build leaves an invalid index, which
+            # would still be kept up to date, and check uniqueness.
+            if self._is_invalid_index(index_name):
+                self._drop_index(index_name)
+            return False
+        # The index may be an invalid one that another process is
+        # building, or failed to build, concurrently.
+        return not self._is_invalid_index(index_name)
+
+    def _is_invalid_index(self, index_name):
+        formatted = self._sql.format_invalid_index_select(index_name)
+        if formatted is None:
+            return False
+        query, values = formatted
         cursor = self._execute('SELECT', query, values)
+        return cursor.fetchone() is not None
+
+    def _drop_index(self, index_name):
+        query = self._sql.format_drop_index(
+            index_name, concurrently=self._autocommit)
+        self._execute('DROP INDEX', query, {})
+
+    def select(self, table_name, column_names, select_condition,
+               table_plan=None):
+        if table_plan is None:
+            query, values = self._sql.format_select(
+                table_name, column_names, select_condition)
+        else:
+            key = (
+                'SELECT',
+                tuple(column_names),
+                condition_shape(select_condition),
+            )
+            query = table_plan.get_statement(
+                self._sql, key,
+                lambda: self._sql.format_select(
+                    table_name, column_names, select_condition)[0])
+            values = self._sql.format_condition_values(select_condition)
+        # Planned selects are the ones executed over and over again,
+        # so they're worth preparing.
+        cursor = self._execute(
+            'SELECT', query, values, prepared=table_plan is not None)
         with self._measurement.new('fetch-rows') as m:
             rows = self._construct_row_dicts(column_names, cursor)
             m.note(row_count=len(rows))
         return rows
 
+    def select_iter(self, table_name, column_names, select_condition,
+                    batch_size=None):
+        '''Select rows, and iterate over them.
+
+        This is like ``select``, but rows are fetched from a streaming
+        cursor (see SqlAdapter.get_streaming_cursor) ``batch_size`` at
+        a time, as the caller iterates, so that they don't all need
+        to be in memory at once. The default batch size comes from
+        the SQL adapter.
+
+        '''
+
+        batch_size = batch_size or self._sql.fetch_batch_size
+        query, values = self._sql.format_select(
+            table_name, column_names, select_condition)
+        with self._measurement.new('SELECT (streaming)') as m:
+            cursor = self._sql.get_streaming_cursor(self._conn)
+            cursor.execute(query, values)
+            m.note(query=query, values=values)
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(zip(column_names, row))
+        finally:
+            cursor.close()
+
+    def get_approximate_row_count(self, table_name):
+        '''Return the estimated number of rows in a table.
+
+        The estimate comes from the statistics the database keeps for
+        its query planner, and is cheap to get, but may be out of
+        date. Return None if there is no estimate.
+
+        '''
+
+        formatted = self._sql.format_approximate_row_count(table_name)
+        if formatted is None:
+            return None
+        query, values = formatted
+        cursor = self._execute('SELECT', query, values)
+        row = cursor.fetchone()
+        if row is None or row[0] is None or row[0] < 0:
+            return None
+        return int(row[0])
+
+    def select_outdated_document_ids(self, table_name, document_column,
+                                     after_id, limit):
+        '''Return ids of items without an up to date document.
+
+        See SqlAdapter.format_outdated_documents_select.
+
+        '''
+
+        query, values = self._sql.format_outdated_documents_select(
+            table_name, document_column, after_id, limit)
+        cursor = self._execute('SELECT', query, values)
+        return [row[0] for row in cursor]
+
     def _construct_row_dicts(self, column_names, cursor):
         result = []
         indexes = range(len(column_names))
@@ -134,15 +286,90 @@ class Transaction(object):
             result.append(row_dict)
         return result
 
-    def insert(self, table_name, column_name_values):
-        query = self._sql.format_insert(table_name, column_name_values)
+    def insert(self, table_name, column_name_values, table_plan=None):
+        if table_plan is None:
+            query = self._sql.format_insert(table_name, column_name_values)
+        else:
+            key = ('INSERT', tuple(column_name_values))
+            query = table_plan.get_statement(
+                self._sql, key,
+                lambda: self._sql.format_insert(
+                    table_name, column_name_values))
         self._execute('INSERT', query, column_name_values)
 
-    def update(self, table_name, select_conditions, column_name_values):
-        query, values = self._sql.format_update(
-            table_name, select_conditions, column_name_values)
-        self._execute('UPDATE', query, values)
+    def insert_many(self, table_name, column_names, rows, table_plan=None):
+        '''Insert many rows into a table, with as few statements as possible.
+
+        ``rows`` is a list of dicts with values for ``column_names``.
 
-    def delete(self, table_name, select_conditions):
-        query, values = self._sql.format_delete(table_name, select_conditions)
+        '''
+
+        if not rows:
+            return
+        if table_plan is None:
+            query = self._sql.format_insert_many(table_name, column_names)
+        else:
+            key = ('INSERT MANY', tuple(column_names))
+            query = table_plan.get_statement(
+                self._sql, key,
+                lambda: self._sql.format_insert_many(
+                    table_name, column_names))
+        with self._measurement.new('INSERT') as m:
+            c = self._conn.cursor()
+            self._sql.execute_many(c, query, column_names, rows)
+            m.note(query=query, row_count=len(rows))
+
+    def update(self, table_name, select_conditions, column_name_values,
+               table_plan=None):
+        '''Update rows, and return the number of rows that matched.'''
+        if table_plan is None:
+            query, values = self._sql.format_update(
+                table_name, select_conditions, column_name_values)
+        else:
+            key = (
+                'UPDATE',
+                tuple(column_name_values),
+                condition_shape(select_conditions),
+            )
+            query = table_plan.get_statement(
+                self._sql, key,
+                lambda: self._sql.format_update(
+                    table_name, select_conditions, column_name_values)[0])
+            values = self._sql.format_condition_values(select_conditions)
+            values.update(column_name_values)
+        cursor = self._execute('UPDATE', query, values)
+        return cursor.rowcount
+
+    def delete(self, table_name, select_conditions, table_plan=None):
+        if table_plan is None:
+            query, values = self._sql.format_delete(
+                table_name, select_conditions)
+        else:
+            key = ('DELETE', condition_shape(select_conditions))
+            query = table_plan.get_statement(
+                self._sql, key,
+                lambda: self._sql.format_delete(
+                    table_name, select_conditions)[0])
+            values = self._sql.format_condition_values(select_conditions)
         self._execute('DELETE', query, values)
+
+
+def condition_shape(condition):
+    '''Return a select condition with the values left out.
+
+    Two conditions with the same shape result in the same SQL text,
+    so the shape can be used to look up a statement formatted
+    earlier. For an 'IN' condition the number of values is kept,
+    since it may affect the number of placeholders.
+
+    '''
+
+    if condition is None:
+        return None
+    op = condition[0]
+    if op == '=':
+        return condition[:3]
+    elif op == 'IN':
+        return condition[:3] + (len(condition[3]),)
+    else:
+        return (op,) + tuple(condition_shape(c) for c in condition[1:])
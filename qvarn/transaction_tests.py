@@ -70,6 +70,34 @@ class TransactionTests(unittest.TestCase):
                 ('OR', ('=', u'foo', u'bar', 0), ('=', u'foo2', u'bar2', 0)))
         self.assertEqual(self.sql.selected_tables, [u'foo'])
 
+    def test_selects_iteratively(self):
+        with self.trans:
+            self.trans.create_table(u'foo', {u'bar': int})
+            for i in range(5):
+                self.trans.insert(u'foo', {u'bar': i})
+            rows = list(self.trans.select_iter(
+                u'foo', [u'bar'], None, batch_size=2))
+        self.assertEqual(
+            sorted(row[u'bar'] for row in rows), [0, 1, 2, 3, 4])
+
+    def test_selects_iteratively_from_streaming_cursor(self):
+        self.sql.set_fetch_batch_size(2)
+        with self.trans:
+            self.trans.create_table(u'foo', {u'bar': int})
+            for i in range(5):
+                self.trans.insert(u'foo', {u'bar': i})
+            rows = list(self.trans.select_iter(u'foo', [u'bar'], None))
+        self.assertEqual(len(rows), 5)
+        cursor = self.sql.streaming_cursors[0]
+        self.assertEqual(cursor.fetch_sizes, [2, 2, 2, 2])
+        self.assertTrue(cursor.closed)
+
+    def test_has_no_approximate_row_count_for_sqlite(self):
+        with self.trans:
+            self.trans.create_table(u'foo', {u'bar': int})
+            self.assertEqual(
+                self.trans.get_approximate_row_count(u'foo'), None)
+
     def test_inserts(self):
         with self.trans:
             self.trans.create_table(u'foo', {u'bar': int})
@@ -96,6 +124,27 @@ class TransactionTests(unittest.TestCase):
         self.assertEqual(self.sql.deleted_tables, [u'foo'])
         self.assertEqual(rows, [])
 
+    def test_formats_planned_statements_once(self):
+        table = qvarn.TablePlan(u'foo', [u'bar'])
+        with self.trans:
+            self.trans.create_table(u'foo', {u'bar': int})
+            self.trans.insert(u'foo', {u'bar': 1}, table_plan=table)
+            self.trans.insert(u'foo', {u'bar': 2}, table_plan=table)
+            rows = self.trans.select(
+                u'foo', [u'bar'], ('=', u'foo', u'bar', 2), table_plan=table)
+            self.trans.select(
+                u'foo', [u'bar'], ('=', u'foo', u'bar', 1), table_plan=table)
+            self.trans.delete(
+                u'foo', ('=', u'foo', u'bar', 1), table_plan=table)
+            self.trans.delete(
+                u'foo', ('=', u'foo', u'bar', 2), table_plan=table)
+            remaining = self.trans.select(u'foo', [u'bar'], None)
+        self.assertEqual(rows, [{u'bar': 2}])
+        self.assertEqual(remaining, [])
+        self.assertEqual(self.sql.inserted_tables, [u'foo'])
+        self.assertEqual(self.sql.selected_tables, [u'foo', u'foo'])
+        self.assertEqual(self.sql.deleted_tables, [u'foo'])
+
 
 class DummyAdapter(qvarn.SqliteAdapter):
 
@@ -109,6 +158,12 @@ class DummyAdapter(qvarn.SqliteAdapter):
         self.inserted_tables = []
         self.updated_tables = []
         self.deleted_tables = []
+        self.streaming_cursors = []
+
+    def get_streaming_cursor(self, conn):
+        cursor = RecordingCursor(conn.cursor())
+        self.streaming_cursors.append(cursor)
+        return cursor
 
     def format_create_table(self, table_name, column_name_types):
         assert table_name not in self.created_tables
@@ -156,3 +211,22 @@ class DummyAdapter(qvarn.SqliteAdapter):
     def _call(self, method_name, *args, **kwargs):
         method = getattr(super(DummyAdapter, self), method_name)
         return method(*args, **kwargs)
+
+
+class RecordingCursor(object):
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.fetch_sizes = []
+        self.closed = False
+
+    def execute(self, query, values):
+        return self._cursor.execute(query, values)
+
+    def fetchmany(self, size):
+        self.fetch_sizes.append(size)
+        return self._cursor.fetchmany(size)
+
+    def close(self):
+        self.closed = True
+        self._cursor.close()
@@ -19,6 +19,7 @@
 '''Random utility functions for the backend.'''
 
 
+import hashlib
 import re
 
 import yaml
@@ -59,6 +60,32 @@ def route_to_scope(route_rule, request_method):
     return route_scope.lower()
 
 
+def revision_etag(revision):
+    '''Return the HTTP ETag header value for an item revision.'''
+    return u'"{}"'.format(revision)
+
+
+def etag_matches(revision, if_none_match):
+    '''Does an If-None-Match header value match an item revision?
+
+    The header value is a comma separated list of entity tags, or
+    ``*``, which matches any revision. Weak tags match too, since
+    the comparison for If-None-Match is the weak one.
+
+    '''
+
+    if not if_none_match:
+        return False
+    etag = revision_etag(revision)
+    for tag in if_none_match.split(u','):
+        tag = tag.strip()
+        if tag.startswith(u'W/'):
+            tag = tag[2:]
+        if tag == u'*' or tag == etag:
+            return True
+    return False
+
+
 def table_name(**kwargs):
     '''Construct a table name.
 
@@ -172,6 +199,45 @@ def table_name(**kwargs):
     assert False
 
 
+def get_case_sensitive_fields(search_spec):
+    '''Return the set of fields that are searched case sensitively.
+
+    ``search_spec`` is the ``search`` part of a resource type spec,
+    or None. Its ``case_sensitive`` list names fields whose values
+    are compared as they are, instead of in lower case, so that plain
+    indexes can be used for them. The resource id is always case
+    sensitive: ids are generated by Qvarn, in lower case.
+
+    '''
+
+    fields = set([u'id'])
+    if search_spec:
+        fields.update(search_spec.get(u'case_sensitive', []))
+    return fields
+
+
+# PostgreSQL truncates longer identifiers.
+MAX_IDENTIFIER_LENGTH = 63
+
+
+def index_name(table, column_names):
+    '''Construct an index name for columns of a table.
+
+    Index names must be unique in the whole database, so the name
+    includes the table name. If the result would be too long for
+    PostgreSQL, it's shortened, and a hash of the full name is added
+    to keep it unique.
+
+    '''
+
+    name = u'{}__idx_{}'.format(table, u'_'.join(column_names))
+    if len(name) > MAX_IDENTIFIER_LENGTH:
+        digest = hashlib.sha1(name.encode('UTF-8')).hexdigest()[:10]
+        name = u'{}_{}'.format(
+            name[:MAX_IDENTIFIER_LENGTH - len(digest) - 1], digest)
+    return name
+
+
 class ComplicatedTableNameError(qvarn.QvarnException):
 
     msg = (u'Internal error: tried to construct a database table name '
@@ -63,6 +63,27 @@ class BasicRouteTests(unittest.TestCase):
             route_scope, u'uapi_orgs_listeners_id_notifications_id_delete')
 
 
+class EtagTests(unittest.TestCase):
+
+    def test_quotes_revision(self):
+        self.assertEqual(qvarn.revision_etag(u'abc'), u'"abc"')
+
+    def test_does_not_match_missing_header(self):
+        self.assertFalse(qvarn.etag_matches(u'abc', None))
+
+    def test_matches_same_revision(self):
+        self.assertTrue(qvarn.etag_matches(u'abc', u'"abc"'))
+
+    def test_does_not_match_other_revision(self):
+        self.assertFalse(qvarn.etag_matches(u'abc', u'"def"'))
+
+    def test_matches_any_in_list(self):
+        self.assertTrue(qvarn.etag_matches(u'abc', u'"def", W/"abc"'))
+
+    def test_matches_star(self):
+        self.assertTrue(qvarn.etag_matches(u'abc', u'*'))
+
+
 class TableNameTests(unittest.TestCase):
 
     def test_returns_correct_name_for_just_resource_type(self):
@@ -129,3 +150,17 @@ class TableNameTests(unittest.TestCase):
             qvarn.table_name(
                 resource_type=u'foo', auxtable=u'aux',
                 list_field='yo', subdict_list_field=u'bar')
+
+
+class IndexNameTests(unittest.TestCase):
+
+    def test_returns_name_with_table_and_columns(self):
+        name = qvarn.index_name(u'foo_bar', [u'id', u'list_pos'])
+        self.assertEqual(name, u'foo_bar__idx_id_list_pos')
+
+    def test_shortens_long_names(self):
+        table = u'foo__path_' + u'x' * 60
+        name = qvarn.index_name(table, [u'id'])
+        self.assertEqual(len(name), 63)
+        self.assertTrue(name.startswith(u'foo__path_xxx'))
+        self.assertNotEqual(name, qvarn.index_name(table, [u'id', u'pos']))
@@ -73,6 +73,22 @@ class ItemValidator(object):
 
         self._validate_dict(prototype, item)
 
+    def validate_fields(self, prototype, fields):
+        '''Validate some fields of an item.
+
+        ``fields`` is a dict with values for some of the fields in
+        the prototype. Unlike with ``validate_item``, other fields may
+        be missing.
+
+        '''
+
+        self._validate_is_dict(fields)
+        extra_keys = set(fields).difference(prototype)
+        if extra_keys:
+            raise UnknownKeys(unknown_keys=list(extra_keys))
+        for field_name in fields:
+            self._validate_field(prototype, fields, field_name)
+
     def _validate_dict(self, prototype, item):
         self._validate_is_dict(prototype)
         self._validate_is_dict(item)
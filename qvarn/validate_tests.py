@@ -125,6 +125,26 @@ class ItemValidatorTests(unittest.TestCase):
                 u'bar': u'this is bar',
             })
 
+    def test_accepts_some_fields_with_correct_types(self):
+        iv = qvarn.ItemValidator()
+        prototype = {
+            u'type': u'',
+            u'foo': u'',
+            u'bar': 0,
+        }
+        self.assertEqual(iv.validate_fields(prototype, {u'bar': 42}), None)
+
+    def test_rejects_some_fields_with_wrong_or_unknown_fields(self):
+        iv = qvarn.ItemValidator()
+        prototype = {
+            u'type': u'',
+            u'foo': u'',
+        }
+        with self.assertRaises(qvarn.ValidationError):
+            iv.validate_fields(prototype, {u'foo': 42})
+        with self.assertRaises(qvarn.ValidationError):
+            iv.validate_fields(prototype, {u'bar': u''})
+
     def test_rejects_item_with_missing_field(self):
         self.assertNotValidItem(
             u'foo-type',
@@ -24,6 +24,24 @@ import sqlalchemy as sa
 import qvarn
 
 
+# Indexes that have been created are remembered in the versions table,
+# with this prefix before the index name.
+INDEX_VERSION_PREFIX = u'index:'
+
+
+Index = collections.namedtuple(
+    'Index',
+    ['table_name', 'index_name', 'column_names', 'unique', 'lower', 'kind'])
+
+
+# Search spec lists of fields that get a special kind of index, and
+# the kind. See SqlAdapter.format_create_index.
+SEARCH_INDEX_KINDS = [
+    (u'startswith', u'pattern'),
+    (u'contains', u'trigram'),
+]
+
+
 class VersionedStorage(object):
 
     '''Prepare storage for different resource type versions.
@@ -55,9 +73,23 @@ class VersionedStorage(object):
         v = Version(version_name, None)
         self._versions.append(v)
 
-    def add_prototype(self, prototype, **kwargs):
+    def add_prototype(self, prototype, search=None, document=False,
+                      **kwargs):
+        '''Add a prototype to the latest version.
+
+        ``search`` is the ``search`` part of the resource type spec,
+        which says which fields get indexes for searching. If
+        ``document`` is true, the main table gets a column for
+        storing whole items as documents (see qvarn.document). Other
+        keyword arguments are given to qvarn.table_name.
+
+        '''
+
         v = self._versions[-1]
-        v.add_prototype(prototype, kwargs)
+        if document:
+            assert not kwargs, 'only main items can be documents'
+            v.document = True
+        v.add_prototype(prototype, kwargs, search or {})
 
     def prepare_storage(self, transaction, tables=None):
         self._prepare_versions_table(transaction)
@@ -78,20 +110,176 @@ class VersionedStorage(object):
     def _get_known_versions(self, transaction):
         rows = transaction.select(
             self._versions_table_name, [u'version'], None)
-        return [row['version'] for row in rows]
+        return [
+            row['version'] for row in rows
+            if not row['version'].startswith(INDEX_VERSION_PREFIX)
+        ]
 
     def _remember_version(self, transaction, version):
         transaction.insert(
             self._versions_table_name, {u'version': version.version})
 
+    def get_indexes(self):
+        '''Return the indexes the tables of the latest version need.
+
+        Every table gets an index on the resource id, so that a
+        resource can be read without scanning whole tables. For
+        tables with one row per resource, the index is unique. Tables
+        for lists also include the list positions in the index, in
+        the order rows are read.
+
+        Fields listed as ``indexed`` in the search spec of a prototype
+        get an index on each column for the field. Text fields that
+        are searched case insensitively are indexed in lower case,
+        since that is how searches compare them.
+
+        Text fields listed as ``startswith`` or ``contains`` get an
+        index that can be used for prefix or substring searches, if
+        the database supports one.
+
+        '''
+
+        if not self._versions:
+            return []
+
+        columns = collections.OrderedDict()
+        field_indexes = []
+        for prototype, kwargs, search in self._versions[-1].prototype_list:
+            indexed = search.get(u'indexed', [])
+            case_sensitive = qvarn.get_case_sensitive_fields(search)
+            schema = qvarn.schema_from_prototype(
+                prototype, resource_type=self._resource_type, **kwargs)
+            for table_name, column_name, column_type in schema:
+                columns.setdefault(table_name, [])
+                if column_name not in columns[table_name]:
+                    columns[table_name].append(column_name)
+                lower = (
+                    column_type == six.text_type and
+                    column_name not in case_sensitive
+                )
+                if column_name in indexed:
+                    field_indexes.append(
+                        make_index(table_name, [column_name], lower=lower))
+                if column_type != six.text_type:
+                    continue
+                for spec_key, kind in SEARCH_INDEX_KINDS:
+                    if column_name in search.get(spec_key, []):
+                        field_indexes.append(make_index(
+                            table_name, [column_name], lower=lower,
+                            kind=kind))
+
+        indexes = []
+        for table_name, column_names in columns.items():
+            pos_columns = [
+                x for x in (u'dict_list_pos', u'list_pos')
+                if x in column_names
+            ]
+            indexes.append(make_index(
+                table_name, [u'id'] + pos_columns, unique=not pos_columns))
+        names = set(index.index_name for index in indexes)
+        for index in field_indexes:
+            if index.index_name not in names:
+                indexes.append(index)
+                names.add(index.index_name)
+        return indexes
+
+    def prepare_indexes(self, transaction):
+        '''Create the indexes the latest version needs.
+
+        This must be called after the tables have been created with
+        ``prepare_storage``, and committed. Each index is created only
+        once: it is remembered in the versions table. If the
+        transaction is in autocommit mode, PostgreSQL builds the
+        indexes concurrently, without blocking writes to the tables.
+
+        Indexes of a kind the database doesn't support are skipped,
+        and not remembered. So are indexes that couldn't be built, or
+        are left invalid, such as unique indexes on tables with
+        duplicate rows; they are tried again the next time.
+
+        '''
+
+        rows = transaction.select(
+            self._versions_table_name, [u'version'], None)
+        known = set(row['version'] for row in rows)
+        for index in self.get_indexes():
+            version = INDEX_VERSION_PREFIX + index.index_name
+            if version not in known:
+                qvarn.log.log(
+                    'create-index', resource_type=self._resource_type,
+                    table_name=index.table_name,
+                    index_name=index.index_name)
+                created = transaction.create_index(
+                    index.table_name, index.index_name, index.column_names,
+                    unique=index.unique, lower=index.lower, kind=index.kind)
+                if created:
+                    transaction.insert(
+                        self._versions_table_name, {u'version': version})
+                    known.add(version)
+
+    def prepare_documents(self, dbconn):
+        '''Store documents for items that don't have an up to date one.
+
+        This is needed when documents have been enabled for a resource
+        type that already has items, or were disabled for a while.
+        Only the items that need a document are selected by the
+        database. They are read from the tables for their fields, and
+        their documents stored, in batches, each batch in its own
+        transaction in ``dbconn``.
+
+        '''
+
+        if not self._versions or not self._versions[-1].document:
+            return
+
+        prototype = self._get_main_prototype(self._versions[-1])
+        table_name = qvarn.table_name(resource_type=self._resource_type)
+        ro = qvarn.ReadOnlyStorage()
+        ro.set_item_prototype(self._resource_type, prototype)
+
+        # Go through the items in id order, so that items that can't
+        # be given a document, such as ones deleted meanwhile, are
+        # only tried once.
+        item_count = 0
+        after_id = None
+        while True:
+            with dbconn.transaction() as t:
+                batch = t.select_outdated_document_ids(
+                    table_name, qvarn.DOCUMENT_COLUMN, after_id,
+                    ro.items_per_batch)
+                for item in ro.get_items(t, batch):
+                    t.update(
+                        table_name, ('=', table_name, u'id', item[u'id']),
+                        {qvarn.DOCUMENT_COLUMN: qvarn.encode_document(item)})
+            if not batch:
+                break
+            item_count += len(batch)
+            after_id = batch[-1]
+
+        qvarn.log.log(
+            'prepare-documents', resource_type=self._resource_type,
+            item_count=item_count)
+
+    def _get_main_prototype(self, version):
+        for prototype, kwargs, _ in version.prototype_list:
+            if not kwargs:
+                return prototype
+        return None
+
     def _prepare_version(self, transaction, version, tables):
         # Collect what is missing.
         create_tables = collections.defaultdict(dict)
         create_columns = collections.defaultdict(dict)
         change_columns = collections.defaultdict(dict)
-        for prototype, kwargs in version.prototype_list:
+        for prototype, kwargs, _ in version.prototype_list:
             schema = qvarn.schema_from_prototype(
                 prototype, resource_type=self._resource_type, **kwargs)
+            if version.document and not kwargs:
+                schema.append((
+                    qvarn.table_name(resource_type=self._resource_type),
+                    qvarn.DOCUMENT_COLUMN,
+                    dict,
+                ))
             for table_name, column_name, column_type in schema:
 
                 # Create table
@@ -133,9 +321,22 @@ class Version(object):
         self.version = version
         self.func = update_data_func
         self.prototype_list = []
-
-    def add_prototype(self, prototype, kwargs):
-        self.prototype_list.append((prototype, kwargs))
+        self.document = False
+
+    def add_prototype(self, prototype, kwargs, search):
+        self.prototype_list.append((prototype, kwargs, search))
+
+
+def make_index(table_name, column_names, unique=False, lower=False,
+               kind=None):
+    name_parts = list(column_names)
+    if lower:
+        name_parts = [u'lower_' + x for x in column_names]
+    if kind is not None:
+        name_parts.append(kind)
+    return Index(
+        table_name, qvarn.index_name(table_name, name_parts),
+        column_names, unique, lower, kind)
 
 
 def get_current_tables(transaction):
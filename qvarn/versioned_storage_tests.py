@@ -169,6 +169,229 @@ class VersionedStorageTests(unittest.TestCase):
                 'rt_items_lst': ['dict_list_pos', 'id', 'list_pos', 'lst'],
             })
 
+    def test_prepares_indexes(self):
+        vs = qvarn.VersionedStorage()
+        vs.set_resource_type(u'rt')
+        vs.start_version(u'v1')
+        vs.add_prototype({
+            u'type': u'',
+            u'id': u'',
+            u'items': [{
+                u'str': u'',
+                u'lst': [u''],
+            }]
+        })
+        vs.add_prototype(
+            qvarn.notification_prototype, search=qvarn.notification_search,
+            auxtable=u'notification')
+        with self.dbconn.transaction() as t:
+            vs.prepare_storage(t)
+        with self.dbconn.transaction(autocommit=True) as t:
+            vs.prepare_indexes(t)
+            self.assertIndexes(t, 'rt', [(['id'], True)])
+            self.assertIndexes(t, 'rt_items', [(['id', 'list_pos'], False)])
+            self.assertIndexes(t, 'rt_items_lst', [
+                (['id', 'dict_list_pos', 'list_pos'], False),
+            ])
+            self.assertIndexes(t, 'rt__aux_notification', [
+                (['id'], True),
+                (['listener_id'], False),
+            ])
+            self.assertVersions(t, 'rt', ['v1'] + [
+                u'index:' + index.index_name for index in vs.get_indexes()
+            ])
+
+    def test_prepares_indexes_for_searched_fields(self):
+        vs = qvarn.VersionedStorage()
+        vs.set_resource_type(u'rt')
+        vs.start_version(u'v1')
+        vs.add_prototype(
+            {
+                u'type': u'',
+                u'id': u'',
+                u'name': u'',
+                u'code': u'',
+                u'count': 0,
+                u'tags': [u''],
+            },
+            search={
+                u'indexed': [u'name', u'code', u'count', u'tags'],
+                u'case_sensitive': [u'code'],
+            })
+        with self.dbconn.transaction() as t:
+            vs.prepare_storage(t)
+        with self.dbconn.transaction() as t:
+            vs.prepare_indexes(t)
+            self.assertIndexes(t, 'rt', [
+                (['<expr>'], False),
+                (['code'], False),
+                (['count'], False),
+                (['id'], True),
+            ])
+            self.assertIndexes(t, 'rt_tags', [
+                (['<expr>'], False),
+                (['id', 'list_pos'], False),
+            ])
+            names = [index.index_name for index in vs.get_indexes()]
+            self.assertIn(u'rt__idx_lower_name', names)
+            self.assertIn(u'rt_tags__idx_lower_tags', names)
+
+    def test_skips_search_indexes_sqlite_does_not_support(self):
+        vs = qvarn.VersionedStorage()
+        vs.set_resource_type(u'rt')
+        vs.start_version(u'v1')
+        vs.add_prototype(
+            {u'type': u'', u'id': u'', u'name': u''},
+            search={u'startswith': [u'name'], u'contains': [u'name']})
+        with self.dbconn.transaction() as t:
+            vs.prepare_storage(t)
+        with self.dbconn.transaction() as t:
+            vs.prepare_indexes(t)
+            self.assertIndexes(t, 'rt', [(['id'], True)])
+            self.assertVersions(t, 'rt', ['v1', u'index:rt__idx_id'])
+
+    def test_prepares_indexes_once(self):
+        vs = qvarn.VersionedStorage()
+        vs.set_resource_type(u'rt')
+        vs.start_version(u'v1')
+        vs.add_prototype({u'type': u'', u'id': u'', u'foo': u''})
+        with self.dbconn.transaction() as t:
+            vs.prepare_storage(t)
+        with self.dbconn.transaction() as t:
+            vs.prepare_indexes(t)
+            vs.prepare_indexes(t)
+            self.assertVersions(t, 'rt', ['v1', u'index:rt__idx_id'])
+
+    def test_skips_unique_index_on_duplicate_rows(self):
+        vs = qvarn.VersionedStorage()
+        vs.set_resource_type(u'rt')
+        vs.start_version(u'v1')
+        vs.add_prototype({u'type': u'', u'id': u'', u'foo': u''})
+        with self.dbconn.transaction() as t:
+            vs.prepare_storage(t)
+            t.insert(u'rt', {u'id': u'dup', u'type': u'rt', u'foo': u'a'})
+            t.insert(u'rt', {u'id': u'dup', u'type': u'rt', u'foo': u'b'})
+        with self.dbconn.transaction(autocommit=True) as t:
+            vs.prepare_indexes(t)
+            self.assertIndexes(t, 'rt', [])
+            self.assertVersions(t, 'rt', ['v1'])
+
+        with self.dbconn.transaction() as t:
+            t.delete(u'rt', ('=', u'rt', u'foo', u'b'))
+        with self.dbconn.transaction(autocommit=True) as t:
+            vs.prepare_indexes(t)
+            self.assertIndexes(t, 'rt', [(['id'], True)])
+            self.assertVersions(t, 'rt', ['v1', u'index:rt__idx_id'])
+
+        # Indexes are not versions.
+        vs.start_version(u'v2')
+        vs.add_prototype({u'type': u'', u'id': u'', u'bar': u''})
+        with self.dbconn.transaction() as t:
+            vs.prepare_storage(t)
+            self.assertVersions(
+                t, 'rt', ['v1', u'index:rt__idx_id', 'v2'])
+
+    def test_adds_document_column(self):
+        vs = qvarn.VersionedStorage()
+        vs.set_resource_type(u'rt')
+        vs.start_version(u'v1')
+        vs.add_prototype(
+            {u'type': u'', u'id': u'', u'foo': u''}, document=True)
+        with self.dbconn.transaction() as t:
+            vs.prepare_storage(t)
+            self.assertEqual(
+                qvarn.get_current_tables(t)[u'rt'][qvarn.DOCUMENT_COLUMN],
+                dict)
+
+    def test_prepares_documents_for_items_without_one(self):
+        prototype = {u'type': u'', u'id': u'', u'revision': u'', u'foo': u''}
+        vs = qvarn.VersionedStorage()
+        vs.set_resource_type(u'rt')
+        vs.start_version(u'v1')
+        vs.add_prototype(prototype)
+        with self.dbconn.transaction() as t:
+            vs.prepare_storage(t)
+
+        wo = qvarn.WriteOnlyStorage()
+        wo.set_item_prototype(u'rt', prototype)
+        with self.dbconn.transaction() as t:
+            item = wo.add_item(t, {u'type': u'rt', u'foo': u'bar'})
+
+        vs.start_version(u'v2')
+        vs.add_prototype(prototype, document=True)
+        with self.dbconn.transaction() as t:
+            vs.prepare_storage(t)
+        vs.prepare_documents(self.dbconn)
+        with self.dbconn.transaction() as t:
+            rows = t.select(u'rt', [qvarn.DOCUMENT_COLUMN], None)
+            self.assertEqual(
+                [qvarn.decode_document(row[qvarn.DOCUMENT_COLUMN])
+                 for row in rows],
+                [item])
+
+    def test_prepares_only_outdated_documents_in_batches(self):
+        prototype = {u'type': u'', u'id': u'', u'revision': u'', u'foo': u''}
+        vs = qvarn.VersionedStorage()
+        vs.set_resource_type(u'rt')
+        vs.start_version(u'v1')
+        vs.add_prototype(prototype, document=True)
+        with self.dbconn.transaction() as t:
+            vs.prepare_storage(t)
+
+        wo = qvarn.WriteOnlyStorage()
+        wo.set_item_prototype(u'rt', prototype)
+        with self.dbconn.transaction() as t:
+            items = [
+                wo.add_item(t, {u'type': u'rt', u'foo': six.text_type(i)})
+                for i in range(5)
+            ]
+            # A current document is left as it is, even if it doesn't
+            # match the tables.
+            current = dict(items[0], foo=u'kept')
+            t.update(
+                u'rt', ('=', u'rt', u'id', current[u'id']),
+                {qvarn.DOCUMENT_COLUMN: qvarn.encode_document(current)})
+            for item in items[1:]:
+                t.update(
+                    u'rt', ('=', u'rt', u'id', item[u'id']),
+                    {qvarn.DOCUMENT_COLUMN: None})
+            t.update(
+                u'rt', ('=', u'rt', u'id', items[1][u'id']),
+                {qvarn.DOCUMENT_COLUMN: qvarn.encode_document(
+                    dict(items[1], revision=u'old', foo=u'stale'))})
+
+        items_per_batch = qvarn.ReadOnlyStorage.items_per_batch
+        qvarn.ReadOnlyStorage.items_per_batch = 2
+        try:
+            vs.prepare_documents(self.dbconn)
+        finally:
+            qvarn.ReadOnlyStorage.items_per_batch = items_per_batch
+
+        with self.dbconn.transaction() as t:
+            rows = t.select(u'rt', [u'id', qvarn.DOCUMENT_COLUMN], None)
+            self.assertEqual(
+                sorted(
+                    (qvarn.decode_document(row[qvarn.DOCUMENT_COLUMN])
+                     for row in rows),
+                    key=lambda item: item[u'id']),
+                sorted([current] + items[1:], key=lambda item: item[u'id']))
+            self.assertEqual(
+                t.select_outdated_document_ids(
+                    u'rt', qvarn.DOCUMENT_COLUMN, None, 10),
+                [])
+
+    def assertIndexes(self, transaction, table_name, expected):
+        indexes = []
+        c = transaction.execute(
+            'SELECT', 'PRAGMA index_list({})'.format(table_name), {})
+        for _, index_name, unique in [row[:3] for row in c.fetchall()]:
+            c = transaction.execute(
+                'SELECT', 'PRAGMA index_info({})'.format(index_name), {})
+            # Expressions, such as LOWER(foo), have no column name.
+            columns = [row[2] or '<expr>' for row in c.fetchall()]
+            indexes.append((columns, bool(unique)))
+        self.assertEqual(sorted(indexes), expected)
+
     def assertSchema(self, transaction, expected):
         engine = transaction.get_engine()
         metadata = sa.MetaData()
@@ -252,3 +475,65 @@ def test_field_type_change(dbconn, old, new):
         vs.prepare_storage(t)
 
     assert get_data(dbconn, 'rt', 'field') == [val(new)]
+
+
+def test_prepares_search_indexes(dbconn):
+    dbconn.drop_tables(['rt', 'rt_tags', 'rt__aux_versions'])
+
+    vs = qvarn.VersionedStorage()
+    vs.set_resource_type(u'rt')
+    vs.start_version(u'v1')
+    vs.add_prototype(
+        {u'type': u'', u'id': u'', u'name': u'', u'tags': [u'']},
+        search={
+            u'startswith': [u'name'],
+            u'contains': [u'tags'],
+            u'case_sensitive': [u'tags'],
+        })
+    with dbconn.transaction() as t:
+        vs.prepare_storage(t)
+    with dbconn.transaction(autocommit=True) as t:
+        vs.prepare_indexes(t)
+
+    with dbconn.transaction() as t:
+        c = t.execute(
+            'SELECT',
+            'SELECT indexname, indexdef FROM pg_indexes '
+            'WHERE tablename IN (%(rt)s, %(rt_tags)s)',
+            {'rt': 'rt', 'rt_tags': 'rt_tags'})
+        indexes = dict(c.fetchall())
+    assert 'text_pattern_ops' in indexes['rt__idx_lower_name_pattern']
+    assert 'lower(' in indexes['rt__idx_lower_name_pattern']
+    assert 'gin_trgm_ops' in indexes['rt_tags__idx_tags_trigram']
+
+
+def test_drops_invalid_unique_index(dbconn):
+    dbconn.drop_tables(['rt', 'rt__aux_versions'])
+
+    vs = qvarn.VersionedStorage()
+    vs.set_resource_type(u'rt')
+    vs.start_version(u'v1')
+    vs.add_prototype({u'type': u'', u'id': u'', u'foo': u''})
+    with dbconn.transaction() as t:
+        vs.prepare_storage(t)
+        t.insert(u'rt', {u'id': u'dup', u'type': u'rt', u'foo': u'a'})
+        t.insert(u'rt', {u'id': u'dup', u'type': u'rt', u'foo': u'b'})
+
+    def get_index_names():
+        with dbconn.transaction() as t:
+            c = t.execute(
+                'SELECT',
+                'SELECT indexname FROM pg_indexes WHERE tablename = %(rt)s',
+                {'rt': 'rt'})
+            return [row[0] for row in c.fetchall()]
+
+    # The failed concurrent build leaves no invalid index behind.
+    with dbconn.transaction(autocommit=True) as t:
+        vs.prepare_indexes(t)
+    assert get_index_names() == []
+
+    with dbconn.transaction() as t:
+        t.delete(u'rt', ('=', u'rt', u'foo', u'b'))
+    with dbconn.transaction(autocommit=True) as t:
+        vs.prepare_indexes(t)
+    assert get_index_names() == [u'rt__idx_id']
@@ -16,6 +16,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import collections
+
 import qvarn
 
 
@@ -30,7 +32,10 @@ class WriteOnlyStorage(object):
     def __init__(self):
         self._item_type = None
         self._prototype = None
+        self._plan = None
         self._subitem_prototypes = qvarn.SubItemPrototypes()
+        self._item_cache = None
+        self._documents = False
         self._id_generator = qvarn.ResourceIdGenerator()
         self._revision_id_type = 'revision id'
 
@@ -38,11 +43,29 @@ class WriteOnlyStorage(object):
         '''Set type and prototype for items handled by this instance.'''
         self._item_type = item_type
         self._prototype = prototype
+        self._plan = qvarn.get_item_plan(prototype, resource_type=item_type)
 
     def set_subitem_prototype(self, item_type, subitem_name, prototype):
         '''Set prototype for a subitem.'''
         self._subitem_prototypes.add(item_type, subitem_name, prototype)
 
+    def set_item_cache(self, item_cache):
+        '''Set a qvarn.ItemCache to invalidate when items change.'''
+        self._item_cache = item_cache
+
+    def set_document_storage(self, enabled):
+        '''Also store each item as a document in the main table.
+
+        See qvarn.document.
+
+        '''
+
+        self._documents = enabled
+
+    def _invalidate_cached_item(self, item_id):
+        if self._item_cache is not None:
+            self._item_cache.invalidate(self._item_type, item_id)
+
     def add_item(self, transaction, item):
         '''Add an item to the database.
 
@@ -52,55 +75,189 @@ class WriteOnlyStorage(object):
 
         '''
 
-        if u'id' in item:
-            raise CannotAddWithId(id=item[u'id'])
-        if u'revision' in item:
-            raise CannotAddWithRevision(revision=item[u'revision'])
+        return self.add_items(transaction, [item])[0]
 
-        added = dict(item)
-        added[u'id'] = self._id_generator.new_id(self._item_type)
-        added[u'revision'] = self._id_generator.new_id(self._revision_id_type)
+    def add_items(self, transaction, items):
+        '''Add many items to the database.
 
-        self._insert_item_into_database(transaction, added)
-        for subitem_name, prototype in self._subitem_prototypes.get_all():
-            self._insert_subitem_into_database(
-                transaction, added[u'id'], subitem_name, prototype)
-        return added
+        This is like ``add_item``, but the rows of all the items are
+        inserted together, one statement per table. A list of the
+        added items is returned, in the same order.
+
+        '''
 
-    def _insert_item_into_database(self, transaction, item):
-        ww = WriteWalker(transaction, self._item_type, item[u'id'])
+        for item in items:
+            if u'id' in item:
+                raise CannotAddWithId(id=item[u'id'])
+            if u'revision' in item:
+                raise CannotAddWithRevision(revision=item[u'revision'])
+
+        rows = RowBuffer()
+        added_items = []
+        for item in items:
+            added = dict(item)
+            added[u'id'] = self._id_generator.new_id(self._item_type)
+            added[u'revision'] = self._id_generator.new_id(
+                self._revision_id_type)
+
+            self._insert_item_into_database(transaction, added, rows=rows)
+            for subitem_name, prototype in self._subitem_prototypes.get_all():
+                self._insert_subitem_into_database(
+                    transaction, added[u'id'], subitem_name, prototype,
+                    rows=rows)
+            added_items.append(added)
+
+        rows.flush(transaction)
+        return added_items
+
+    def _insert_item_into_database(self, transaction, item, rows=None):
+        extra_columns = None
+        if self._documents:
+            extra_columns = {
+                qvarn.DOCUMENT_COLUMN: qvarn.encode_document(item),
+            }
+        ww = WriteWalker(
+            transaction, self._item_type, item[u'id'], plan=self._plan,
+            extra_columns=extra_columns, rows=rows)
         ww.walk_item(item, self._prototype)
 
     def _insert_subitem_into_database(self, transaction, item_id,
-                                      subitem_name, subitem):
+                                      subitem_name, subitem, rows=None):
         prototype = self._subitem_prototypes.get(self._item_type, subitem_name)
         table_name = qvarn.table_name(
             resource_type=self._item_type, subpath=subitem_name)
-        ww = WriteWalker(transaction, table_name, item_id)
+        plan = qvarn.get_item_plan(prototype, resource_type=table_name)
+        ww = WriteWalker(
+            transaction, table_name, item_id, plan=plan, rows=rows)
         ww.walk_item(subitem, prototype)
 
     def update_item(self, transaction, item):
         '''Update an existing item.
 
-        The item MUST have an id set.
+        The item MUST have an id set, and its revision MUST be the
+        current revision of the item.
 
         '''
 
-        current = self._get_current_revision(transaction, item[u'id'])
-        if current != item[u'revision']:
-            raise qvarn.WrongRevision(
-                item_id=item[u'id'],
-                current=current,
-                update=item[u'revision'])
-
         updated = item.copy()
         updated[u'revision'] = self._id_generator.new_id(
             self._revision_id_type)
+        self._invalidate_cached_item(item[u'id'])
+        self._update_item_in_database(transaction, updated, item[u'revision'])
+        return updated
+
+    def _update_item_in_database(self, transaction, item, revision):
+        # Rather than deleting all the rows of the item and inserting
+        # them again, compare the rows the item has now with the rows
+        # it should have, table by table, and only change what's
+        # different. Rows are identified by their position columns, so
+        # the result is the same as if everything had been rewritten.
+        extra_columns = {}
+        if self._documents:
+            extra_columns[qvarn.DOCUMENT_COLUMN] = (
+                qvarn.encode_document(item))
+        collector = RowCollector(
+            self._item_type, item[u'id'], plan=self._plan,
+            extra_columns=extra_columns)
+        collector.walk_item(item, self._prototype)
+
+        # The main table has one row, and it's written by the same
+        # statement that checks the revision.
+        main = self._plan.main
+        row = collector.get_rows(main)[()]
+        values = dict((x, row[x]) for x in row if x != u'id')
+        self._update_main_row(transaction, item[u'id'], revision, values)
+
+        for table in self._plan.tables:
+            if table is not main:
+                self._update_table_rows(
+                    transaction, table, item[u'id'],
+                    collector.get_rows(table))
+
+    def _update_table_rows(self, transaction, table, item_id, new_rows):
+        key_names = list(table.pos_columns)
+        value_names = [x for x in table.columns if x != u'id']
+        match_id = ('=', table.name, u'id', item_id)
+
+        old_rows = {}
+        rows = transaction.select(
+            table.name, key_names + value_names, match_id, table_plan=table)
+        for row in rows:
+            old_rows[tuple(row[x] for x in key_names)] = row
+
+        if not new_rows:
+            if old_rows:
+                transaction.delete(table.name, match_id, table_plan=table)
+            return
+
+        for key in old_rows:
+            if key not in new_rows:
+                transaction.delete(
+                    table.name, self._match_row(table, match_id, key),
+                    table_plan=table)
+
+        added = []
+        for key, columns in new_rows.items():
+            old = old_rows.get(key)
+            if old is None:
+                added.append(columns)
+                continue
+            changed = dict(
+                (x, columns[x]) for x in value_names if columns[x] != old[x])
+            if changed:
+                transaction.update(
+                    table.name, self._match_row(table, match_id, key),
+                    changed, table_plan=table)
+        if added:
+            transaction.insert_many(
+                table.name, sorted(added[0]), added, table_plan=table)
+
+    def _match_row(self, table, match_id, key):
+        if not key:
+            return match_id
+        conds = [
+            ('=', table.name, name, value)
+            for name, value in zip(table.pos_columns, key)
+        ]
+        return ('AND', match_id) + tuple(conds)
+
+    def update_items_fields(self, transaction, item_ids, fields):
+        '''Set the same fields of many items to the same values.
+
+        ``fields`` is a dict of new values for fields that are in the
+        main table of the item, i.e., not lists. The caller must have
+        validated them. Each item gets a new revision. Return a list
+        of (item id, new revision) pairs.
 
-        self._delete_item_in_transaction(
-            transaction, item[u'id'], delete_subitems=False)
+        '''
 
-        self._insert_item_into_database(transaction, updated)
+        table = self._plan.main
+        documents = {}
+        if self._documents:
+            for batch in _batches(item_ids):
+                rows = transaction.select(
+                    table.name, [u'id', u'revision', qvarn.DOCUMENT_COLUMN],
+                    ('IN', table.name, u'id', batch))
+                for row in rows:
+                    documents[row[u'id']] = row
+
+        updated = []
+        for item_id in item_ids:
+            revision = self._id_generator.new_id(self._revision_id_type)
+            values = dict(fields)
+            values[u'revision'] = revision
+            row = documents.get(item_id)
+            if row is not None and row[qvarn.DOCUMENT_COLUMN] is not None:
+                # Keep the document up to date, so that it can still
+                # be used, if it was up to date before.
+                values[qvarn.DOCUMENT_COLUMN] = _refresh_document(
+                    row[qvarn.DOCUMENT_COLUMN], row[u'revision'],
+                    dict(values))
+            transaction.update(
+                table.name, ('=', table.name, u'id', item_id), values,
+                table_plan=table)
+            self._invalidate_cached_item(item_id)
+            updated.append((item_id, revision))
         return updated
 
     def _get_current_revision(self, transaction, item_id):
@@ -113,16 +270,14 @@ class WriteOnlyStorage(object):
 
     def update_subitem(self, transaction, item_id, revision, subitem_name,
                        subitem):
-        current_revision = self._get_current_revision(transaction, item_id)
-        if current_revision != revision:
-            raise qvarn.WrongRevision(
-                item_id=item_id,
-                current=current_revision,
-                update=revision)
-
         # Update revision of main item.
         new_revision = self._id_generator.new_id(self._revision_id_type)
-        self._update_revision(transaction, item_id, new_revision)
+        self._update_main_row(
+            transaction, item_id, revision, {u'revision': new_revision})
+        if self._documents:
+            self._update_document_revision(
+                transaction, item_id, revision, new_revision)
+        self._invalidate_cached_item(item_id)
 
         # Add or replace subitem.
         self._delete_subitem_in_transaction(
@@ -132,36 +287,114 @@ class WriteOnlyStorage(object):
 
         return new_revision
 
-    def _update_revision(self, transaction, item_id, new_revision):
-        table_name = qvarn.table_name(resource_type=self._item_type)
-        match_columns = ('=', table_name, u'id', item_id)
-        values = {
-            u'revision': new_revision,
-        }
-        transaction.update(table_name, match_columns, values)
+    def _update_main_row(self, transaction, item_id, revision, values):
+        # Update the main table row of the item, but only if the item
+        # still has the revision the caller has. This is a single
+        # statement, so there's no window for another writer between
+        # checking and changing the revision: a concurrent update of
+        # the same item waits for the row, and then finds the revision
+        # has changed.
+        table = self._plan.main
+        match_columns = (
+            'AND',
+            ('=', table.name, u'id', item_id),
+            ('=', table.name, u'revision', revision),
+        )
+        count = transaction.update(
+            table.name, match_columns, values, table_plan=table)
+        if count == 0:
+            # Find out why, to give the right error.
+            current = self._get_current_revision(transaction, item_id)
+            if current is None:
+                raise qvarn.ItemDoesNotExist(item_id=item_id)
+            raise qvarn.WrongRevision(
+                item_id=item_id, current=current, update=revision)
+
+    def _update_document_revision(self, transaction, item_id, revision,
+                                  new_revision):
+        # Keep the document up to date, so that it can still be used,
+        # if it was up to date before.
+        table = self._plan.main
+        match_columns = ('=', table.name, u'id', item_id)
+        rows = transaction.select(
+            table.name, [qvarn.DOCUMENT_COLUMN], match_columns)
+        for row in rows:
+            if row[qvarn.DOCUMENT_COLUMN] is None:
+                continue
+            values = {
+                qvarn.DOCUMENT_COLUMN: _refresh_document(
+                    row[qvarn.DOCUMENT_COLUMN], revision,
+                    {u'revision': new_revision}),
+            }
+            transaction.update(table.name, match_columns, values)
 
     def delete_item(self, transaction, item_id):
         '''Delete an item given its id.'''
         self._delete_item_in_transaction(transaction, item_id)
+        self._invalidate_cached_item(item_id)
+
+    def delete_items(self, transaction, item_ids):
+        '''Delete many items given their ids.
 
-    def _delete_item_in_transaction(self, transaction, item_id,
-                                    delete_subitems=True):
-        dw = DeleteWalker(transaction, self._item_type, item_id)
+        The rows of all the items are deleted with one statement per
+        table, for each batch of ids.
+
+        '''
+
+        tables = list(self._plan.tables)
+        for subitem_name, prototype in self._subitem_prototypes.get_all():
+            table_name = qvarn.table_name(
+                resource_type=self._item_type, subpath=subitem_name)
+            plan = qvarn.get_item_plan(prototype, resource_type=table_name)
+            tables.extend(plan.tables)
+
+        for batch in _batches(item_ids):
+            for table in tables:
+                transaction.delete(
+                    table.name, ('IN', table.name, u'id', batch))
+        for item_id in item_ids:
+            self._invalidate_cached_item(item_id)
+
+    def _delete_item_in_transaction(self, transaction, item_id):
+        dw = DeleteWalker(
+            transaction, self._item_type, item_id, plan=self._plan)
         dw.walk_item(self._prototype, self._prototype)
-        if delete_subitems:
-            for subitem_name, _ in self._subitem_prototypes.get_all():
-                self._delete_subitem_in_transaction(
-                    transaction, item_id, subitem_name)
+        for subitem_name, _ in self._subitem_prototypes.get_all():
+            self._delete_subitem_in_transaction(
+                transaction, item_id, subitem_name)
 
     def _delete_subitem_in_transaction(self, transaction, item_id,
                                        subitem_name):
         table_name = qvarn.table_name(
             resource_type=self._item_type, subpath=subitem_name)
         prototype = self._subitem_prototypes.get(self._item_type, subitem_name)
-        dw = DeleteWalker(transaction, table_name, item_id)
+        plan = qvarn.get_item_plan(prototype, resource_type=table_name)
+        dw = DeleteWalker(transaction, table_name, item_id, plan=plan)
         dw.walk_item(prototype, prototype)
 
 
+def _refresh_document(document, revision, values):
+    # Return a stored document with new values for some fields, ready
+    # to be stored again. A document that wasn't for ``revision``, the
+    # revision the item had, is out of date: it may have been written
+    # while documents were disabled, or by a process that doesn't
+    # store them. Changing its revision would make it look current,
+    # so None is returned instead, and the item is read from the
+    # tables for its fields until the document is prepared again.
+    item = qvarn.decode_document(document)
+    if item is None or item.get(u'revision') != revision:
+        return None
+    item.update(values)
+    return qvarn.encode_document(item)
+
+
+def _batches(item_ids, batch_size=500):
+    # Split ids into batches, so that statements with a placeholder
+    # per id stay within the limits of the database.
+    for i in range(0, len(item_ids), batch_size):
+        yield item_ids[i:i + batch_size]
+
+
 class CannotAddWithId(qvarn.BadRequest):
 
     msg = u"Object being added already has an id"
@@ -179,28 +412,51 @@ class WrongRevision(qvarn.Conflict):
            'update wants to update {update}')
 
 
-class WriteWalker(qvarn.ItemWalker):
+class WriteWalker(qvarn.PlannedWalker):
+
+    '''Visit every part of an item to write it to database.
 
-    '''Visit every part of an item to write it to database.'''
+    ``extra_columns`` is a dict of values for columns that aren't
+    fields of the item, to put in the row of the main table.
 
-    def __init__(self, transaction, item_type, item_id):
+    Rows are collected per table during the walk, and each table's
+    rows are inserted together at the end, with
+    Transaction.insert_many. If ``rows`` is given, it's a RowBuffer
+    shared with other walkers, and the caller inserts the rows by
+    flushing it.
+
+    '''
+
+    def __init__(self, transaction, item_type, item_id, plan=None,
+                 extra_columns=None, rows=None):
         self._transaction = transaction
         self._item_type = item_type
         self._item_id = item_id
+        self._plan = plan
+        self._extra_columns = extra_columns or {}
+        self._own_rows = rows is None
+        self._rows = RowBuffer() if rows is None else rows
+
+    def walk_item(self, item, proto_item):
+        super(WriteWalker, self).walk_item(item, proto_item)
+        if self._own_rows:
+            self._rows.flush(self._transaction)
+
+    def _insert(self, table, columns):
+        self._rows.add(table, columns)
 
     def visit_main_dict(self, item, column_names):
         columns = dict((x, item[x]) for x in column_names)
         if u'id' not in column_names:
             columns[u'id'] = self._item_id
-        self._transaction.insert(self._item_type, columns)
+        columns.update(self._extra_columns)
+        self._insert(self._get_table(), columns)
 
     def visit_main_str_list(self, item, field):
-        table_name = qvarn.table_name(
-            resource_type=self._item_type, list_field=field)
-        self._insert_str_list(table_name, field, self._item_id, None,
-                              item[field])
+        table = self._get_table(list_field=field)
+        self._insert_str_list(table, field, self._item_id, None, item[field])
 
-    def _insert_str_list(self, table_name, column_name, item_id, dict_list_pos,
+    def _insert_str_list(self, table, column_name, item_id, dict_list_pos,
                          strings):
         prefix = {
             u'id': item_id,
@@ -211,34 +467,28 @@ class WriteWalker(qvarn.ItemWalker):
             columns = dict(prefix)
             columns[u'list_pos'] = i
             columns[column_name] = str_value
-            self._transaction.insert(table_name, columns)
+            self._insert(table, columns)
 
     def visit_dict_in_list(self, item, field, pos, column_names):
-        table_name = qvarn.table_name(
-            resource_type=self._item_type, list_field=field)
         columns = {
             u'id': self._item_id,
             u'list_pos': pos,
         }
         for column_name in column_names:
             columns[column_name] = item[field][pos][column_name]
-        self._transaction.insert(table_name, columns)
+        self._insert(self._get_table(list_field=field), columns)
 
     def visit_dict_in_list_str_list(self, item, field, pos, str_list_field):
-        table_name = qvarn.table_name(
-            resource_type=self._item_type,
-            list_field=field,
-            subdict_list_field=str_list_field)
+        table = self._get_table(
+            list_field=field, subdict_list_field=str_list_field)
         strings = item[field][pos][str_list_field]
-        self._insert_str_list(table_name, str_list_field, self._item_id,
+        self._insert_str_list(table, str_list_field, self._item_id,
                               pos, strings)
 
     def visit_dict_in_inner_list(self, item, field, outer_pos, inner_field,
                                  inner_pos, column_names):
-        table_name = qvarn.table_name(
-            resource_type=self._item_type,
-            list_field=field,
-            subdict_list_field=inner_field)
+        table = self._get_table(
+            list_field=field, subdict_list_field=inner_field)
         columns = {
             u'id': self._item_id,
             u'dict_list_pos': outer_pos,
@@ -247,44 +497,109 @@ class WriteWalker(qvarn.ItemWalker):
         inner_dict = item[field][outer_pos][inner_field][inner_pos]
         for column_name in column_names:
             columns[column_name] = inner_dict[column_name]
-        self._transaction.insert(table_name, columns)
+        self._insert(table, columns)
+
+    def visit_dict_in_inner_list_str_list(self, item, outer_field, outer_pos,
+                                          inner_field, inner_pos,
+                                          str_list_field):
+        table = self._get_table(
+            list_field=outer_field,
+            subdict_list_field=inner_field,
+            inner_dict_list_field=str_list_field)
+        inner_dict = item[outer_field][outer_pos][inner_field][inner_pos]
+        for i, str_value in enumerate(inner_dict.get(str_list_field, [])):
+            columns = {
+                u'id': self._item_id,
+                u'dict_list_pos': outer_pos,
+                u'list_pos': inner_pos,
+                u'str_list_pos': i,
+                str_list_field: str_value,
+            }
+            self._insert(table, columns)
+
+
+class RowBuffer(object):
+
+    '''Rows waiting to be inserted, grouped by table and columns.'''
+
+    def __init__(self):
+        self._pending = collections.OrderedDict()
 
+    def add(self, table, columns):
+        '''Add a row, as a dict of column values, to insert into a table.'''
+        key = (table.name, tuple(sorted(columns)))
+        if key not in self._pending:
+            self._pending[key] = (table, [])
+        self._pending[key][1].append(columns)
 
-class DeleteWalker(qvarn.ItemWalker):
+    def flush(self, transaction):
+        '''Insert all rows, with one Transaction.insert_many per table.'''
+        for (_, column_names), (table, rows) in self._pending.items():
+            transaction.insert_many(
+                table.name, list(column_names), rows, table_plan=table)
+        self._pending.clear()
+
+
+class RowCollector(WriteWalker):
+
+    '''Collect the rows an item would be written as, without writing.
+
+    The item is walked like by WriteWalker, but instead of inserting
+    rows, they are collected per table, each identified by the values
+    of the table's position columns. The walker must have a plan.
+
+    '''
+
+    def __init__(self, item_type, item_id, plan, extra_columns=None):
+        super(RowCollector, self).__init__(
+            None, item_type, item_id, plan=plan, extra_columns=extra_columns)
+        self._collected = {}
+
+    def get_rows(self, table):
+        '''Return the rows of a table as a dict keyed by position.'''
+        return self._collected.get(table.name, {})
+
+    def _insert(self, table, columns):
+        key = tuple(columns[x] for x in table.pos_columns)
+        self._collected.setdefault(table.name, {})[key] = columns
+
+
+class DeleteWalker(qvarn.PlannedWalker):
 
     '''Visit every part of an item when deleting it.'''
 
-    def __init__(self, transaction, item_type, item_id):
+    def __init__(self, transaction, item_type, item_id, plan=None):
         self._transaction = transaction
         self._item_type = item_type
         self._item_id = item_id
+        self._plan = plan
 
     def visit_main_dict(self, item, column_names):
-        self._delete_rows(self._item_type, self._item_id)
+        self._delete_rows(self._get_table())
 
-    def _delete_rows(self, table_name, item_id):
-        self._transaction.delete(table_name, ('=', table_name, u'id', item_id))
+    def _delete_rows(self, table):
+        self._transaction.delete(
+            table.name, ('=', table.name, u'id', self._item_id),
+            table_plan=table)
 
     def visit_main_str_list(self, item, field):
-        table_name = qvarn.table_name(
-            resource_type=self._item_type, list_field=field)
-        self._delete_rows(table_name, self._item_id)
+        self._delete_rows(self._get_table(list_field=field))
 
     def visit_main_dict_list(self, item, field, column_names):
-        table_name = qvarn.table_name(
-            resource_type=self._item_type, list_field=field)
-        self._delete_rows(table_name, self._item_id)
+        self._delete_rows(self._get_table(list_field=field))
 
     def visit_dict_in_list_str_list(self, item, field, pos, str_list_field):
-        table_name = qvarn.table_name(
-            resource_type=self._item_type,
-            list_field=field,
-            subdict_list_field=str_list_field)
-        self._delete_rows(table_name, self._item_id)
+        self._delete_rows(self._get_table(
+            list_field=field, subdict_list_field=str_list_field))
 
     def visit_inner_dict_list(self, item, field, inner_field, column_names):
-        table_name = qvarn.table_name(
-            resource_type=self._item_type,
-            list_field=field,
-            subdict_list_field=inner_field)
-        self._delete_rows(table_name, self._item_id)
+        self._delete_rows(self._get_table(
+            list_field=field, subdict_list_field=inner_field))
+
+    def visit_dict_in_inner_list_str_list(self, item, outer_field, outer_pos,
+                                          inner_field, inner_pos,
+                                          str_list_field):
+        self._delete_rows(self._get_table(
+            list_field=outer_field,
+            subdict_list_field=inner_field,
+            inner_dict_list_field=str_list_field))
@@ -122,6 +122,52 @@ class WriteOnlyStorageTests(unittest.TestCase):
             obj = self.get_item_from_disk(t, added)
             self.assertEqual(added, obj)
 
+    def test_inserts_rows_of_each_table_at_once(self):
+        with self.dbconn.transaction() as t:
+            inserts = []
+            insert_many = t.insert_many
+
+            def record(table_name, column_names, rows, **kwargs):
+                inserts.append((table_name, len(rows)))
+                return insert_many(table_name, column_names, rows, **kwargs)
+
+            t.insert_many = record
+            added = self.wo.add_item(t, self.person)
+            self.assertEqual(
+                sorted(inserts),
+                sorted([
+                    (u'person', 1),
+                    (u'person_aliases', 1),
+                    (u'person_addrs', 2),
+                    (u'person_addrs_lines', 4),
+                    (u'person_addrs_inner', 2),
+                    (u'person__path_secret', 1),
+                ]))
+            obj = self.get_item_from_disk(t, added)
+            self.assertEqual(added, obj)
+
+    def test_invalidates_cached_item(self):
+        cache = qvarn.ItemCache(10)
+        self.ro.set_item_cache(cache)
+        self.wo.set_item_cache(cache)
+        with self.dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.person)
+            self.ro.get_item(t, added[u'id'])
+            self.assertEqual(len(cache), 1)
+
+            updated = self.wo.update_item(t, added)
+            self.assertEqual(len(cache), 0)
+            self.ro.get_item(t, added[u'id'])
+
+            self.wo.update_subitem(
+                t, added[u'id'], updated[u'revision'], self.subitem_name,
+                {u'secret_identity': u'Clark Kent'})
+            self.assertEqual(len(cache), 0)
+            self.ro.get_item(t, added[u'id'])
+
+            self.wo.delete_item(t, added[u'id'])
+            self.assertEqual(len(cache), 0)
+
     def get_item_from_disk(self, transaction, item):
         return self.ro.get_item(transaction, item[u'id'])
 
@@ -149,6 +195,58 @@ class WriteOnlyStorageTests(unittest.TestCase):
             obj = self.get_item_from_disk(t, added)
             self.assertEqual(updated, obj)
 
+    def test_updates_lists_of_item(self):
+        with self.dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.person)
+            self.wo.update_subitem(
+                t, added[u'id'], added[u'revision'], self.subitem_name,
+                {u'secret_identity': u'Bruce Wayne'})
+            person_v2 = self.ro.get_item(t, added[u'id'])
+            person_v2[u'aliases'] = [u'Batman', u'Alfred E. Newman']
+            person_v2[u'addrs'] = [
+                {
+                    u'country': u'GB',
+                    u'lines': [u'addr1'],
+                    u'inner': [],
+                },
+            ]
+            updated = self.wo.update_item(t, person_v2)
+            obj = self.get_item_from_disk(t, added)
+            self.assertEqual(updated, obj)
+            self.assertEqual(
+                self.ro.get_subitem(t, added[u'id'], self.subitem_name),
+                {u'secret_identity': u'Bruce Wayne'})
+
+            person_v3 = dict(updated)
+            person_v3[u'aliases'] = []
+            person_v3[u'addrs'] = self.person[u'addrs']
+            updated = self.wo.update_item(t, person_v3)
+            obj = self.get_item_from_disk(t, added)
+            self.assertEqual(updated, obj)
+
+    def test_update_only_writes_changed_rows(self):
+        with self.dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.person)
+            writes = []
+
+            def record(what, func):
+                def wrapper(table_name, *args, **kwargs):
+                    writes.append((what, table_name))
+                    return func(table_name, *args, **kwargs)
+                return wrapper
+
+            t.insert = record('INSERT', t.insert)
+            t.insert_many = record('INSERT', t.insert_many)
+            t.update = record('UPDATE', t.update)
+            t.delete = record('DELETE', t.delete)
+
+            person_v2 = dict(added)
+            person_v2[u'name'] = u'Bruce Wayne'
+            updated = self.wo.update_item(t, person_v2)
+            self.assertEqual(writes, [('UPDATE', self.resource_type)])
+            obj = self.get_item_from_disk(t, added)
+            self.assertEqual(updated, obj)
+
     def test_refuses_to_update_item_with_wrong_revision(self):
         with self.dbconn.transaction() as t:
             added = self.wo.add_item(t, self.person)
@@ -162,6 +260,34 @@ class WriteOnlyStorageTests(unittest.TestCase):
             obj = self.get_item_from_disk(t, added)
             self.assertEqual(added, obj)
 
+    def test_refuses_to_update_item_that_does_not_exist(self):
+        with self.dbconn.transaction() as t:
+            person = dict(self.person, id=u'nope', revision=u'nope')
+            with self.assertRaises(qvarn.ItemDoesNotExist):
+                self.wo.update_item(t, person)
+            with self.assertRaises(qvarn.ItemDoesNotExist):
+                self.wo.update_subitem(
+                    t, u'nope', u'nope', self.subitem_name,
+                    {u'secret_identity': u'Peter Parker'})
+
+    def test_checks_revision_while_updating(self):
+        with self.dbconn.transaction() as t:
+            added = self.wo.add_item(t, self.person)
+            selected = []
+            select = t.select
+
+            def record(table_name, *args, **kwargs):
+                selected.append(table_name)
+                return select(table_name, *args, **kwargs)
+
+            t.select = record
+            person_v2 = dict(added, name=u'Bruce Wayne')
+            updated = self.wo.update_item(t, person_v2)
+            self.wo.update_subitem(
+                t, added[u'id'], updated[u'revision'],
+                self.subitem_name, {u'secret_identity': u'Peter Parker'})
+            self.assertNotIn(self.resource_type, selected)
+
     def test_deletes_item(self):
         with self.dbconn.transaction() as t:
             added = self.wo.add_item(t, self.person)